@@ -41,7 +41,14 @@ period. If there are too many failed login attempts during that period, the user
 will be locked out.
 """
 
-import time
+import urllib
+import logging
+import threading
+
+from bespin.cache import LRUCache
+from bespin.redis import RedisError
+
+log = logging.getLogger("bespin.auth")
 
 class FailedLoginInfo(object):
     def __init__(self, username, can_log_in, failed_attempts):
@@ -66,36 +73,87 @@ class DoNothingFailedLoginTracker(object):
         pass
     
 class MemoryFailedLoginTracker(object):
-    """Stores the information in memory. This is really only for development/testing
-    purposes. You would not use this in production. The failed logins are not
-    automatically expired."""
+    """Stores the information in memory. The failed logins expire after the
+    lockout period and at most max_entries usernames are tracked, with
+    the least recently seen ones forgotten first. Because the information
+    is kept per process, this should only be used when there is a single
+    server process."""
     
-    def __init__(self, number_of_attempts, lockout_period):
+    def __init__(self, number_of_attempts, lockout_period, max_entries=10000):
         self.number_of_attempts = number_of_attempts
         self.lockout_period = lockout_period
-        self.store = {}
+        self.store = LRUCache(max_entries, ttl=lockout_period)
         
     def can_log_in(self, username):
-        now = time.time()
-        current = self.store.get(username, [0, now])
-        if now > current[1]:
-            # reset if we've passed the time out
-            current = [0, 0]
-            del self.store[username]
-            
-        if current[0] >= self.number_of_attempts:
-            return FailedLoginInfo(username, False, current[0])
-        return FailedLoginInfo(username, True, current[0])
+        attempts = self.store.get(username, 0)
+        if attempts >= self.number_of_attempts:
+            return FailedLoginInfo(username, False, attempts)
+        return FailedLoginInfo(username, True, attempts)
         
     def login_failed(self, fli):
-        current = self.store.setdefault(fli.username, [0, 0])
-        current[0] += 1
-        current[1] = time.time() + self.lockout_period
+        # the lockout period starts again with each failure
+        self.store.set(fli.username, self.store.get(fli.username, 0) + 1)
         
     def login_successful(self, fli):
+        self.store.delete(fli.username)
+
+class RedisFailedLoginTracker(object):
+    """Stores the failed login counts in redis, so that lockouts apply
+    across all of the server processes. Redis expires the counts
+    after the lockout period."""
+    
+    def __init__(self, redis, number_of_attempts, lockout_period):
+        self.redis = redis
+        self.number_of_attempts = number_of_attempts
+        self.lockout_period = lockout_period
+        # the redis client is not safe to share between threads
+        self.lock = threading.Lock()
+    
+    def _get_key(self, username):
+        if isinstance(username, unicode):
+            username = username.encode("utf8")
+        return "loginfail_" + urllib.quote(username, "")
+    
+    def can_log_in(self, username):
+        key = self._get_key(username)
+        self.lock.acquire()
+        try:
+            try:
+                attempts = int(self.redis.get(key) or 0)
+            except RedisError:
+                # don't lock everyone out if redis is unavailable
+                log.exception("Problem checking failed logins for %s", username)
+                attempts = 0
+        finally:
+            self.lock.release()
+        if attempts >= self.number_of_attempts:
+            return FailedLoginInfo(username, False, attempts)
+        return FailedLoginInfo(username, True, attempts)
+    
+    def login_failed(self, fli):
+        key = self._get_key(fli.username)
+        self.lock.acquire()
+        try:
+            try:
+                # INCR and EXPIRE go to redis in a single round trip
+                self.redis.pipeline(('INCR', key),
+                                    ('EXPIRE', key, self.lockout_period))
+            except RedisError:
+                log.exception("Problem tracking failed login for %s",
+                              fli.username)
+        finally:
+            self.lock.release()
+    
+    def login_successful(self, fli):
+        if not fli.failed_attempts:
+            return
+        key = self._get_key(fli.username)
+        self.lock.acquire()
         try:
-            del self.store[fli.username]
-        except KeyError:
-            pass
-        
-        
\ No newline at end of file
+            try:
+                self.redis.delete(key)
+            except RedisError:
+                log.exception("Problem clearing failed logins for %s",
+                              fli.username)
+        finally:
+            self.lock.release()
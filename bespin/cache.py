@@ -0,0 +1,117 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+"""A small in-memory cache with a bounded size."""
+
+import time
+import threading
+
+class LRUCache(object):
+    """Holds up to max_entries values. When the cache is full, the least
+    recently used entries are discarded. If ttl (in seconds) is given,
+    entries also expire that long after they were last set."""
+    
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.store = {}
+        self.lock = threading.Lock()
+        self._counter = 0
+    
+    def _tick(self):
+        self._counter += 1
+        return self._counter
+    
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            entry = self.store.get(key)
+            if entry is None:
+                return default
+            if self.ttl is not None and time.time() > entry[1]:
+                del self.store[key]
+                return default
+            entry[2] = self._tick()
+            return entry[0]
+        finally:
+            self.lock.release()
+    
+    def set(self, key, value):
+        self.lock.acquire()
+        try:
+            if self.ttl is not None:
+                expires = time.time() + self.ttl
+            else:
+                expires = None
+            self.store[key] = [value, expires, self._tick()]
+            if len(self.store) > self.max_entries:
+                self._evict()
+        finally:
+            self.lock.release()
+    
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            self.store.pop(key, None)
+        finally:
+            self.lock.release()
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.store.clear()
+        finally:
+            self.lock.release()
+    
+    def __len__(self):
+        return len(self.store)
+    
+    def _evict(self):
+        """Drops the expired entries and, if that isn't enough, the least
+        recently used tenth of the cache so that eviction doesn't happen
+        on every set."""
+        store = self.store
+        if self.ttl is not None:
+            now = time.time()
+            for key, entry in store.items():
+                if now > entry[1]:
+                    del store[key]
+        if len(store) <= self.max_entries:
+            return
+        target = max(1, self.max_entries - self.max_entries / 10)
+        by_age = sorted(store.items(), key=lambda item: item[1][2])
+        for key, entry in by_age[:len(store) - target]:
+            del store[key]
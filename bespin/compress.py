@@ -0,0 +1,262 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+# 
+
+"""Compression of responses, as WSGI middleware."""
+
+import os
+import re
+import zlib
+import rfc822
+import mimetypes
+
+from bespin.filesystem import FileIter
+
+# content types that are already compressed, so compressing them again
+# would only cost time
+_compressed_types = re.compile(r"^(image/(?!svg)|audio/|video/|"
+    r"application/(zip|x-zip-compressed|x-gzip|gzip|x-bzip2|x-compress|"
+    r"x-7z-compressed|x-rar-compressed|octet-stream)$)")
+
+# the zlib window bits for each content coding: gzip has its own header
+# and trailer, HTTP's "deflate" is the zlib format
+_window_bits = dict(gzip=16 + zlib.MAX_WBITS, deflate=zlib.MAX_WBITS)
+
+def choose_encoding(accept_encoding, codings=("gzip", "deflate")):
+    """Returns the first of codings that the Accept-Encoding header value
+    allows, or None if the response should be sent uncompressed."""
+    qualities = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            name, sep, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    for coding in codings:
+        quality = qualities.get(coding, qualities.get("*", 0.0))
+        if quality > 0:
+            return coding
+    return None
+
+def _get_header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+def _etag_suffix(coding):
+    return "-" + coding
+
+def _strip_etag_suffixes(if_none_match):
+    """Compressed responses get the coding added to their ETag, so that
+    it differs from the uncompressed one. The application only knows the
+    original ETags."""
+    for coding in _window_bits:
+        if_none_match = if_none_match.replace(_etag_suffix(coding) + '"', '"')
+    return if_none_match
+
+class _CompressedIter(object):
+    def __init__(self, app_iter, coding, level):
+        self.app_iter = app_iter
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                           _window_bits[coding])
+
+    def __iter__(self):
+        compressor = self.compressor
+        for chunk in self.app_iter:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def close(self):
+        if hasattr(self.app_iter, "close"):
+            self.app_iter.close()
+
+def compress_middleware(app, min_size=1024, level=6):
+    """Compresses responses for clients that accept gzip or deflate.
+    Bodies are compressed as they stream by. Responses that are smaller
+    than min_size bytes, aren't 200s, are already encoded or have a
+    content type that is already compressed are passed through."""
+    def wrapped(environ, start_response):
+        coding = choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if coding is None or environ["REQUEST_METHOD"] == "HEAD":
+            return app(environ, start_response)
+
+        if "HTTP_IF_NONE_MATCH" in environ:
+            environ["HTTP_IF_NONE_MATCH"] = _strip_etag_suffixes(
+                environ["HTTP_IF_NONE_MATCH"])
+
+        response = []
+        written = []
+        def capture(status, headers, exc_info=None):
+            response[:] = [status, headers, exc_info]
+            return written.append
+
+        app_iter = app(environ, capture)
+        status, headers, exc_info = response
+        if written:
+            # an old style application that used write()
+            app_iter = written + list(app_iter)
+
+        content_type = (_get_header(headers, "Content-Type") or "")
+        content_type = content_type.split(";")[0].strip().lower()
+        length = _get_header(headers, "Content-Length")
+        if (not status.startswith("200")
+            or _get_header(headers, "Content-Encoding")
+            or _compressed_types.match(content_type)
+            or (length is not None and int(length) < min_size)):
+            start_response(status, headers, exc_info)
+            return app_iter
+
+        new_headers = []
+        vary = None
+        for name, value in headers:
+            lname = name.lower()
+            if lname == "content-length":
+                continue
+            elif lname == "vary":
+                vary = value
+                continue
+            elif lname == "etag" and value.endswith('"'):
+                value = value[:-1] + _etag_suffix(coding) + '"'
+            new_headers.append((name, value))
+        if vary and vary.strip() != "*":
+            vary += ", Accept-Encoding"
+        elif not vary:
+            vary = "Accept-Encoding"
+        new_headers.append(("Vary", vary))
+        new_headers.append(("Content-Encoding", coding))
+        start_response(status, new_headers, exc_info)
+        return _CompressedIter(app_iter, coding, level)
+    return wrapped
+
+def precompressed_middleware(app, directory):
+    """Serves a file's gzipped sibling (foo.js.gz for foo.js) from the
+    static directory when the client accepts gzip and the sibling is at
+    least as new as the file, answering conditional GETs with a 304 the
+    way static.Cling does. Everything else is passed on to app."""
+    directory = os.path.abspath(directory)
+    def wrapped(environ, start_response):
+        if environ["REQUEST_METHOD"] not in ("GET", "HEAD") or \
+                choose_encoding(environ.get("HTTP_ACCEPT_ENCODING", ""),
+                                ("gzip",)) is None:
+            return app(environ, start_response)
+
+        filename = os.path.normpath(os.path.join(directory,
+                        environ.get("PATH_INFO", "").lstrip("/")))
+        if not filename.startswith(directory + os.sep):
+            return app(environ, start_response)
+        try:
+            mtime = os.stat(filename).st_mtime
+            compressed = open(filename + ".gz", "rb")
+        except (IOError, OSError):
+            return app(environ, start_response)
+
+        body = FileIter(compressed)
+        compressed_mtime = os.fstat(compressed.fileno()).st_mtime
+        if compressed_mtime < mtime:
+            # out of date: the original is served until it's rebuilt
+            body.close()
+            return app(environ, start_response)
+
+        etag = '"%s"' % body.etag
+        last_modified = rfc822.formatdate(compressed_mtime)
+        headers = [("Vary", "Accept-Encoding"),
+                   ("ETag", etag),
+                   ("Last-Modified", last_modified)]
+        if_none = environ.get("HTTP_IF_NONE_MATCH")
+        if_modified = environ.get("HTTP_IF_MODIFIED_SINCE")
+        if if_none:
+            not_modified = if_none.strip() == "*" or etag in if_none
+        elif if_modified:
+            since = rfc822.parsedate(if_modified)
+            not_modified = since is not None and \
+                since >= rfc822.parsedate(last_modified)
+        else:
+            not_modified = False
+        if not_modified:
+            body.close()
+            start_response("304 Not Modified", headers)
+            return []
+
+        content_type = mimetypes.guess_type(filename)[0]
+        headers = [("Content-Type", content_type or "application/octet-stream"),
+                   ("Content-Length", str(body.size)),
+                   ("Content-Encoding", "gzip")] + headers
+        start_response("200 OK", headers)
+        if environ["REQUEST_METHOD"] == "HEAD":
+            body.close()
+            return []
+        return body
+    return wrapped
+
+def compress_directory(directory, min_size=1024, level=9):
+    """Writes a .gz sibling for each file in directory (and below) that
+    is worth compressing. Returns the number of files written."""
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for name in filenames:
+            if name.endswith(".gz"):
+                continue
+            filename = os.path.join(dirpath, name)
+            content_type = mimetypes.guess_type(filename)[0] or ""
+            if _compressed_types.match(content_type) or \
+                    os.path.getsize(filename) < min_size:
+                continue
+            compressed = filename + ".gz"
+            if os.path.exists(compressed) and \
+                    os.path.getmtime(compressed) >= os.path.getmtime(filename):
+                continue
+            data = open(filename, "rb").read()
+            compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                          _window_bits["gzip"])
+            output = open(compressed, "wb")
+            try:
+                output.write(compressor.compress(data) + compressor.flush())
+            finally:
+                output.close()
+            count += 1
+    return count
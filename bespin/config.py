@@ -47,7 +47,8 @@ from path import path
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-from bespin import stats, auth
+from bespin import stats, auth, passwords, notify
+from bespin.cache import LRUCache
 
 class InvalidConfiguration(Exception):
     pass
@@ -66,8 +67,52 @@ c = Bunch()
 c.dburl = None
 c.db_pool_size = 10
 c.db_pool_overflow = 10
+
+# requests to endpoints exposed with read_only=True are sent to one of
+# these database replicas (a list, or URLs separated by spaces), taking
+# turns. If the replica fails, the request is run again on dburl. The
+# replicas' connection pools are sized separately.
+c.db_replica_urls = []
+c.db_replica_pool_size = 10
+c.db_replica_pool_overflow = 10
+c.replica_engines = []
+c.replica_session_factories = []
+
 c.secret = "This is the phrase that is used for secret stuff."
 c.pw_secret = "This phrase encrypts passwords."
+
+# how passwords are hashed: "pbkdf2" (salted PBKDF2-SHA256 with
+# password_iterations rounds; "paver bench_passwords" will suggest a
+# value for your hardware) or "sha256" (the old unsalted scheme).
+# Passwords stored any other way are rehashed when their user logs in.
+c.password_hash = "pbkdf2"
+c.password_iterations = 10000
+
+# hashing runs on password_hash_threads threads. When
+# password_hash_queue logins are already waiting, further logins are
+# turned away until the queue drains.
+c.password_hash_threads = 2
+c.password_hash_queue = 20
+
+# successful password checks are remembered for this many seconds
+# (0 turns this off)
+c.password_cache_ttl = 300
+c.password_cache_size = 1000
+c.passwords = None
+
+# the parsed BespinSettings files (settings and pluginInfo.json) of up to
+# settings_cache_size users are kept in memory. A cached file is only
+# checked for changes once settings_check_interval seconds have passed
+# since the last check; changes made through Bespin are seen right away.
+c.settings_cache_size = 1000
+c.settings_check_interval = 5
+c.settings_cache = None
+
+# number of threads that list directories when a project's files are
+# scanned (after a version control clone, for a rescan or when quotas
+# are verified). More than 1 helps with big projects, particularly on
+# network filesystems.
+c.scan_threads = 1
 c.static_dir = path.getcwd() / ".." / "bespinclient" / "tmp" / "static"
 
 c.plugin_path = []
@@ -103,6 +148,32 @@ c.static_map = {}
 # resources without altering Bespin's sources.
 c.static_override = None
 
+# how files are saved. "fast" overwrites files in place without fsync,
+# so a crash part way through a save can lose the file. "safe" writes a
+# temporary file, fsyncs it and renames it over the original.
+# "paver bench_writes" compares the modes.
+c.write_mode = "safe"
+c.write_sync = None
+
+# the files that template installs (the SampleProject and BespinSettings
+# every new user gets) and gallery plugin installs write can be kept once,
+# in a content-addressed store in blob_dir (fsroot/.blobs by default),
+# and hardlinked into projects. Saves replace files rather than writing
+# into them, so an edit gives the user their own copy. "paver
+# collect_blobs" removes the blobs that are no longer linked.
+c.use_blob_store = False
+c.blob_dir = None
+c.blob_store = None
+
+# responses to clients that accept gzip or deflate are compressed unless
+# they're smaller than compress_min_size bytes or their content type is
+# already compressed. Files in the static_map directories with a
+# gzipped sibling ("paver compress_static" writes them) are served
+# from that instead.
+c.compress_responses = True
+c.compress_min_size = 1024
+c.compress_level = 6
+
 # turns on asynchronous running of long jobs (like vcs)
 c.async_jobs = True
 # can be "" or False, "beanstalk" or True, or "restmq" for now
@@ -127,6 +198,13 @@ c.stats_type = "none"
 c.redis_host = None
 c.redis_port = None
 
+# when stats_flush_interval is set (in milliseconds), stats updates
+# are buffered in memory and sent to the stats backend in one batch
+# every stats_flush_interval milliseconds or every
+# stats_flush_events updates, whichever comes first.
+c.stats_flush_interval = 0
+c.stats_flush_events = 100
+
 # login failure tracking: none, memory, redis
 # memory holds the login failure attempts in a dictionary and should
 # not be used in production
@@ -140,6 +218,37 @@ c.login_attempts = 10
 # how long a user is locked out (in seconds)
 c.lockout_period = 600
 
+# the maximum number of usernames tracked by the memory login
+# failure tracker
+c.login_tracker_max_entries = 10000
+
+# /messages/ polls can ask to wait (with ?wait=seconds) for up to
+# message_wait_max seconds for a message to arrive, instead of the
+# client polling again. Each waiting poll holds a server thread, so
+# size the server's thread pool to match. Polls that carry mobwrite
+# edits are always answered straight away.
+c.message_wait_max = 0
+
+# how waiting polls find out about new messages: "memory" only sees
+# messages sent from the same process, "redis" uses redis pub/sub
+# (on redis_host and redis_port) so that messages from queue workers
+# and other web processes are seen too.
+c.message_notification = "memory"
+c.message_notifier = None
+
+# log_event hands events to a background thread that writes them to the
+# EventLog in batches of up to event_log_batch_size rows, at least every
+# event_log_interval seconds. If event_log_max_pending events back up,
+# later ones are appended to event_log_spill_file (load them with
+# "paver load_event_spill") or dropped if that isn't set. Turn
+# event_log_async off to insert each event as part of its request.
+c.event_log_async = True
+c.event_log_batch_size = 100
+c.event_log_interval = 1
+c.event_log_max_pending = 10000
+c.event_log_spill_file = None
+c.event_log_writer = None
+
 # The options for mobwrite_implementation are defined in controllers.py.
 # Currently: MobwriteInProcess, MobwriteTelnetProxy, or MobwriteHttpProxy
 c.mobwrite_implementation = "MobwriteHttpProxy"
@@ -174,6 +283,15 @@ c.stats_users = set()
 # a list of keys to display other than the base set
 c.stats_display = set()
 
+# sampling profiler: if profile_sample_rate is set, one in every
+# profile_sample_rate requests for each exposed function is run under
+# cProfile and the results are collected in memory. The stats_users can
+# retrieve them from /stats/profile/. If profile_slow_threshold is set
+# (in milliseconds), sampled requests faster than that are discarded.
+c.profile_sample_rate = 0
+c.profile_slow_threshold = 0
+c.profiler = None
+
 # Locations that should be added to Dojo's module path for loading
 # client side code.
 # See http://www.dojotoolkit.org/book/dojo-book-0-9/part-3-programmatic-dijit-and-dojo/modules-and-namespaces/creating-your-own-modul
@@ -219,6 +337,10 @@ def set_profile(profile):
         c.async_jobs = False
         c.mobwrite_implementation = "MobwriteInProcess"
         c.fslevels = 0
+        c.password_iterations = 10
+        c.event_log_async = False
+        c.settings_check_interval = 0
+        c.write_mode = "fast"
     elif profile == "dev":
         c.dburl = "sqlite:///%s" % (os.path.abspath("devdata.db"))
         c.fsroot = os.path.abspath("%s/../devfiles"
@@ -266,6 +388,25 @@ def load_pyconfig(configfile):
     exec(code)
     print(c.fsroot)
 
+def _create_engine(url, pool_size, pool_overflow):
+    engine_options = dict()
+    
+    if not url.startswith("sqlite"):
+        engine_options.update(pool_size=int(pool_size),
+        max_overflow=int(pool_overflow))
+    
+    # recycle connections for MySQL's benefit (by default, a MySQL
+    # server will disconnect automatically after a time.)
+    if url.startswith("mysql"):
+        # set it to 4 hours. default MySQL drops connection after 8 hours.
+        engine_options['pool_recycle'] = 14400
+        
+    # the query counter lets expose() record the number of
+    # statements run for each request
+    engine_options['proxy'] = stats.query_counter
+        
+    return create_engine(url, **engine_options)
+
 def activate_profile():
     
     if c.errorstack_key:
@@ -290,21 +431,40 @@ def activate_profile():
         for mapping in mappings:
             name, directory = mapping.split("=")
             static_map[name] = directory
+        c.static_map = static_map
 
-    engine_options = dict()
-    
-    if not c.dburl.startswith("sqlite"):
-        engine_options.update(pool_size=c.db_pool_size,
-        max_overflow=c.db_pool_overflow)
-    
-    # recycle connections for MySQL's benefit (by default, a MySQL
-    # server will disconnect automatically after a time.)
-    if c.dburl.startswith("mysql"):
-        # set it to 4 hours. default MySQL drops connection after 8 hours.
-        engine_options['pool_recycle'] = 14400
-        
-    c.dbengine = create_engine(c.dburl, **engine_options)
-    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine))
+    c.dbengine = _create_engine(c.dburl, c.db_pool_size, c.db_pool_overflow)
+
+    if isinstance(c.db_replica_urls, basestring):
+        c.db_replica_urls = c.db_replica_urls.split()
+    c.replica_engines = [_create_engine(url, c.db_replica_pool_size,
+                                        c.db_replica_pool_overflow)
+                         for url in c.db_replica_urls]
+
+    if c.redis_port:
+        c.redis_port = int(c.redis_port)
+
+    if c.message_notification == "redis":
+        c.message_notifier = notify.RedisNotifier(c.redis_host, c.redis_port)
+    else:
+        c.message_notifier = notify.MemoryNotifier()
+    c.message_wait_max = float(c.message_wait_max)
+
+    c.session_factory = scoped_session(sessionmaker(bind=c.dbengine,
+                        extension=notify.MessageExtension(c.message_notifier)))
+    c.replica_session_factories = [
+        scoped_session(sessionmaker(bind=engine))
+        for engine in c.replica_engines]
+
+    if c.event_log_writer is not None:
+        c.event_log_writer.stop()
+    if c.event_log_async:
+        from bespin import database
+        c.event_log_writer = database.EventLogWriter(c.dbengine,
+            int(c.event_log_batch_size), float(c.event_log_interval),
+            int(c.event_log_max_pending), c.event_log_spill_file)
+    else:
+        c.event_log_writer = None
 
     c.fsroot = path(c.fsroot)
     c.gallery_root = c.fsroot / "gallery"
@@ -330,9 +490,6 @@ def activate_profile():
         elif c.async_jobs == "restmq":
             c.queue = queue.RestMqQueue(c.queue_host, c.queue_port, timeout=float(c.queue_timeout))
 
-    if c.redis_port:
-        c.redis_port = int(c.redis_port)
-
     if c.stats_type == "redis" or c.login_failure_tracking == "redis":
         from bespin import redis
         redis_client = redis.Redis(c.redis_host, c.redis_port)
@@ -348,11 +505,46 @@ def activate_profile():
     else:
         c.stats = stats.DoNothingStats()
 
+    c.stats_flush_interval = int(c.stats_flush_interval)
+    c.stats_flush_events = int(c.stats_flush_events)
+    if c.stats_flush_interval and c.stats_type in ("redis", "memory"):
+        c.stats = stats.BufferedStats(c.stats,
+                                      c.stats_flush_interval / 1000.0,
+                                      c.stats_flush_events)
+
     if isinstance(c.stats_users, basestring):
         c.stats_users = set(c.stats_users.split(','))
     if isinstance(c.stats_display, basestring):
         c.stats_display = set(c.stats_display.split(','))
 
+    c.profile_sample_rate = int(c.profile_sample_rate)
+    if c.profile_sample_rate:
+        from bespin import profiler
+        c.profiler = profiler.SamplingProfiler(c.profile_sample_rate,
+                                        float(c.profile_slow_threshold))
+    else:
+        c.profiler = None
+
+    c.password_iterations = int(c.password_iterations)
+    hashers = [passwords.SHA256Hasher(c.pw_secret),
+               passwords.PBKDF2Hasher(c.pw_secret, c.password_iterations)]
+    c.passwords = passwords.PasswordManager(
+        passwords.get_hasher(c.password_hash, c.pw_secret,
+                             c.password_iterations),
+        hashers, int(c.password_hash_threads), int(c.password_hash_queue),
+        int(c.password_cache_size), int(c.password_cache_ttl))
+
+    from bespin import filesystem
+    c.write_sync = filesystem.get_write_sync(c.write_mode)
+    if c.use_blob_store:
+        c.blob_store = filesystem.BlobStore(c.blob_dir or c.fsroot / ".blobs")
+    else:
+        c.blob_store = None
+
+    c.settings_cache = LRUCache(int(c.settings_cache_size))
+    c.settings_check_interval = float(c.settings_check_interval)
+    c.scan_threads = int(c.scan_threads)
+
     if c.login_attempts:
         c.login_attempts = int(c.login_attempts)
 
@@ -362,9 +554,14 @@ def activate_profile():
     if c.login_failure_tracking == "redis":
         if not redis_client:
             raise InvalidConfiguration("Login failure tracking is set to redis, but redis is not configured")
+        # the tracker gets its own connection, separate from the stats
+        c.login_tracker = auth.RedisFailedLoginTracker(
+            redis.Redis(c.redis_host, c.redis_port), c.login_attempts,
+            c.lockout_period)
     elif c.login_failure_tracking == "memory":
         c.login_tracker = auth.MemoryFailedLoginTracker(c.login_attempts, 
-                                                        c.lockout_period)
+                                c.lockout_period,
+                                int(c.login_tracker_max_entries))
     else:
         c.login_tracker = auth.DoNothingFailedLoginTracker()
 
@@ -46,8 +46,9 @@ import urllib
 from hashlib import sha256
 import re
 import md5
+import pstats
 
-from urlrelay import URLRelay, register
+from urlrelay import register
 from paste.auth import auth_tkt
 from paste.proxy import Proxy
 import simplejson
@@ -57,15 +58,25 @@ from webob import Request, Response
 
 from bespin.config import c
 from bespin.framework import expose, BadRequest
-from bespin import vcs, deploy
+from bespin import vcs, deploy, framework
+from bespin.stats import get_histogram_keys, percentile
 from bespin.database import User, get_project, log_event, GalleryPlugin
 from bespin.filesystem import NotAuthorized, OverQuota, File, FileNotFound
 from bespin.utils import send_email_template
-from bespin import filesystem, queue, plugins
+from bespin.passwords import PasswordHashBusy
+from bespin import filesystem, queue, plugins, database, compress
 from bespin.plugins import get_user_plugin_path, get_user_plugin_info
 
 log = logging.getLogger("bespin.controllers")
 
+def _password_hash_busy(response):
+    """Tells the client to come back later, because all of the
+    password hashing workers are in use."""
+    response.status = "503 Service Unavailable"
+    response.headers['Retry-After'] = "5"
+    response.body = "Too many logins in progress, please try again."
+    return response()
+
 @expose(r'^/register/new/(?P<username>.*)$', 'POST', auth=False)
 def new_user(request, response):
     try:
@@ -74,7 +85,10 @@ def new_user(request, response):
         password = request.POST['password']
     except KeyError:
         raise BadRequest("username, email and password are required.")
-    user = User.create_user(username, password, email)
+    try:
+        user = User.create_user(username, password, email)
+    except PasswordHashBusy:
+        return _password_hash_busy(response)
 
     settings_project = get_project(user, user, "BespinSettings", create=True)
     settings_project.install_template('usertemplate')
@@ -122,7 +136,10 @@ def login(request, response):
         response.body = "Locked out due to failed login attempts."
         return response()
         
-    user = User.find_user(username, password)
+    try:
+        user = User.find_user(username, password)
+    except PasswordHashBusy:
+        return _password_hash_busy(response)
     if not user:
         c.login_tracker.login_failed(fli)
         response.status = "401 Not Authorized"
@@ -191,7 +208,10 @@ def password_change(request, response):
     code = request.POST.get('code')
     if verify_code != code:
         raise BadRequest("Invalid verification code for password change.")
-    user.password = User.generate_password(request.POST['newPassword'])
+    try:
+        user.password = User.generate_password(request.POST['newPassword'])
+    except PasswordHashBusy:
+        return _password_hash_busy(response)
     return response()
 
 @expose(r'^/register/userdata/(?P<username>.+)$')
@@ -214,6 +234,7 @@ def save_settings(request, response):
     user.settings.update(request.POST)
     # make it so that the user obj appears dirty to SQLAlchemy
     user.settings = user.settings
+    database.invalidate_settings(user)
     return response()
 
 @expose(r'^/settings/(?P<setting_name>.*)$', 'GET')
@@ -245,6 +266,7 @@ def delete_setting(request, response):
         user.settings = user.settings
     except KeyError:
         response.status = "404 Not Found"
+    database.invalidate_settings(user)
     return response()
 
 def _split_path(request):
@@ -268,6 +290,12 @@ def listopen(request, response):
     response.body = simplejson.dumps(result)
     return response()
 
+def _settings_changed(project):
+    """Files in BespinSettings are cached (see database.invalidate_settings),
+    so writes to that project have to drop the owner's cached copies."""
+    if project.name == "BespinSettings":
+        database.invalidate_settings(project.owner)
+
 @expose(r'^/file/at/(?P<path>.*)$', 'PUT')
 def putfile(request, response):
     user = request.user
@@ -284,25 +312,43 @@ def putfile(request, response):
             raise BadRequest("Path ended in '/' indicating directory, but request contains ")
         project.create_directory(path)
     elif path:
-        project.save_file(path, request.body)
+        length = request.content_length
+        if length is None:
+            project.save_file(path, request.body)
+        else:
+            project.save_file_from(path, request.body_file, length)
+    _settings_changed(project)
     log_event("filesave", request.user)
     return response()
 
-@expose(r'^/file/at/(?P<path>.*)$', 'GET')
+# file contents may be kept by the browser, but have to be revalidated
+# (with the ETag) every time they're used
+FILE_CACHE = "private, no-cache"
+
+def _send_file(response, file_obj, content_type):
+    """Streams the file's contents as the response body. The response
+    answers If-None-Match with a 304 and Range with the partial
+    content."""
+    body = file_obj.open_iter()
+    response.app_iter = body
+    response.content_length = body.size
+    response.etag = body.etag
+    response.content_type = content_type
+    response.conditional_response = True
+    return response()
+
+@expose(r'^/file/at/(?P<path>.*)$', 'GET', cache_control=FILE_CACHE)
 def getfile(request, response):
     user = request.user
 
     owner, project, path = _split_path(request)
     project = get_project(user, owner, project)
 
-    mode = request.GET.get('mode', 'rw')
-    contents = project.get_file(path, mode)
+    file_obj = project.get_file_object(path)
     
     _tell_file_event(user, project, path, 'open')
     
-    response.body = contents
-    response.content_type = "zombie/brains"
-    return response()
+    return _send_file(response, file_obj, "zombie/brains")
 
 @expose(r'^/file/close/(?P<path>.*)$', 'POST')
 def postfile(request, response):
@@ -322,9 +368,10 @@ def deletefile(request, response):
     project = get_project(user, owner, project)
 
     project.delete(path)
+    _settings_changed(project)
     return response()
 
-@expose(r'^/file/list/(?P<path>.*)$', 'GET')
+@expose(r'^/file/list/(?P<path>.*)$', 'GET', read_only=True)
 def file_list(request, response):
     user = request.user
     path = request.kwargs['path']
@@ -356,7 +403,7 @@ def file_list(request, response):
 
     return _respond_json(response, files)
 
-@expose(r'^/file/list_all/(?P<path>.*)$', 'GET')
+@expose(r'^/file/list_all/(?P<path>.*)$', 'GET', read_only=True)
 def file_list_all(request, response):
     user = request.user
     path = request.kwargs['path']
@@ -467,6 +514,11 @@ def filestats(request, response):
 @expose(r'^/project/import/(?P<project_name>[^/]+)', "POST")
 def import_project(request, response):
     project_name = request.kwargs['project_name']
+    # refuse uploads that can't fit before the body is read (the upload
+    # itself is spooled to a temporary file by the form parser)
+    length = request.content_length
+    if length is not None and not request.user.check_save(length):
+        raise OverQuota()
     input_file = request.POST['filedata']
     filename = input_file.filename
     _perform_import(request.user, project_name, filename,
@@ -558,7 +610,7 @@ def export_project(request, response):
     response.app_iter = filegen()
     return response()
     
-@expose(r'^/preview/at/(?P<path>.+)$')
+@expose(r'^/preview/at/(?P<path>.+)$', cache_control=FILE_CACHE)
 def preview_file(request, response):
     user = request.user
     
@@ -569,9 +621,7 @@ def preview_file(request, response):
     project = get_project(user, owner, project)
     
     file_obj = project.get_file_object(path)
-    response.body = str(file_obj.data)
-    response.content_type = file_obj.mimetype
-    return response()
+    return _send_file(response, file_obj, file_obj.mimetype)
     
 @expose(r'^/project/rename/(?P<project_name>.+)/$', 'POST')
 def rename_project(request, response):
@@ -584,7 +634,7 @@ def rename_project(request, response):
     response.content_type = "text/plain"
     return response()
 
-@expose(r'^/network/followers/$', 'GET')
+@expose(r'^/network/followers/$', 'GET', read_only=True)
 def follow(request, response):
     return _users_followed_response(request.user, response)
 
@@ -625,13 +675,13 @@ def tell(request, response):
     response.content_type = "text/plain"
     return response()
 
-@expose(r'^/group/list/all', 'GET')
+@expose(r'^/group/list/all', 'GET', read_only=True)
 def group_list_all(request, response):
     groups = request.user.get_groups()
     groups = [ group.name for group in groups ]
     return _respond_json(response, groups)
 
-@expose(r'^/group/list/(?P<group>[^/]+)/$', 'GET')
+@expose(r'^/group/list/(?P<group>[^/]+)/$', 'GET', read_only=True)
 def group_list(request, response):
     group_name = request.kwargs['group']
     group = request.user.get_group(group_name, raise_on_not_found=True)
@@ -704,42 +754,39 @@ def _users_following_response(user, response):
 
 def _tell_file_event(user, project, path, event):
     followers = user.users_following_me()
-    followers = [follower.following.username for follower in followers if follower.following]
+    followers = [follower.following for follower in followers if follower.following]
     # find the owner
     isMyProject = _is_project_shared(project, user)
-    for follower in followers:
-        #try:
-            member = User.find_user(follower)
-            if isMyProject and _is_project_shared(project, member):
-                # we can safely send a message
-                member.publish({
-                    'msgtargetid': 'file_event',
-                    'from':    user.username,
-                    'event':   event,
-                    'project': project.name,
-                    'owner':   project.owner.username,
-                    'path':    path,
-                })
-        #except:
-            #pass
+    if not isMyProject:
+        return
+    for member in project.owner.filter_shared_users(project, followers):
+        # we can safely send a message
+        member.publish({
+            'msgtargetid': 'file_event',
+            'from':    user.username,
+            'event':   event,
+            'project': project.name,
+            'owner':   project.owner.username,
+            'path':    path,
+        })
     
 def _is_project_shared(project, user):
     return project.owner.username == user.username or project.owner.is_project_shared(project, user)
 
-@expose(r'^/share/list/all/$', 'GET')
+@expose(r'^/share/list/all/$', 'GET', read_only=True)
 def share_list_all(request, response):
     "List all project shares"
     data = request.user.get_sharing()
     return _respond_json(response, data)
 
-@expose(r'^/share/list/(?P<project>[^/]+)/$', 'GET')
+@expose(r'^/share/list/(?P<project>[^/]+)/$', 'GET', read_only=True)
 def share_list_project(request, response):
     "List sharing for a given project"
     project = get_project(request.user, request.user, request.kwargs['project'])
     data = request.user.get_sharing(project)
     return _respond_json(response, data)
 
-@expose(r'^/share/list/(?P<project>[^/]+)/(?P<member>[^/]+)/$', 'GET')
+@expose(r'^/share/list/(?P<project>[^/]+)/(?P<member>[^/]+)/$', 'GET', read_only=True)
 def share_list_project_member(request, response):
     "List sharing for a given project and member"
     project = get_project(request.user, request.user, request.kwargs['project'])
@@ -788,11 +835,16 @@ def share_tell(request, response):
     isMyProject = _is_project_shared(project, user)
     # notify recipients
     list = []
-    recipients = post.get('recipients', [])
-    for recipient in recipients:
-        #try:
-            member = User.find_user(recipient)
-            if isMyProject and _is_project_shared(project, member):
+    recipients = []
+    for recipient in post.get('recipients', []):
+        member = User.find_user(recipient)
+        if member:
+            recipients.append((recipient, member))
+    if isMyProject:
+        shared = project.owner.filter_shared_users(project,
+                        [member for recipient, member in recipients])
+        for recipient, member in recipients:
+            if member in shared:
                 # we can safely send a message
                 member.publish({
                     'msgtargetid': 'share_tell',
@@ -800,19 +852,17 @@ def share_tell(request, response):
                     'text': text
                 })
                 list.append(recipient)
-        #except:
-        #    pass
     response.body = simplejson.dumps(list)
     response.content_type = "text/plain"
     return response()
 
-@expose(r'^/viewme/list/all/$', 'GET')
+@expose(r'^/viewme/list/all/$', 'GET', read_only=True)
 def viewme_list_all(request, response):
     "List all the members with view settings on me"
     data = request.user.get_viewme()
     return _respond_json(response, data)
 
-@expose(r'^/viewme/list/(?P<member>[^/]+)/$', 'GET')
+@expose(r'^/viewme/list/(?P<member>[^/]+)/$', 'GET', read_only=True)
 def viewme_list(request, response):
     "List the view settings for a given member"
     member = request.user.find_member(request.kwargs['member'])
@@ -1072,7 +1122,8 @@ def messages(request, response):
         body = u"[]"
     else:
         question = request.body
-        msgs = [simplejson.loads(msg) for msg in user.pop_messages()]
+        wait = _get_message_wait(request, question)
+        msgs = [simplejson.loads(msg) for msg in _pop_messages(user, wait)]
         if "collab" in c.capabilities:
             answer = ask_mobwrite(question, user) + "\n\n"
             msgs.append({
@@ -1086,7 +1137,69 @@ def messages(request, response):
     response.body = body.encode("utf8")
     return response()
 
-@expose('^/stats/$', 'GET')
+def _get_message_wait(request, question):
+    """Works out how many seconds a /messages/ poll can wait for a
+    message to arrive."""
+    try:
+        wait = float(request.GET.get("wait", 0))
+    except ValueError:
+        raise BadRequest("wait should be a number of seconds")
+    # mobwrite edits need to go back and forth without delay
+    if "collab" in c.capabilities and question.strip():
+        return 0
+    return max(0, min(wait, c.message_wait_max))
+
+def _pop_messages(user, wait):
+    """Pops the user's messages, waiting up to wait seconds for one
+    to arrive if there are none."""
+    msgs = user.pop_messages()
+    if msgs or not wait:
+        return msgs
+    c.stats.incr("message_waits_DATE")
+    listener = c.message_notifier.listen(user.id)
+    try:
+        # finish the transaction so that the wait doesn't hold on to
+        # a database connection, and so that messages committed since
+        # are visible
+        database._get_session().commit()
+        msgs = user.pop_messages()
+        if not msgs and listener.wait(wait):
+            msgs = user.pop_messages()
+    finally:
+        c.message_notifier.unlisten(listener)
+    return msgs
+
+def _get_route_stats(today):
+    """Returns the request count, latency percentiles (in ms) and the
+    average response size and number of queries for each route that
+    has been requested today."""
+    hist_keys = dict((route, get_histogram_keys(
+                        "timing_%s_%s" % (route, today)))
+                    for route in framework.routes)
+    keys = []
+    for route in framework.routes:
+        keys.extend(hist_keys[route])
+        keys.append("bytes_%s_%s" % (route, today))
+        keys.append("queries_%s_%s" % (route, today))
+    values = c.stats.multiget(keys)
+    
+    result = {}
+    for route in framework.routes:
+        counts = [int(values.get(key) or 0) for key in hist_keys[route]]
+        count = sum(counts)
+        if not count:
+            continue
+        total_bytes = int(values.get("bytes_%s_%s" % (route, today)) or 0)
+        queries = int(values.get("queries_%s_%s" % (route, today)) or 0)
+        result[route] = dict(count=count,
+            p50=percentile(counts, 50),
+            p90=percentile(counts, 90),
+            p99=percentile(counts, 99),
+            avgBytes=total_bytes / count,
+            avgQueries=float(queries) / count)
+    return result
+
+@expose('^/stats/$', 'GET', read_only=True)
 def stats(request, response):
     username = request.username
     if username not in c.stats_users:
@@ -1103,10 +1216,48 @@ def stats(request, response):
     more_keys = [k.replace("_DATE", "_" + today) for k in c.stats_display]
     keys.extend(more_keys)
     result = c.stats.multiget(keys)
+    result['routes'] = _get_route_stats(today)
     response.content_type = "application/json"
     response.body = simplejson.dumps(result)
     return response()
     
+@expose('^/stats/profile/$', 'GET')
+def profile_stats(request, response):
+    """Dumps the data collected by the sampling profiler. The route
+    parameter limits the output to one exposed function. format=pstats
+    returns the data in the pstats file format instead of as text."""
+    if request.username not in c.stats_users:
+        raise NotAuthorized("Not allowed to access stats")
+    if not c.profiler:
+        raise FileNotFound("The sampling profiler is not turned on")
+    route = request.GET.get("route")
+    if request.GET.get("format") == "pstats":
+        response.content_type = "application/octet-stream"
+        response.body = c.profiler.dump_pstats(route)
+    elif request.GET.get("format") == "routes":
+        response.content_type = "application/json"
+        response.body = simplejson.dumps(c.profiler.routes)
+    else:
+        try:
+            limit = int(request.GET.get("limit", 80))
+        except ValueError:
+            limit = 80
+        sort = request.GET.get("sort", "cumulative")
+        if sort not in pstats.Stats.sort_arg_dict_default:
+            raise BadRequest("Unknown sort key: %s" % sort)
+        response.content_type = "text/plain"
+        response.body = c.profiler.dump_text(route, sort, limit)
+    return response()
+
+@expose('^/stats/profile/$', 'DELETE')
+def reset_profile_stats(request, response):
+    """Throws away the data collected by the sampling profiler."""
+    if request.username not in c.stats_users:
+        raise NotAuthorized("Not allowed to access stats")
+    if c.profiler:
+        c.profiler.reset()
+    return _respond_blank(response)
+
 @expose('^/project/deploy/(?P<project_name>[^/]+)/setup$', 'PUT')
 def deploy_setup(request, response):
     user = request.user
@@ -1259,9 +1410,8 @@ def register_boot_plugin(request, response):
     return response()
 
 def _user_plugin_response(request, response, environment='main'):
-    plugin_info, project = get_user_plugin_info(request.user)
-    path = get_user_plugin_path(request.user, plugin_info=plugin_info,
-        project=project)
+    plugin_info = get_user_plugin_info(request.user)
+    path = get_user_plugin_path(request.user, plugin_info=plugin_info)
 
     return _plugin_response(response, path, environment=environment,
         plugin_info=plugin_info)
@@ -1306,9 +1456,53 @@ def load_script(request, response):
         return _plugin_does_not_exist(response, plugin_name)
     
     script_text = plugin.get_script_text(script_path)
-    response.body = _wrap_script(plugin_name, script_path, script_text)
+    response.body = plugins.wrap_script(plugin_name, script_path, script_text)
     return response()
     
+# bundle URLs carry a stamp of their contents (see Plugin.bundle_stamp),
+# so the responses can be kept until the URL changes
+BUNDLE_CACHE = "public, max-age=31536000"
+
+@expose(r'^/plugin/bundle/(?P<plugin_location>[^/]+)/(?P<plugin_name>[^/]+)/(?P<stamp>[^/]+)\.js$', 'GET', auth=False, cache_control=BUNDLE_CACHE)
+def load_bundle(request, response):
+    """Serves all of a plugin's scripts in one response."""
+    plugin_name = request.kwargs['plugin_name']
+    plugin_location = request.kwargs['plugin_location']
+    if ".." in plugin_name or ".." in plugin_location:
+        raise BadRequest("'..' not allowed in plugin names")
+    
+    if plugin_location == "user":
+        if not request.user:
+            raise NotAuthorized("Log in to load your plugins")
+        path = get_user_plugin_path(request.user)
+        response.headers['Cache-Control'] = "private, max-age=31536000"
+    else:
+        path = [path_entry for path_entry in c.plugin_path
+                if path_entry['name'] == plugin_location]
+    
+    if not path:
+        raise FileNotFound("Plugin location %s unknown" % (plugin_location))
+    
+    plugin = plugins.lookup_plugin(plugin_name, path)
+    if not plugin:
+        return _plugin_does_not_exist(response, plugin_name)
+    
+    stamp, script, compressed = plugin.get_bundle()
+    if stamp != request.kwargs['stamp']:
+        # an out of date URL gets the current scripts, which mustn't be
+        # kept under the old URL
+        response.headers['Cache-Control'] = framework.NO_CACHE
+    
+    response.content_type = "text/javascript"
+    response.headers['Vary'] = "Accept-Encoding"
+    if compress.choose_encoding(request.headers.get("Accept-Encoding", ""),
+                                ("gzip",)):
+        response.body = compressed
+        response.content_encoding = "gzip"
+    else:
+        response.body = script
+    return response()
+
 @expose(r'^/plugin/file/(?P<plugin_location>[^/]+)/(?P<plugin_name>[^/]+)/(?P<path>.*)', 'GET', auth=False)
 def load_file(request, response):
     plugin_name = request.kwargs['plugin_name']
@@ -1401,7 +1595,7 @@ def plugin_templates(request, response):
         raise FileNotFound("Plugin %s has no templates" % plugin_name)
     
     response.content_type = "text/javascript"
-    response.body = _wrap_script(plugin_name, "templates", template_module)
+    response.body = plugins.wrap_script(plugin_name, "templates", template_module)
     return response()
 
 class FileIterable(object):
@@ -1442,16 +1636,6 @@ def download_plugin(request, response):
     return response()
     
     
-def _wrap_script(plugin_name, script_path, script_text):
-    if script_path:
-        module_name = os.path.splitext(script_path)[0]
-    else:
-        module_name = "index"
-        
-    return """; %s.module('%s:%s', function(require, exports, module) {%s
-;}); %s.script('%s:%s');""" % (c.loader_name, plugin_name, module_name, 
-        script_text, c.loader_name, plugin_name, script_path)
-
 urlmatch = re.compile(r'^(http|https)://')
 
 @expose(r'^/plugin/install/$', 'POST')
@@ -1494,6 +1678,7 @@ def db_middleware(app):
         from sqlalchemy.orm import scoped_session
         session = c.session_factory()
         environ['bespin.docommit'] = True
+        database.start_request_cache(session)
         try:
             # If you need to work out what <script> tags to insert into a
             # page to get Dojo to behave properly, then uncomment these 3
@@ -1513,6 +1698,8 @@ def db_middleware(app):
             c.stats.incr("exceptions_DATE")
             log.exception("Error raised during request: %s", environ)
             raise
+        finally:
+            database.end_request_cache(session)
         c.stats.disconnect()
         return result
     return wrapped
@@ -1527,6 +1714,24 @@ def pathpopper_middleware(app, num_to_pop=1):
 
 _separate_plugin_name = re.compile("/([^/]+):")
 
+class _WrappedScript(object):
+    """Streams a plugin script between the head and tail that
+    script_wrapper gives for it."""
+    def __init__(self, head, app_iter, tail):
+        self.head = head
+        self.app_iter = app_iter
+        self.tail = tail
+
+    def __iter__(self):
+        yield self.head
+        for chunk in self.app_iter:
+            yield chunk
+        yield self.tail
+
+    def close(self):
+        if hasattr(self.app_iter, "close"):
+            self.app_iter.close()
+
 def scriptwrapper_middleware(app):
     def new_app(environ, start_response):
         req = Request(environ)
@@ -1545,14 +1750,16 @@ def scriptwrapper_middleware(app):
             process_script = False
         result = req.get_response(app)
         if process_script and result.status.startswith("200"):
-            contents = result.body
-            newbody = _wrap_script(plugin_name, script_path, contents)
-            result.headers['Content-Length'] = str(len(newbody))
+            # wrap the script as it streams by instead of buffering it
+            head, tail = plugins.script_wrapper(plugin_name, script_path)
+            if result.content_length is not None:
+                result.content_length = (len(head) + result.content_length
+                                         + len(tail))
             result.headers['Content-Type'] = "text/javascript"
             start_response(result.status, result.headers.items())
-            return [newbody]
+            return _WrappedScript(head, result.app_iter, tail)
         start_response(result.status, result.headers.items())
-        return [result.body]
+        return result.app_iter
     return new_app
     
 class URLRelayCompatibleProxy(Proxy):
@@ -1581,10 +1788,14 @@ def make_app():
     
     for location, directory in c.static_map.items():
         topop = 1 + location.count('/')
-        more_static = pathpopper_middleware(static.Cling(directory), topop)
+        more_static = static.Cling(directory)
+        if c.compress_responses:
+            more_static = compress.precompressed_middleware(more_static,
+                                                            directory)
+        more_static = pathpopper_middleware(more_static, topop)
         register("^/%s/" % location, more_static)
 
-    app = URLRelay(default=static_app)
+    app = framework.IndexedURLRelay(default=static_app)
     app = auth_tkt.AuthTKTMiddleware(app, c.secret, secure=c.secure_cookie, 
                 include_ip=False, httponly=c.http_only_cookie,
                 current_domain_cookie=c.current_domain_cookie, wildcard_cookie=False)
@@ -1595,4 +1806,8 @@ def make_app():
         app = TransLogger(app)
         
     app = scriptwrapper_middleware(app)
+    
+    if c.compress_responses:
+        app = compress.compress_middleware(app, int(c.compress_min_size),
+                                           int(c.compress_level))
     return app
@@ -38,9 +38,12 @@
 """Data classes for working with files/projects/users."""
 from datetime import datetime
 import logging
+import threading
+import time
+import atexit
+import itertools
 from uuid import uuid4
 import simplejson
-from hashlib import sha256
 
 from path import path as path_obj
 from pathutils import LockError as PULockError, Lock, LockFile
@@ -48,12 +51,15 @@ from pathutils import LockError as PULockError, Lock, LockFile
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import (Column, PickleType, String, Integer,
                     Boolean, ForeignKey, Binary,
-                    DateTime, Text, Table)
-from sqlalchemy.orm import relation
+                    DateTime, Text, Table, Index, select, union_all, and_,
+                    literal)
+from sqlalchemy.orm import relation, eagerload
 from sqlalchemy.exc import DBAPIError
 from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.sql.expression import ClauseElement
 
 from bespin import config, filesystem
+from bespin.cache import LRUCache
 from bespin.utils import _check_identifiers, BadValue
 from bespin.filesystem import get_project, Project, LockError
 
@@ -67,8 +73,113 @@ def debug():
         for found in _get_session().query(table).all():
             print found
 
+# the replica session factory in use by each thread (see use_replica)
+_replica = threading.local()
+_replica_turn = itertools.count()
+
 def _get_session():
-    return config.c.session_factory()
+    factory = getattr(_replica, "factory", None)
+    if factory is None:
+        factory = config.c.session_factory
+    return factory()
+
+def _execute(query):
+    """Runs a SQL expression query in the current session. Unlike
+    session.query, session.execute doesn't autoflush, so this flushes
+    first to make the changes made earlier in the request visible."""
+    session = _get_session()
+    session.flush()
+    return session.execute(query)
+
+def use_replica():
+    """Sends this thread's queries to one of c.replica_session_factories
+    until use_primary is called. Nothing written in the meantime is
+    committed, so this is only for read-only requests. Returns False if
+    there are no replicas configured."""
+    factories = config.c.replica_session_factories
+    if not factories:
+        return False
+    _replica.factory = factories[_replica_turn.next() % len(factories)]
+    return True
+
+def use_primary():
+    """Goes back to the primary database after use_replica, discarding
+    the replica session."""
+    factory = getattr(_replica, "factory", None)
+    if factory is None:
+        return
+    _replica.factory = None
+    factory.remove()
+
+# usernames mapped to user ids. Ids never change, so this can be shared
+# between requests; it saves the username query and lets the session's
+# identity map answer instead.
+_user_ids = LRUCache(10000, ttl=600)
+
+def start_request_cache(session):
+    """Remember the users looked up during a request (see db_middleware)
+    so that repeated lookups of the same username don't query again."""
+    session.bespin_users = {}
+
+def end_request_cache(session):
+    session.bespin_users = None
+
+def _get_request_users():
+    return getattr(_get_session(), "bespin_users", None)
+
+def _parse_settings(settings_file):
+    settings = {}
+    if settings_file is None:
+        return settings
+    for line in settings_file.lines(retain=False):
+        info = line.split(" ", 1)
+        if len(info) != 2:
+            continue
+        settings[info[0]] = info[1]
+    return settings
+
+def _parse_plugin_info(info_file):
+    if info_file is None:
+        return None
+    try:
+        return simplejson.loads(info_file.bytes())
+    except ValueError:
+        return None
+
+def _read_settings_file(user, filename, parse):
+    """Returns parse(file) for one of the user's BespinSettings files
+    (or parse(None) if the file doesn't exist). The result is kept in
+    c.settings_cache until the file's mtime or size changes, and the
+    file isn't looked at again for c.settings_check_interval seconds."""
+    cache = config.c.settings_cache
+    files = cache.get(user.id) or {}
+    entry = files.get(filename)
+    now = time.time()
+    if entry is not None and now - entry[0] < config.c.settings_check_interval:
+        return entry[2]
+
+    settings_file = user.get_location() / "BespinSettings" / filename
+    try:
+        info = settings_file.stat()
+        stamp = (info.st_mtime, info.st_size)
+    except OSError:
+        stamp = None
+    if entry is not None and entry[1] == stamp:
+        value = entry[2]
+    elif stamp is None:
+        value = parse(None)
+    else:
+        value = parse(settings_file)
+
+    files = dict(files)
+    files[filename] = (now, stamp, value)
+    cache.set(user.id, files)
+    return value
+
+def invalidate_settings(user):
+    """Drops the cached BespinSettings files of the user. Call this after
+    changing them so that the change is seen right away."""
+    config.c.settings_cache.delete(user.id)
 
 Base = declarative_base()
 
@@ -77,7 +188,7 @@ class Connection(Base):
 
     followed_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True)
     followed = relation('User', primaryjoin='User.id==Connection.followed_id')
-    following_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    following_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True, index=True)
     following = relation('User', primaryjoin='User.id==Connection.following_id')
 
     followed_viewable = Column(Boolean, default=False)
@@ -93,14 +204,18 @@ class Message(Base):
     def __str__(self):
         return "Message[id=%s, msg=%s]" % (self.id, self.message)
 
+# messages are always read per user, oldest first
+Index("ix_messages_user_id_when", Message.__table__.c.user_id,
+      Message.__table__.c.when)
+
 class User(Base):
     __tablename__ = "users"
 
     id = Column(Integer, primary_key=True)
     uuid = Column(String(36), unique=True)
     username = Column(String(128), unique=True)
-    email = Column(String(128))
-    password = Column(String(64))
+    email = Column(String(128), index=True)
+    password = Column(String(128))
     settings = Column(PickleType())
     quota = Column(Integer, default=10)
     amount_used = Column(Integer, default=0)
@@ -121,9 +236,7 @@ class User(Base):
                     
     @staticmethod
     def generate_password(password):
-        password_hash = sha256()
-        password_hash.update(config.c.pw_secret + password)
-        return password_hash.hexdigest()
+        return config.c.passwords.encode(password)
 
     @classmethod
     def create_user(cls, username, password, email, override_location=None):
@@ -161,13 +274,40 @@ class User(Base):
                 return None
             user = users[0]
         else:
-            user = _get_session().query(cls).filter_by(username=username).first()
+            user = cls._find_by_username(username)
         if user and password is not None:
-            digest = User.generate_password(password)
-            if str(user.password) != digest:
+            valid, new_password = config.c.passwords.verify(user.username,
+                                            password, str(user.password))
+            if not valid:
                 user = None
+            elif new_password:
+                # upgrade the stored hash now that we have the password
+                user.password = new_password
         return user
         
+    @classmethod
+    def _find_by_username(cls, username):
+        request_users = _get_request_users()
+        if request_users is not None and username in request_users:
+            return request_users[username]
+
+        session = _get_session()
+        user = None
+        user_id = _user_ids.get(username)
+        if user_id is not None:
+            user = session.query(cls).get(user_id)
+            # the user may have been removed, and the id reused
+            if user is not None and user.username != username:
+                user = None
+        if user is None:
+            user = session.query(cls).filter_by(username=username).first()
+            if user is not None:
+                _user_ids.set(username, user.id)
+
+        if request_users is not None and user is not None:
+            request_users[username] = user
+        return user
+
     @classmethod
     def find_by_email(cls, email):
         """Looks up a user by email address."""
@@ -235,19 +375,46 @@ class User(Base):
                 if not name.basename().startswith(".")]
         result = sorted(result, key=lambda item: item.name)
         if include_shared:
-            for followee_connection in self.users_i_follow():
-                followee = followee_connection.followed
-                for project in followee.projects:
-                    if followee.is_project_shared(project, self):
-                        result.append(project)
+            result.extend(self.get_shared_projects())
         return result
 
+    def get_shared_projects(self):
+        """Find the projects of the users that this user follows which
+        are shared with this user. The sharing tables are kept in step
+        with project deletes and renames, so this is a single query
+        rather than a directory listing per followee."""
+        connections = Connection.__table__
+        shares = _sharing_query(self.id, connections.c.followed_id, None,
+                            connections.c.following_id==self.id).alias()
+        query = _get_session().query(User, shares.c.project_name) \
+            .filter(User.id==shares.c.owner_id) \
+            .distinct() \
+            .order_by(User.username, shares.c.project_name)
+        result = []
+        for owner, project_name in query:
+            location = owner.get_location() / project_name
+            # skip over shares of projects that were removed behind our back
+            if location.exists():
+                result.append(Project(owner, project_name, location))
+        return result
+
+    def rename_sharing(self, old_name, new_name):
+        """Carry the shares of a project over to its new name."""
+        for table in [UserSharing, GroupSharing, EveryoneSharing]:
+            _get_session().query(table) \
+                .filter_by(owner_id=self.id) \
+                .filter_by(project_name=old_name) \
+                .update(dict(project_name=new_name))
+
     @property
     def statusfile(self):
         return self.get_location() / ".bespin-status.json"
 
     def recompute_files(self):
-        """Recomputes how much space the user has used."""
+        """Recomputes how much space the user has used, by scanning
+        all of the files. Saves and deletes keep amount_used (and the
+        sizes recorded in each project's metadata) up to date, so this
+        is only needed to catch drift (see verify_space_used)."""
         total = 0
         # add up all of the directory contents
         # by only looking at directories, we skip
@@ -334,17 +501,13 @@ class User(Base):
     def get_settings(self):
         """Load a user's settings from BespinSettings/settings.
         Returns a dictionary."""
-        location = self.get_location()
-        settings_file = location / "BespinSettings" / "settings"
-        if not settings_file.exists():
-            return {}
-        settings = {}
-        for line in settings_file.lines(retain=False):
-            info = line.split(" ", 1)
-            if len(info) != 2:
-                continue
-            settings[info[0]] = info[1]
-        return settings
+        return dict(_read_settings_file(self, "settings", _parse_settings))
+
+    def get_plugin_info(self):
+        """Load a user's BespinSettings/pluginInfo.json. Returns None if
+        it is missing or isn't valid JSON. The result is shared between
+        callers, so don't modify it."""
+        return _read_settings_file(self, "pluginInfo.json", _parse_plugin_info)
 
     def find_member(self, member):
         """When a user refers to X, is this a reference to a user or a group or
@@ -368,11 +531,17 @@ class User(Base):
 
     def users_i_follow(self):
         """Retrieve a list of the users that someone follows."""
-        return _get_session().query(Connection).filter_by(following=self).all()
+        return _get_session().query(Connection) \
+            .options(eagerload('followed')) \
+            .filter_by(following=self) \
+            .all()
 
     def users_following_me(self):
         """Retrieve a list of the users that someone is following"""
-        return _get_session().query(Connection).filter_by(followed=self).all()
+        return _get_session().query(Connection) \
+            .options(eagerload('following')) \
+            .filter_by(followed=self) \
+            .all()
 
     def follow(self, followed_user):
         """Add a follow connection between 2 users"""
@@ -457,7 +626,9 @@ class User(Base):
     def _get_user_sharing(self, project=None, invited_user=None):
         """Retrieve a list of the user level shares made by a user, optionally
         filtered by project and by invited user"""
-        query = _get_session().query(UserSharing).filter_by(owner_id=self.id)
+        query = _get_session().query(UserSharing) \
+            .options(eagerload('invited')) \
+            .filter_by(owner_id=self.id)
         if project != None:
             query = query.filter_by(project_name=project.name)
         if invited_user != None:
@@ -467,7 +638,9 @@ class User(Base):
     def _get_group_sharing(self, project=None, invited_group=None):
         """Retrieve a list of the group level shares made by a user, optionally
         filtered by project and by invited group"""
-        query = _get_session().query(GroupSharing).filter_by(owner_id=self.id)
+        query = _get_session().query(GroupSharing) \
+            .options(eagerload('invited')) \
+            .filter_by(owner_id=self.id)
         if project != None:
             query = query.filter_by(project_name=project.name)
         if invited_group != None:
@@ -494,47 +667,41 @@ class User(Base):
         }
 
     def is_project_shared(self, project, user, require_write=False):
-        if self._is_project_everyone_shared(project, require_write):
-            return True
-        if self._is_project_user_shared(project, user, require_write):
-            return True
-        groups = self.get_groups(user)
-        for group in groups:
-            if self._is_project_group_shared(project, group, require_write):
-                return True
-        return False
-
-    def _is_project_user_shared(self, project, user, require_write=False):
-        if isinstance(project, Project):
-            project = project.name
-        query = _get_session().query(UserSharing)
-        query = query.filter_by(owner_id=self.id)
-        query = query.filter_by(project_name=project)
-        query = query.filter_by(invited_user_id=user.id)
+        access = self.get_project_access(project, user)
         if require_write:
-            query = query.filter_by(edit=True)
-        return query.first() != None
-
-    def _is_project_group_shared(self, project, group, require_write=False):
+            return access == "write"
+        return access != None
+
+    def get_project_access(self, project, user):
+        """Find the level of access that user has to one of this user's
+        projects through everyone, user or group sharing. Returns None,
+        "read" or "write". This is a single query, because it's run
+        on every request for a shared project."""
         if isinstance(project, Project):
             project = project.name
-        query = _get_session().query(GroupSharing)
-        query = query.filter_by(owner_id=self.id)
-        query = query.filter_by(project_name=project)
-        query = query.filter_by(invited_group_id=group.id)
-        if require_write:
-            query = query.filter_by(edit=True)
-        return query.first() != None
-
-    def _is_project_everyone_shared(self, project, require_write=False):
+        query = _sharing_query(user.id, self.id, project_name=project)
+        edits = [row.edit for row in _execute(query)]
+        if not edits:
+            return None
+        if True in edits:
+            return "write"
+        return "read"
+
+    def filter_shared_users(self, project, users):
+        """Returns the users, out of those given, that one of this
+        user's projects is shared with (or who own it). This is a single
+        query however many users there are."""
         if isinstance(project, Project):
             project = project.name
-        query = _get_session().query(EveryoneSharing)
-        query = query.filter_by(owner_id=self.id)
-        query = query.filter_by(project_name=project)
-        if require_write:
-            query = query.filter_by(edit=True)
-        return query.first() != None
+        users = list(users)
+        if not users:
+            return []
+        user_id = User.__table__.c.id
+        query = _sharing_query(user_id, self.id, project,
+                               user_id.in_([user.id for user in users]))
+        shared_ids = set(row.user_id for row in _execute(query))
+        shared_ids.add(self.id)
+        return [user for user in users if user.id in shared_ids]
 
     def add_sharing(self, project, member, edit=False, loadany=False):
         if member == 'everyone':
@@ -611,11 +778,58 @@ class User(Base):
         print(message)
 
     def pop_messages(self):
-        messages = []
-        for message in self.messages:
-            messages.append(message.message)
-            _get_session().delete(message)
-        return messages
+        """Returns this user's messages, oldest first, and removes them.
+        This is one query and one delete, rather than loading each
+        Message through the relation and deleting it separately."""
+        session = _get_session()
+        rows = session.query(Message.id, Message.message) \
+            .filter_by(user_id=self.id) \
+            .order_by(Message.when, Message.id) \
+            .all()
+        if not rows:
+            return []
+        session.query(Message) \
+            .filter(Message.id.in_([row.id for row in rows])) \
+            .delete(synchronize_session=False)
+        session.expire(self, ['messages'])
+        return [row.message for row in rows]
+
+def _sharing_query(user_id, owner_id, project_name=None, *clauses):
+    """Build a union of (owner_id, project_name, edit, user_id) rows for
+    every everyone, user and group share that applies to the user with
+    user_id. user_id and owner_id can be ids or columns to join against,
+    and any extra clauses are added to each part of the union."""
+    everyone = EveryoneSharing.__table__
+    users = UserSharing.__table__
+    groups = GroupSharing.__table__
+    group = Group.__table__
+    membership = GroupMembership.__table__
+
+    everyone_clauses = [everyone.c.owner_id==owner_id]
+    user_clauses = [users.c.owner_id==owner_id,
+                    users.c.invited_user_id==user_id]
+    group_clauses = [groups.c.owner_id==owner_id,
+                     groups.c.invited_group_id==group.c.id,
+                     group.c.owner_id==groups.c.owner_id,
+                     membership.c.group_id==group.c.id,
+                     membership.c.user_id==user_id]
+    if project_name != None:
+        everyone_clauses.append(everyone.c.project_name==project_name)
+        user_clauses.append(users.c.project_name==project_name)
+        group_clauses.append(groups.c.project_name==project_name)
+
+    if not isinstance(user_id, ClauseElement):
+        user_id = literal(user_id)
+
+    parts = []
+    for table, table_clauses, shared_with in [
+            (everyone, everyone_clauses, user_id),
+            (users, user_clauses, users.c.invited_user_id),
+            (groups, group_clauses, membership.c.user_id)]:
+        columns = [table.c.owner_id, table.c.project_name, table.c.edit,
+                   shared_with.label("user_id")]
+        parts.append(select(columns, and_(*(table_clauses + list(clauses)))))
+    return union_all(*parts)
 
 class Group(Base):
     __tablename__ = "groups"
@@ -644,6 +858,7 @@ class Group(Base):
     def get_members(self):
         """Retrieve a list of the members of a given users group"""
         return _get_session().query(GroupMembership) \
+            .options(eagerload('user')) \
             .filter_by(group_id=self.id) \
             .all()
 
@@ -673,7 +888,7 @@ class GroupMembership(Base):
 
     group_id = Column(Integer, ForeignKey('groups.id', ondelete='cascade'), primary_key=True)
     group = relation(Group, primaryjoin=Group.id==group_id)
-    user_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='cascade'), primary_key=True, index=True)
     user = relation(User, primaryjoin=User.id==user_id)
 
     def __init__(self, group, user):
@@ -780,6 +995,12 @@ def log_event(kind, user, details=None):
         details = simplejson.dumps(details)
     else:
         details = None
+    
+    writer = config.c.event_log_writer
+    if writer is not None:
+        writer.add(dict(ts=datetime.now(), kind=kind, username=username,
+                        details=details))
+        return
         
     ins = EventLog.insert().values(kind=kind, username=username,
         details=details)
@@ -787,6 +1008,172 @@ def log_event(kind, user, details=None):
     conn = session.connection()
     conn.execute(ins)
 
+class EventLogWriter(object):
+    """Writes events to the EventLog from a background thread, so that
+    requests don't wait on it. Events are sent in multi-row inserts of
+    up to batch_size rows, every interval seconds or as soon as a full
+    batch is waiting.
+    
+    If more than max_pending events back up (the database is slow or
+    down), further events are set aside for the thread to append to
+    spill_file as JSON lines, to be loaded later with load_spill_file.
+    Without a spill_file, they are dropped and counted in the
+    eventlog_dropped stat. Events that arrive after stop() are written
+    straight away, since there's no thread left to write them."""
+    
+    def __init__(self, engine, batch_size=100, interval=1.0,
+                 max_pending=10000, spill_file=None):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.spill_file = spill_file
+        self.pending = []
+        self.overflow = []
+        self.condition = threading.Condition()
+        self.spill_lock = threading.Lock()
+        self.thread = None
+        self.stopped = False
+        atexit.register(self.stop)
+    
+    def add(self, event):
+        self.condition.acquire()
+        try:
+            stopped = self.stopped
+            if not stopped:
+                if len(self.pending) >= self.max_pending:
+                    self.overflow.append(event)
+                    self.condition.notify()
+                    return
+                self.pending.append(event)
+                if self.thread is None:
+                    self._start()
+                if len(self.pending) >= self.batch_size:
+                    self.condition.notify()
+        finally:
+            self.condition.release()
+        if stopped:
+            self._write([event])
+    
+    def _start(self):
+        self.thread = threading.Thread(target=self._run, name="eventlog")
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def _run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                if not self.stopped and not self.overflow and \
+                        len(self.pending) < self.batch_size:
+                    self.condition.wait(self.interval)
+                stopped = self.stopped
+            finally:
+                self.condition.release()
+            self.flush()
+            if stopped:
+                return
+    
+    def flush(self):
+        """Spills the overflow and writes out everything that is
+        waiting."""
+        self.condition.acquire()
+        try:
+            overflow = self.overflow
+            self.overflow = []
+        finally:
+            self.condition.release()
+        if overflow:
+            self._spill(overflow)
+        while True:
+            self.condition.acquire()
+            try:
+                batch = self.pending[:self.batch_size]
+                del self.pending[:self.batch_size]
+            finally:
+                self.condition.release()
+            if not batch:
+                return
+            # leave the rest for the next try, unless there won't be one
+            if not self._write(batch) and not self.stopped:
+                return
+    
+    def stop(self):
+        """Writes out the waiting events and stops the thread."""
+        self.condition.acquire()
+        try:
+            self.stopped = True
+            self.condition.notify()
+            thread = self.thread
+        finally:
+            self.condition.release()
+        if thread is not None:
+            thread.join()
+        # pick up anything the thread didn't get to
+        self.flush()
+    
+    def _write(self, batch):
+        """Inserts the batch, spilling it if that fails. Returns True
+        if the insert worked."""
+        try:
+            self.engine.execute(EventLog.insert(), batch)
+            return True
+        except Exception, e:
+            log.exception("Unable to write %s events", len(batch))
+            self._spill(batch)
+            return False
+    
+    def _spill(self, events):
+        if not self.spill_file:
+            config.c.stats.incr("eventlog_dropped_DATE", len(events))
+            return
+        lines = []
+        for event in events:
+            event = dict(event)
+            event['ts'] = event['ts'].strftime(_SPILL_TIME_FORMAT)
+            lines.append(simplejson.dumps(event) + "\n")
+        self.spill_lock.acquire()
+        try:
+            spill = open(self.spill_file, "a")
+            try:
+                spill.writelines(lines)
+            finally:
+                spill.close()
+        finally:
+            self.spill_lock.release()
+
+_SPILL_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def load_spill_file(filename, engine, batch_size=1000):
+    """Inserts the events from an EventLogWriter spill file into the
+    EventLog. Returns the number of events loaded."""
+    count = 0
+    batch = []
+    for line in open(filename):
+        event = simplejson.loads(line)
+        event['ts'] = datetime.strptime(event['ts'], _SPILL_TIME_FORMAT)
+        batch.append(event)
+        if len(batch) >= batch_size:
+            engine.execute(EventLog.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        engine.execute(EventLog.insert(), batch)
+        count += len(batch)
+    return count
+
+def verify_space_used(session):
+    """Recomputes amount_used for every user, to correct any drift
+    from changes that were made outside of Bespin. Returns a list of
+    (username, recorded, actual) for the users that were off."""
+    drifted = []
+    for user in session.query(User):
+        recorded = user.amount_used
+        user.recompute_files()
+        if user.amount_used != recorded:
+            drifted.append((user.username, recorded, user.amount_used))
+    return drifted
+
 class GalleryPlugin(Base):
     """Plugin Gallery entries"""
     __tablename__ = "gallery"
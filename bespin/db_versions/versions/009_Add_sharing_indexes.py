@@ -0,0 +1,23 @@
+from sqlalchemy import *
+from migrate import *
+
+metadata = MetaData()
+metadata.bind = migrate_engine
+
+def _membership_user_index():
+    memberships = Table('group_memberships', metadata, autoload=True)
+    return Index('ix_group_memberships_user_id', memberships.c.user_id)
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    
+    # group memberships are looked up by user when resolving group
+    # sharing; the primary key is (group_id, user_id) so it can't be used.
+    # The sharing tables are already covered by their unique constraints.
+    _membership_user_index().create()
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    
+    _membership_user_index().drop()
@@ -0,0 +1,22 @@
+from sqlalchemy import *
+from migrate import *
+
+metadata = MetaData()
+metadata.bind = migrate_engine
+
+def _following_index():
+    connections = Table('connections', metadata, autoload=True)
+    return Index('ix_connections_following_id', connections.c.following_id)
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    
+    # the shared project listing joins from the follower's side, which
+    # the (followed_id, following_id) primary key doesn't cover
+    _following_index().create()
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    
+    _following_index().drop()
@@ -0,0 +1,26 @@
+from sqlalchemy import *
+from migrate import *
+
+metadata = MetaData()
+metadata.bind = migrate_engine
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    
+    # salted hashes are tagged with their algorithm and parameters, so
+    # they need more room than the 64 character sha256 digests. Existing
+    # digests are left alone and get rehashed when their users log in.
+    # SQLite doesn't enforce VARCHAR lengths, so only other databases
+    # need changing.
+    if migrate_engine.name != "sqlite":
+        migrate_engine.execute("""ALTER TABLE users 
+    CHANGE password password VARCHAR(128)""")
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    
+    # this can't undo rehashed passwords, which won't fit in 64 characters
+    if migrate_engine.name != "sqlite":
+        migrate_engine.execute("""ALTER TABLE users 
+    CHANGE password password VARCHAR(64)""")
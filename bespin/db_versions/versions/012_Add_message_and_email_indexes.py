@@ -0,0 +1,33 @@
+from sqlalchemy import *
+from migrate import *
+
+metadata = MetaData()
+metadata.bind = migrate_engine
+
+def _indexes():
+    messages = Table('messages', metadata, autoload=True)
+    users = Table('users', metadata, autoload=True)
+    return [
+        # messages are read per user in the order they were sent
+        Index('ix_messages_user_id_when', messages.c.user_id,
+              messages.c.when),
+        # logging in with an email address looks users up by email
+        Index('ix_users_email', users.c.email)
+    ]
+
+def upgrade():
+    # Upgrade operations go here. Don't create your own engine; use the engine
+    # named 'migrate_engine' imported from migrate.
+    
+    # The sharing tables' unique constraints already index (owner_id,
+    # project_name, invited_*_id), and group memberships and connections
+    # were covered in 009 and 010. bespin/tests/test_query_plans.py
+    # checks that the queries in database.py use these.
+    for index in _indexes():
+        index.create()
+
+def downgrade():
+    # Operations to reverse the above upgrade go here.
+    
+    for index in _indexes():
+        index.drop()
@@ -37,6 +37,7 @@
 
 """Data classes for working with files/projects/users."""
 import os
+import errno
 import time
 import tarfile
 import tempfile
@@ -47,13 +48,18 @@ import logging
 import re
 import itertools
 import sqlite3
+import stat
+import threading
+import Queue
+from hashlib import sha1
 
 from path import path as path_obj
 from pathutils import LockError as PULockError, Lock, LockFile
 import simplejson
 
 from bespin import config, jsontemplate
-from bespin.utils import _check_identifiers, BadValue
+from bespin.utils import _check_identifiers, BadValue, load_template
+from bespin.cache import LRUCache
 
 log = logging.getLogger("bespin.model")
 
@@ -111,7 +117,12 @@ def get_project(user, owner, project_name, create=False, clean=False):
     if location.exists():
         project = ProjectView(user, owner, project_name, location)
         if clean:
+            # the old files stop counting against the quota
+            metadata = project._recorded_sizes()
+            owner.amount_used -= metadata.forget_size("", True)
+            metadata.cache_replace([])
             location.rmtree()
+            project._remove_temp_copy("")
             location.makedirs()
     else:
         if not create:
@@ -122,6 +133,42 @@ def get_project(user, owner, project_name, create=False, clean=False):
         config.c.stats.incr("projects")
     return project
 
+def expand_template(template, variables):
+    """Returns a list of (path, contents) for the files in the project
+    template (a directory found on c.template_path), expanded with the
+    variables given. See Project.install_template."""
+    if "/" in template or "." in template:
+        raise BadValue("Template names cannot include '/' or '.'")
+    found = False
+    for p in config.c.template_path:
+        source_dir = path_obj(p) / template
+        if source_dir.isdir():
+            found = True
+            break
+    if not found:
+        raise FSException("Unknown project template: %s" % template)
+
+    result = []
+    common_path_len = len(source_dir) + 1
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        destdir = dirpath[common_path_len:]
+        if '.svn' in destdir:
+            continue
+        for f in filenames:
+            if "{" in f:
+                dest_f = jsontemplate.expand(f, variables)
+            else:
+                dest_f = f
+
+            if destdir:
+                destpath = "%s/%s" % (destdir, dest_f)
+            else:
+                destpath = dest_f
+            variables['filename'] = dest_f
+            template_obj = load_template(os.path.join(dirpath, f))
+            result.append((destpath, template_obj.expand(variables)))
+    return result
+
 def _find_common_base(member_names):
     base = None
     base_len = None
@@ -198,6 +245,52 @@ class Directory(object):
     def listdir(self):
         return self.location.listdir()
 
+def _make_etag(stat):
+    """Builds a strong ETag that changes whenever the file is replaced
+    (inode), written to (mtime) or resized."""
+    return "%x-%x-%x" % (stat.st_ino, stat.st_size,
+                         int(stat.st_mtime * 1000000))
+
+class FileIter(object):
+    """Iterates over an open file in chunks, so that file contents can be
+    used as a WSGI app_iter without reading them into memory. Supports
+    webob's app_iter_range for Range requests."""
+
+    chunk_size = 65536
+
+    def __init__(self, fileobj, start=0, stop=None):
+        self.file = fileobj
+        stat = os.fstat(fileobj.fileno())
+        self.size = stat.st_size
+        self.etag = _make_etag(stat)
+        self.stop = stop
+        self.pos = start
+        if start:
+            fileobj.seek(start)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        size = self.chunk_size
+        if self.stop is not None:
+            size = min(size, self.stop - self.pos)
+        if size <= 0:
+            self.close()
+            raise StopIteration
+        data = self.file.read(size)
+        if not data:
+            self.close()
+            raise StopIteration
+        self.pos += len(data)
+        return data
+
+    def app_iter_range(self, start, stop):
+        return FileIter(self.file, start, stop)
+
+    def close(self):
+        self.file.close()
+
 class File(object):
     def __init__(self, project, name):
         if "../" in name:
@@ -239,6 +332,11 @@ class File(object):
     def data(self):
         return self.location.bytes()
 
+    def open_iter(self):
+        """Opens the file for reading and returns a FileIter over its
+        contents, with the size and etag taken from the open file."""
+        return FileIter(self.location.open("rb"))
+
     @property
     def mimetype(self):
         """Returns the mimetype of the file, or application/octet-stream
@@ -317,23 +415,113 @@ class File(object):
     def __repr__(self):
         return "File: %s" % (self.name)
 
-def _get_file_list(directory):
+# directories that hold version control data rather than project files
+_VCS_DIRS = frozenset([".hg", ".svn", ".bzr", ".git"])
+
+class _DirectoryScan(object):
+    """The files and subdirectories of one directory. Each entry is
+    stat'ed once, and version control directories are skipped without
+    being listed."""
+
+    def __init__(self, location):
+        self.location = location
+        self.entries = []
+
+    def scan(self):
+        """Lists the directory, returning the _DirectoryScans for its
+        subdirectories, which still need to be scanned."""
+        try:
+            names = os.listdir(self.location)
+        except OSError:
+            return []
+        names.sort()
+        subdirs = []
+        for name in names:
+            try:
+                info = os.stat(os.path.join(self.location, name))
+            except OSError:
+                continue
+            if stat.S_ISDIR(info.st_mode):
+                if name in _VCS_DIRS:
+                    continue
+                subdir = _DirectoryScan(os.path.join(self.location, name))
+                subdirs.append(subdir)
+                self.entries.append((name, subdir))
+            elif stat.S_ISREG(info.st_mode):
+                self.entries.append((name, info.st_size))
+        return subdirs
+
+    def files(self, prefix=""):
+        """Yields (path, size) for the files under this directory, in
+        sorted order."""
+        for name, entry in self.entries:
+            if isinstance(entry, _DirectoryScan):
+                for item in entry.files(prefix + name + "/"):
+                    yield item
+            else:
+                yield prefix + name, entry
+
+def _scan_directories(root, threads):
+    """Scans root and everything under it, listing directories in the
+    given number of threads."""
+    jobs = Queue.Queue()
+    def work():
+        while True:
+            scan = jobs.get()
+            if scan is None:
+                return
+            try:
+                try:
+                    for subdir in scan.scan():
+                        jobs.put(subdir)
+                except:
+                    log.exception("Error scanning %s", scan.location)
+            finally:
+                jobs.task_done()
+    workers = [threading.Thread(target=work) for i in range(threads)]
+    for worker in workers:
+        worker.setDaemon(True)
+        worker.start()
+    jobs.put(root)
+    jobs.join()
+    for worker in workers:
+        jobs.put(None)
+
+def _get_file_list(directory, threads=None):
+    """Returns the total size of the files under directory and a list of
+    (path, size) for them, in sorted order. Directories are listed in
+    c.scan_threads threads (or threads, if it's given)."""
+    if threads is None:
+        threads = config.c.scan_threads
+    root = _DirectoryScan(directory)
+    if threads > 1:
+        _scan_directories(root, threads)
+    else:
+        pending = [root]
+        while pending:
+            pending.extend(pending.pop().scan())
+    files = list(root.files())
     total = 0
-    files = []
-    for f in directory.walkfiles():
-        if ".hg" in f or ".svn" in f or ".bzr" in f or ".git" in f:
-            continue
-        total += f.size
-        files.append(directory.relpathto(f))
+    for name, size in files:
+        total += size
     return total, files
 
-def _get_space_used(directory):
-    total = 0
-    for f in directory.walkfiles():
-        if ".hg" in f or ".svn" in f or ".bzr" in f or ".git" in f:
-            continue
-        total += f.size
-    return total
+def _parent_dirs(filename):
+    """Returns the directories that contain filename, starting
+    with "" for the project itself: "a/b/c" gives "", "a/", "a/b/"."""
+    parts = filename.rstrip("/").split("/")[:-1]
+    result = [""]
+    for i in range(len(parts)):
+        result.append("/".join(parts[:i+1]) + "/")
+    return result
+
+def _add_to_dirs(cursor, dirnames, delta):
+    for dirname in dirnames:
+        cursor.execute("update dir_size set size=size+? where dirname=?",
+                        (delta, dirname))
+        if cursor.rowcount == 0:
+            cursor.execute("insert into dir_size (dirname, size) values (?, ?)",
+                            (dirname, delta))
 
 def _regexp(expr, item):
     if expr is None:
@@ -385,12 +573,61 @@ class Project(object):
     def __repr__(self):
         return "Project(name=%s)" % (self.name)
 
-    def save_file(self, destpath, contents=None):
+    def save_file(self, destpath, contents=None, shared=False):
         """Saves the contents to the file path provided, creating
         directories as needed in between. If last_edit is not provided,
         the file must not be opened for editing. Otherwise, the
         last_edit parameter should include the last edit ID received by
-        the user."""
+        the user. If shared is True and the blob store is enabled
+        (c.use_blob_store), the file is linked to the store's copy of
+        the contents."""
+        # count the bytes that end up on disk, as scan_files does
+        contents = _encode_contents(contents)
+        saved_size = len(contents)
+        file, is_new = self._start_save(destpath, saved_size)
+        blob_store = config.c.blob_store
+        if shared and blob_store is not None:
+            blob_store.link(file.location, contents)
+        else:
+            file.save(contents)
+        self._finish_save(file, is_new, saved_size)
+        return file
+
+    def save_file_from(self, destpath, fileobj, length=None, shared=False):
+        """Like save_file, but the contents are read from fileobj
+        in chunks (up to length bytes, if it's given) instead of being
+        held in memory. They are written to a temporary file next to the
+        destination, which is then renamed into place, so readers never
+        see a partially written file. The quota is checked against
+        length before anything is read and against the bytes read as
+        they arrive."""
+        file, is_new = self._start_save(destpath, length)
+
+        # check_save allows saves that leave something free
+        available = self.owner.quota * QUOTA_UNITS - self.owner.amount_used
+        def write(output):
+            saved_size = _copy_file(fileobj, output, length, available - 1)
+            if saved_size is None:
+                raise OverQuota()
+            if length is not None and saved_size < length:
+                raise FSException("Upload of %s ended after %s of %s bytes"
+                                  % (file.name, saved_size, length))
+            return saved_size
+        blob_store = config.c.blob_store
+        if shared and blob_store is not None:
+            saved_size = blob_store.link_from(file.location, write)
+        else:
+            # even the fast write mode can't overwrite in place here,
+            # because the upload may fail part way through
+            saved_size = _write_file(file.location, write, atomic=True)
+
+        self._finish_save(file, is_new, saved_size)
+        return file
+
+    def _start_save(self, destpath, length):
+        """Checks that a file of length bytes (if that's known) can be
+        saved at destpath and makes its directory. Returns the File and
+        whether it's new."""
         if "../" in destpath:
             raise BadValue("Relative directories are not allowed")
 
@@ -398,8 +635,7 @@ class Project(object):
         while destpath and destpath.startswith("/"):
             destpath = destpath[1:]
 
-        saved_size = len(contents) if contents is not None else 0
-        if not self.owner.check_save(saved_size):
+        if length is not None and not self.owner.check_save(length):
             raise OverQuota()
 
         file_loc = self.location / destpath
@@ -413,16 +649,20 @@ class Project(object):
         if not file_dir.exists():
             file_dir.makedirs()
 
+        # the sizes have to be recorded before the file changes, so that
+        # _finish_save sees the old size
+        self._recorded_sizes()
         file = File(self, destpath)
-        if file.exists():
-            size_delta = saved_size - file.saved_size
-        else:
-            size_delta = saved_size
-            self.metadata.cache_add(destpath)
+        return file, not file.exists()
+
+    def _finish_save(self, file, is_new, saved_size):
+        """Records a save of saved_size bytes that _start_save began."""
+        metadata = self.metadata
+        if is_new:
+            metadata.cache_add(file.name)
             config.c.stats.incr("files")
-        file.save(contents)
-        self.owner.amount_used += size_delta
-        return file
+        self.owner.amount_used += metadata.record_size(file.name, saved_size)
+        self._remove_temp_copy(file.name)
 
     def save_temp_file(self, destpath, contents=None):
         """Saves the contents to the file path provided, creating
@@ -437,8 +677,7 @@ class Project(object):
         while destpath and destpath.startswith("/"):
             destpath = destpath[1:]
 
-        temp_name = get_temp_file_name(self.name, destpath)
-        file_loc = self.location.parent / temp_name
+        file_loc = self.temp_directory / destpath
 
         if file_loc.isdir():
             raise FileConflict("Cannot save file at %s in project "
@@ -451,6 +690,39 @@ class Project(object):
 
         log.debug("save_temp_file to %s", file_loc)
         _save(file_loc, contents)
+        _get_temp_files(self.temp_directory).add(destpath)
+
+    @property
+    def temp_directory(self):
+        """The directory (next to the project) that holds mobwrite's
+        temp copies of the project's files."""
+        return self.location.parent / get_temp_file_name(self.name, "")
+
+    def _remove_temp_copy(self, path):
+        """Removes the mobwrite temp copy of path (or of everything under
+        path, if it's a directory), because the real file has changed."""
+        if "../" in path or path == ".." or path.endswith("/.."):
+            raise BadValue("Relative directories are not allowed")
+
+        # chop off any leading slashes
+        while path and path.startswith("/"):
+            path = path[1:]
+
+        temp_dir = self.temp_directory
+        temp_loc = temp_dir / path
+        # never remove anything outside of the temp directory
+        root = os.path.realpath(temp_dir)
+        resolved = os.path.realpath(temp_loc)
+        if resolved != root and not resolved.startswith(root + os.sep):
+            raise BadValue("%s is outside of project %s" % (path, self.name))
+        try:
+            if not path or path.endswith("/"):
+                temp_loc.rmtree()
+            else:
+                temp_loc.remove()
+        except OSError:
+            pass
+        _forget_temp_files(temp_dir, path)
 
     def create_directory(self, destpath):
         """Create a new directory"""
@@ -490,16 +762,12 @@ class Project(object):
 
         template_file = config.c.template_file_dir / template_name
         try:
-            fileobj = template_file.open()
-        except IOError:
+            tobj = load_template(template_file, header_options=True)
+        except (IOError, OSError):
             raise FileNotFound("There is no template called " + template_name);
-        tobj = jsontemplate.FromFile(fileobj)
-        try:
-            contents = tobj.expand(options['values'])
-        finally:
-            fileobj.close()
+        contents = tobj.expand(options['values'])
 
-        self.save_file(path, contents)
+        self.save_file(path, contents, shared=True)
 
     def install_template(self, template="template", other_vars=None):
         """Installs a set of template files into a new project.
@@ -528,17 +796,6 @@ class Project(object):
         """
         log.debug("Installing template %s for user %s as project %s",
                 template, self.owner, self.name)
-        if "/" in template or "." in template:
-            raise BadValue("Template names cannot include '/' or '.'")
-        found = False
-        for p in config.c.template_path:
-            source_dir = path_obj(p) / template
-            if source_dir.isdir():
-                found = True
-                break
-        if not found:
-            raise FSException("Unknown project template: %s" % template)
-
         if other_vars is not None:
             variables = LenientUndefinedDict(other_vars)
         else:
@@ -547,25 +804,8 @@ class Project(object):
         variables['project'] = self.name
         variables['username'] = self.owner.username
 
-        common_path_len = len(source_dir) + 1
-        for dirpath, dirnames, filenames in os.walk(source_dir):
-            destdir = dirpath[common_path_len:]
-            if '.svn' in destdir:
-                continue
-            for f in filenames:
-                if "{" in f:
-                    dest_f = jsontemplate.expand(f, variables)
-                else:
-                    dest_f = f
-
-                if destdir:
-                    destpath = "%s/%s" % (destdir, dest_f)
-                else:
-                    destpath = dest_f
-                contents = open(os.path.join(dirpath, f)).read()
-                variables['filename'] = dest_f
-                contents = jsontemplate.expand(contents, variables)
-                self.save_file(destpath, contents)
+        for destpath, contents in expand_template(template, variables):
+            self.save_file(destpath, contents, shared=True)
 
     def list_files(self, path=""):
         """Retrieve a list of files at the path. Directories will have
@@ -629,14 +869,17 @@ class Project(object):
                     raise FileNotFound("Directory %s in project %s does not exist" %
                             (path, self.name))
 
-            space_used = _get_space_used(location)
-
+            metadata = self._recorded_sizes()
             if not path:
-                self.metadata.delete()
+                space_used = metadata.get_space_used()
+                metadata.delete()
+                self.owner.remove_sharing(self)
             else:
-                self.metadata.cache_delete(path, True)
+                space_used = metadata.forget_size(dir_obj.name, True)
+                metadata.cache_delete(path, True)
 
             location.rmtree()
+            self._remove_temp_copy(dir_obj.name)
             config.c.stats.decr("projects")
             self.owner.amount_used -= space_used
         else:
@@ -652,10 +895,12 @@ class Project(object):
                     "File %s in project %s is in use by another user"
                     % (path, self.name))
 
-            self.owner.amount_used -= file_obj.saved_size
+            metadata = self._recorded_sizes()
             file_obj.location.remove()
             config.c.stats.decr("files")
-            self.metadata.cache_delete(path)
+            metadata.cache_delete(path)
+            self.owner.amount_used -= metadata.forget_size(file_obj.name)
+            self._remove_temp_copy(file_obj.name)
 
     def import_tarball(self, filename, file_obj, prefix=""):
         """Imports the tarball in the file_obj into the project
@@ -681,12 +926,12 @@ class Project(object):
                 if member.size > max_import_file_size:
                     raise FSException("File %s too large (max is %s bytes)"
                         % (member.name, max_import_file_size))
-                self.save_file(prefix + member.name[base_len:],
-                    pfile.extractfile(member).read())
+                self.save_file_from(prefix + member.name[base_len:],
+                    pfile.extractfile(member), member.size)
 
-    def import_zipfile(self, filename, file_obj, prefix=""):
+    def import_zipfile(self, filename, file_obj, prefix="", shared=False):
         """Imports the zip file in the file_obj into the project
-        project owned by user."""
+        project owned by user. shared is passed on to save_file_from."""
         max_import_file_size = config.c.max_import_file_size
 
         pfile = zipfile.ZipFile(file_obj)
@@ -701,8 +946,12 @@ class Project(object):
             if member.file_size > max_import_file_size:
                 raise FSException("File %s too large (max is %s bytes)"
                     % (member.filename, max_import_file_size))
-            self.save_file(prefix + member.filename[base_len:],
-                pfile.read(member.filename))
+            member_file = pfile.open(member)
+            try:
+                self.save_file_from(prefix + member.filename[base_len:],
+                    member_file, member.file_size, shared)
+            finally:
+                member_file.close()
 
     def export_tarball(self):
         """Exports the project as a tarball, returning a
@@ -789,16 +1038,27 @@ class Project(object):
                 " a project with the new name already exists."
                 % (self.name, new_name))
         old_location.rename(new_location)
+        self._remove_temp_copy("")
+        self.owner.rename_sharing(self.name, new_name)
         self.name = new_name
         self.location = new_location
 
     def scan_files(self):
         """Looks through the files, computes how much space they
-        take and updates the cached file list."""
+        take and updates the cached file list and recorded sizes."""
         space_used, files = _get_file_list(self.location)
-        self.metadata.cache_replace(files)
+        self.metadata.cache_replace([name for name, size in files])
+        self.metadata.sizes_replace(dict(files))
         return space_used
 
+    def _recorded_sizes(self):
+        """Returns the metadata, after scanning the files if their sizes
+        haven't been recorded yet (for projects from before they were)."""
+        metadata = self.metadata
+        if not metadata.sizes_recorded():
+            self.scan_files()
+        return metadata
+
     def search_files(self, query, limit=20, include=""):
         """Scans the files for filenames that match the queries."""
 
@@ -851,11 +1111,20 @@ class ProjectView(Project):
         if "../" in path:
             raise BadValue("Relative directories are not allowed")
 
-        # Load from the temp file first
-        file_loc = self.location / get_temp_file_name(self.name, path)
-        if file_loc.exists():
+        # chop off any leading slashes
+        while path and path.startswith("/"):
+            path = path[1:]
+
+        # Load from the temp file first, if there is one
+        file_loc = self.temp_directory / path
+        temp_files = _get_temp_files(self.temp_directory)
+        if path in temp_files:
             log.debug("get_temp_file path=%s" % file_loc)
-            return str(file_loc.bytes())
+            try:
+                return str(file_loc.bytes())
+            except IOError:
+                # removed by another process
+                temp_files.discard(path)
 
         # Otherwise, go for data from the real file
         file_obj = File(self, path)
@@ -867,7 +1136,7 @@ class ProjectView(Project):
         if file_loc.isdir():
             raise FileConflict("Cannot save file at %s in project "
                 "%s, because there is already a directory with that name."
-                % (destpath, self.name))
+                % (path, self.name))
 
         log.debug("New file - creating temp space")
 
@@ -876,6 +1145,7 @@ class ProjectView(Project):
             file_dir.makedirs()
 
         _save(file_loc, "")
+        temp_files.add(path)
         return ""
 
     def delete(self, path=""):
@@ -906,11 +1176,316 @@ class ProjectView(Project):
 def get_temp_file_name(project, path):
     return "." + project + "-mobwrite/" + path
 
-def _save(path, contents):
+# the paths that have mobwrite temp copies, for the temp directories
+# that have been looked at most recently by this process. Only the
+# mobwrite daemon creates temp copies, so the sets are kept up to date
+# by save_temp_file and get_temp_file. Copies removed by other processes
+# (saves of the real file and prune_temp_files) are dropped when they
+# turn out to be gone.
+_temp_files = LRUCache(1000)
+_temp_files_lock = threading.Lock()
+
+def _get_temp_files(temp_dir):
+    """Returns the set of paths that have temp copies in temp_dir,
+    listing the directory the first time it's asked for."""
+    _temp_files_lock.acquire()
+    try:
+        result = _temp_files.get(temp_dir)
+        if result is None:
+            result = set()
+            if temp_dir.isdir():
+                for f in temp_dir.walkfiles():
+                    result.add(str(temp_dir.relpathto(f)))
+            _temp_files.set(temp_dir, result)
+        return result
+    finally:
+        _temp_files_lock.release()
+
+def _forget_temp_files(temp_dir, path):
+    """Drops path (or everything under path, if it's a directory or "")
+    from the temp copies known for temp_dir."""
+    _temp_files_lock.acquire()
+    try:
+        temp_files = _temp_files.get(temp_dir)
+        if temp_files is None:
+            return
+        if not path or path.endswith("/"):
+            for name in list(temp_files):
+                if name.startswith(path):
+                    temp_files.discard(name)
+        else:
+            temp_files.discard(path)
+    finally:
+        _temp_files_lock.release()
+
+def prune_temp_files(users, max_age):
+    """Deletes the mobwrite temp copies in the given users' areas that
+    haven't been written to for max_age seconds, along with the
+    directories that leaves empty. Returns the number of files deleted."""
+    cutoff = time.time() - max_age
+    count = 0
+    for user in users:
+        for temp_dir in user.get_location().dirs(".*-mobwrite"):
+            temp_dir = temp_dir + "/"
+            for f in temp_dir.walkfiles():
+                try:
+                    if f.mtime >= cutoff:
+                        continue
+                    f.remove()
+                except OSError:
+                    continue
+                _forget_temp_files(temp_dir, str(temp_dir.relpathto(f)))
+                count += 1
+            # deepest first, so that parents are empty when we get there
+            for d in sorted(temp_dir.walkdirs(), reverse=True) + [temp_dir]:
+                try:
+                    d.rmdir()
+                except OSError:
+                    pass
+    return count
+
+# how much of an upload is read at a time
+COPY_CHUNK_SIZE = 65536
+
+# mkstemp creates files that only the owner can read, saved files get
+# the permissions that writing them directly would have given them
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def get_write_sync(mode):
+    """Returns the function that _save uses to fsync files for the write
+    mode: None for "fast" or os.fsync for "safe"."""
+    if mode == "fast":
+        return None
+    elif mode == "safe":
+        return os.fsync
+    raise ValueError("Unknown write_mode %r (use fast or safe)" % (mode,))
+
+def _write_file(path, write, atomic=False):
+    """Writes a file with the configured write mode (c.write_mode).
+    write is called with the open file and its result is returned. In
+    the "fast" mode, the file is written in place unless atomic is True.
+    Otherwise, it's written to a temporary file in the same directory,
+    which is fsynced (with c.write_sync) and renamed over path. The
+    directory is fsynced after the rename, too."""
+    sync = config.c.write_sync
+    if config.c.write_mode == "fast":
+        sync = None
+        # writing into a file that's linked from the blob store would
+        # change every copy
+        if not atomic and not _is_linked(path):
+            output = open(path, "wb")
+            try:
+                return write(output)
+            finally:
+                output.close()
+
+    fd, temp_name = tempfile.mkstemp(prefix=".bespin-write-",
+                                     dir=path.dirname())
+    try:
+        output = os.fdopen(fd, "wb")
+        try:
+            result = write(output)
+            output.flush()
+            if sync is not None:
+                sync(output.fileno())
+        finally:
+            output.close()
+        os.chmod(temp_name, 0666 & ~_UMASK)
+        os.rename(temp_name, path)
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+    _sync_directory(path.dirname(), sync)
+    return result
+
+def _sync_directory(directory, sync):
+    if sync is None:
+        return
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        sync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def _is_linked(path):
+    try:
+        return os.stat(path).st_nlink > 1
+    except OSError:
+        return False
+
+def _copy_file(source, dest, length=None, limit=None):
+    """Copies up to length bytes (or everything, if length is None) from
+    the source file object to dest in chunks. Returns the number of
+    bytes copied, or None if that would have been more than limit."""
+    copied = 0
+    while length is None or copied < length:
+        size = COPY_CHUNK_SIZE
+        if length is not None:
+            size = min(size, length - copied)
+        chunk = source.read(size)
+        if not chunk:
+            break
+        copied += len(chunk)
+        if limit is not None and copied > limit:
+            return None
+        dest.write(chunk)
+    return copied
+
+def _encode_contents(contents):
     if isinstance(contents, unicode):
-        path.write_text(contents, encoding='utf-8')
-    else:
-        path.write_bytes(contents)
+        # the newline handling that path.write_text has always done
+        for newline in (u"\r\n", u"\r\x85", u"\r", u"\x85", u"\u2028"):
+            contents = contents.replace(newline, u"\n")
+        contents = contents.replace(u"\n", os.linesep).encode("utf-8")
+    elif contents is None:
+        contents = ""
+    return contents
+
+def _save(path, contents):
+    contents = _encode_contents(contents)
+    _write_file(path, lambda output: output.write(contents))
+
+class _HashingFile(object):
+    """Wraps a file that's being written, computing the sha1 of what's
+    written to it."""
+
+    def __init__(self, fileobj):
+        self.file = fileobj
+        self.hash = sha1()
+
+    def write(self, data):
+        self.hash.update(data)
+        self.file.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+class BlobStore(object):
+    """Keeps a single copy of file contents that many projects have in
+    common (the template and plugin installs that every user gets), named
+    by their sha1, and hardlinks the copies into projects. Saves replace
+    files instead of writing into them (see _write_file), so a user's
+    edit gives them their own copy and leaves the blob alone. Where
+    hardlinks can't be made, files are copied."""
+
+    def __init__(self, directory):
+        self.directory = path_obj(directory)
+
+    def _blob_location(self, digest):
+        return self.directory / digest[:2] / digest
+
+    def _store(self, blob, write):
+        blob_dir = blob.dirname()
+        if not blob_dir.exists():
+            blob_dir.makedirs()
+        _write_file(blob, write, atomic=True)
+
+    def link(self, dest, contents):
+        """Makes dest a link to the blob with these contents (a str),
+        storing the blob first if it's new."""
+        blob = self._blob_location(sha1(contents).hexdigest())
+        write = lambda output: output.write(contents)
+        if not blob.exists():
+            self._store(blob, write)
+        error = _link_file(blob, dest)
+        if error in (errno.ENOENT, errno.EMLINK):
+            # the blob was collected in the meantime or has as many links
+            # as the filesystem allows. Links made from now on go to a
+            # new copy.
+            self._store(blob, write)
+            error = _link_file(blob, dest)
+        if error is not None:
+            _write_file(dest, write, atomic=True)
+
+    def link_from(self, dest, write):
+        """Like link, but the contents are written by calling write with
+        an open file (and hashed as they are written). Returns the
+        result of write."""
+        if not self.directory.exists():
+            self.directory.makedirs()
+        fd, temp_name = tempfile.mkstemp(prefix=".bespin-write-",
+                                         dir=self.directory)
+        try:
+            output = os.fdopen(fd, "wb")
+            try:
+                hashing = _HashingFile(output)
+                result = write(hashing)
+                output.flush()
+                if config.c.write_sync is not None:
+                    config.c.write_sync(output.fileno())
+            finally:
+                output.close()
+            os.chmod(temp_name, 0666 & ~_UMASK)
+
+            blob = self._blob_location(hashing.hexdigest())
+            if not blob.exists():
+                blob_dir = blob.dirname()
+                if not blob_dir.exists():
+                    blob_dir.makedirs()
+                os.rename(temp_name, blob)
+            error = _link_file(blob, dest)
+            if error in (errno.ENOENT, errno.EMLINK) \
+                    and os.path.exists(temp_name):
+                # as in link, our copy becomes the blob
+                os.rename(temp_name, blob)
+                error = _link_file(blob, dest)
+
+            if error is not None:
+                if os.path.exists(temp_name):
+                    source = path_obj(temp_name)
+                else:
+                    source = blob
+                def copy(output):
+                    source_file = source.open("rb")
+                    try:
+                        _copy_file(source_file, output)
+                    finally:
+                        source_file.close()
+                _write_file(dest, copy, atomic=True)
+        finally:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+        return result
+
+    def collect(self, min_age=3600):
+        """Removes the blobs that are no longer linked from any project
+        (and temporary files left behind by crashes), leaving ones younger
+        than min_age seconds, which may be about to be linked. Returns the
+        number removed."""
+        if not self.directory.exists():
+            return 0
+        cutoff = time.time() - min_age
+        count = 0
+        for f in self.directory.walkfiles():
+            try:
+                stat = f.stat()
+                if stat.st_nlink > 1 or stat.st_mtime >= cutoff:
+                    continue
+                f.remove()
+            except OSError:
+                continue
+            count += 1
+        return count
+
+def _link_file(source, dest):
+    """Hardlinks source to dest, replacing dest if it exists. Returns
+    None if that worked and the errno if it didn't."""
+    temp_name = "%s.bespin-write-%s" % (dest.dirname() / "",
+                                        os.urandom(6).encode("hex"))
+    try:
+        os.link(source, temp_name)
+    except OSError, e:
+        return e.errno
+    try:
+        os.rename(temp_name, dest)
+    except:
+        os.remove(temp_name)
+        raise
+    _sync_directory(dest.dirname(), config.c.write_sync)
+    return None
 
 class ProjectMetadata(dict):
     """Provides access to Bespin-specific project information.
@@ -948,6 +1523,20 @@ class ProjectMetadata(dict):
 )''')
             conn.commit()
             c.close()
+
+        # metadata files created before sizes were recorded need these
+        # tables added. Project._recorded_sizes fills them in with a scan.
+        c = conn.cursor()
+        c.execute('''create table if not exists file_size (
+    filename text primary key,
+    size integer
+)''')
+        c.execute('''create table if not exists dir_size (
+    dirname text primary key,
+    size integer
+)''')
+        conn.commit()
+        c.close()
         return conn
 
     def delete(self):
@@ -1036,6 +1625,108 @@ class ProjectMetadata(dict):
         c.close()
         return result
 
+    ######
+    #
+    # Methods for the recorded file sizes. dir_size keeps a running
+    # total for each directory ("a/", "a/b/") and for the whole
+    # project (""), so that quota accounting doesn't need to walk
+    # the tree.
+    #
+    ######
+
+    def sizes_recorded(self):
+        """True if the file sizes have been recorded for this project."""
+        c = self.connection.cursor()
+        c.execute("select 1 from dir_size where dirname=''")
+        result = c.fetchone() is not None
+        c.close()
+        return result
+
+    def get_space_used(self, path=""):
+        """Returns the recorded number of bytes used by the files under
+        path, which is a directory name ending in / (or "" for the
+        whole project)."""
+        c = self.connection.cursor()
+        c.execute("select size from dir_size where dirname=?", (path,))
+        row = c.fetchone()
+        c.close()
+        if row is None:
+            return 0
+        return row[0]
+
+    def record_size(self, filename, size):
+        """Records the size of the file, updating the totals for the
+        directories above it. Returns the change in size."""
+        conn = self.connection
+        c = conn.cursor()
+        c.execute("select size from file_size where filename=?", (filename,))
+        row = c.fetchone()
+        if row is None:
+            delta = size
+            c.execute("insert into file_size (filename, size) values (?, ?)",
+                        (filename, size))
+        else:
+            delta = size - row[0]
+            c.execute("update file_size set size=? where filename=?",
+                        (size, filename))
+        if delta:
+            _add_to_dirs(c, _parent_dirs(filename), delta)
+        conn.commit()
+        c.close()
+        return delta
+
+    def forget_size(self, filename, recursive=False):
+        """Removes the size of the file from the recorded sizes. If
+        recursive is True, filename is a directory and everything under
+        it is removed. Returns the number of bytes that were removed."""
+        conn = self.connection
+        c = conn.cursor()
+        if recursive:
+            if filename and not filename.endswith("/"):
+                filename += "/"
+            c.execute("select size from dir_size where dirname=?",
+                        (filename,))
+            row = c.fetchone()
+            # substr rather than LIKE, so that _ and % in names
+            # are not treated as wildcards
+            c.execute("delete from file_size where substr(filename, 1, ?)=?",
+                        (len(filename), filename))
+            c.execute("delete from dir_size where substr(dirname, 1, ?)=?",
+                        (len(filename), filename))
+            if not filename:
+                c.execute("insert into dir_size (dirname, size) values ('', 0)")
+        else:
+            c.execute("select size from file_size where filename=?",
+                        (filename,))
+            row = c.fetchone()
+            c.execute("delete from file_size where filename=?", (filename,))
+        size = 0
+        if row is not None:
+            size = row[0]
+        if size and filename:
+            _add_to_dirs(c, _parent_dirs(filename), -size)
+        conn.commit()
+        c.close()
+        return size
+
+    def sizes_replace(self, sizes):
+        """Replace all of the recorded sizes with the ones in the sizes
+        dictionary (filename -> size)."""
+        totals = {"": 0}
+        for filename, size in sizes.items():
+            for dirname in _parent_dirs(filename):
+                totals[dirname] = totals.get(dirname, 0) + size
+        conn = self.connection
+        c = conn.cursor()
+        c.execute("delete from file_size")
+        c.execute("delete from dir_size")
+        c.executemany("insert into file_size (filename, size) values (?, ?)",
+                        sizes.items())
+        c.executemany("insert into dir_size (dirname, size) values (?, ?)",
+                        totals.items())
+        conn.commit()
+        c.close()
+
     ######
     #
     # Dictionary methods for the key/value store
@@ -35,16 +35,22 @@
 # ***** END LICENSE BLOCK *****
 # 
 
-from urlrelay import url
+import time
+from urlrelay import url, URLRelay
 from webob import Request, Response
+from sqlalchemy.exc import DBAPIError
 import logging
 
-from bespin import filesystem, database, config, plugins
+from bespin import filesystem, database, config, plugins, stats
 from bespin.__init__ import API_VERSION
 from bespin.database import User
 
 log = logging.getLogger("bespin.framework")
 
+# names of all of the functions that have been exposed, used for
+# reporting per-route stats
+routes = []
+
 class BadRequest(Exception):
     pass
 
@@ -85,19 +91,179 @@ class BespinResponse(Response):
     def error(self, status, e):
         self.status = status
         self.body = str(e)
+        self.conditional_response = False
+        _add_base_headers(self)
         self.environ['bespin.docommit'] = False
 
-def _add_base_headers(response):
+_regex_special = set(".^$*+?{}[]\\|()")
+
+_inline_flags = set("iLmsux")
+
+def _has_alternatives_or_flags(pattern):
+    """Returns True if the pattern has a | outside of any group, so
+    that it's really several patterns, or an inline flag group like
+    (?i) that changes how the rest of it matches."""
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_class:
+            if char == "]":
+                in_class = False
+        elif char == "[":
+            in_class = True
+            # a ] straight after the [ (or [^) is part of the class
+            if pattern[i+1:i+2] == "^":
+                i += 1
+            if pattern[i+1:i+2] == "]":
+                i += 1
+        elif char == "(":
+            if pattern[i+1:i+2] == "?" and pattern[i+2:i+3] in _inline_flags:
+                return True
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+        i += 1
+    return False
+
+def _literal_prefix(pattern):
+    """Returns the literal text that any path matched by the regular
+    expression pattern must start with. This is empty if the pattern
+    is not anchored at the start, has alternatives at the top level or
+    uses inline flags."""
+    if not pattern.startswith("^") or _has_alternatives_or_flags(pattern):
+        return ""
+    prefix = []
+    for char in pattern[1:]:
+        if char in _regex_special:
+            break
+        prefix.append(char)
+    prefix = "".join(prefix)
+    # a trailing character followed by a quantifier is optional
+    if len(prefix) + 1 < len(pattern) and pattern[len(prefix) + 1] in "*?{":
+        prefix = prefix[:-1]
+    return prefix
+
+def _first_segment(path):
+    """Returns the first segment of the path including the slashes
+    around it (/file/ for /file/at/foo), or None if the path doesn't
+    have a complete first segment."""
+    end = path.find("/", 1)
+    if not path.startswith("/") or end == -1:
+        return None
+    return path[:end+1]
+
+class IndexedURLRelay(URLRelay):
+    """A URLRelay that avoids trying every pattern on every request.
+    The patterns are grouped by the first segment of their literal
+    prefix (/file/, /plugin/, /share/...) and by HTTP method, so only
+    the patterns that could match are tried, and the literal prefix
+    is checked before running the regular expression. Patterns are
+    still tried in the order they were registered, so this dispatches
+    exactly as URLRelay does."""
+    
+    def __init__(self, **kw):
+        super(IndexedURLRelay, self).__init__(**kw)
+        # entries are (order, prefix, compiled pattern, app or method dict)
+        self._segments = {}
+        self._unindexed = []
+        for order, (pattern, app) in enumerate(self._paths):
+            prefix = _literal_prefix(pattern.pattern)
+            entry = (order, prefix, pattern, app)
+            segment = _first_segment(prefix)
+            if segment is None:
+                self._unindexed.append(entry)
+            else:
+                self._segments.setdefault(segment, []).append(entry)
+        for segment, entries in self._segments.items():
+            entries.extend(self._unindexed)
+            entries.sort()
+        self._methods = set()
+        for pattern, app in self._paths:
+            if isinstance(app, dict):
+                self._methods.update(app.keys())
+        # candidate lists for each (segment, method) pair, built lazily
+        self._by_method = {}
+    
+    def _candidates(self, path, method):
+        segment = _first_segment(path)
+        if segment not in self._segments:
+            segment = None
+        if method not in self._methods:
+            method = None
+        key = (segment, method)
+        candidates = self._by_method.get(key)
+        if candidates is None:
+            if segment is None:
+                entries = self._unindexed
+            else:
+                entries = self._segments[segment]
+            candidates = []
+            for order, prefix, pattern, app in entries:
+                if isinstance(app, dict):
+                    app = app.get(method)
+                    if app is None:
+                        continue
+                candidates.append((prefix, pattern, app))
+            self._by_method[key] = candidates
+        return candidates
+    
+    def resolve(self, path, method):
+        for prefix, pattern, app in self._candidates(path, method):
+            if not path.startswith(prefix):
+                continue
+            search = pattern.search(path)
+            if not search:
+                continue
+            app = self._loadapp(app)
+            kw = search.groupdict()
+            args = tuple(i for i in search.groups() if i not in kw)
+            return app, args, kw
+        if self._default is not None:
+            default = self._loadapp(self._default)
+            return default, (), {}
+        raise ImportError()
+
+# the Cache-Control header for responses that must never be reused. This
+# is the default for exposed functions; see expose's cache_control.
+NO_CACHE = "no-store, no-cache, must-revalidate, post-check=0, pre-check=0, private"
+
+def _add_base_headers(response, cache_control=NO_CACHE):
     response.headers['X-Bespin-API'] = API_VERSION
-    response.headers['Cache-Control'] = "no-store, no-cache, must-revalidate, post-check=0, pre-check=0, private"
-    response.headers['Pragma'] = "no-cache"
+    response.headers['Cache-Control'] = cache_control
+    if "no-store" in cache_control:
+        response.headers['Pragma'] = "no-cache"
+
+def _record_route_stats(name, start, queries_start, response):
+    """Records the latency, response size and number of database
+    queries for a request to the route called name."""
+    elapsed = (time.time() - start) * 1000
+    c = config.c
+    c.stats.timing("timing_%s_DATE" % name, elapsed)
+    c.stats.incr("bytes_%s_DATE" % name, response.content_length or 0)
+    c.stats.incr("queries_%s_DATE" % name,
+                 stats.query_counter.count - queries_start)
 
-def expose(url_pattern, method=None, auth=True, skip_token_check=False, profile=False):
+def expose(url_pattern, method=None, auth=True, skip_token_check=False, profile=False,
+           read_only=False, cache_control=NO_CACHE):
     """Expose this function to the world, matching the given URL pattern
     and, optionally, HTTP method. By default, the user is required to
     be authenticated. If auth is False, the user is not required to be
-    authenticated."""
+    authenticated. Functions that only read from the database can say
+    read_only=True, so that they are run against a replica when there
+    is one (see database.use_replica). cache_control is sent as the
+    Cache-Control header of successful responses."""
     def entangle(func):
+        route_name = func.__name__
+        if route_name not in routes:
+            routes.append(route_name)
+        
         @url(url_pattern, method)
         def wrapped(environ, start_response):
 
@@ -129,10 +295,28 @@ def expose(url_pattern, method=None, auth=True, skip_token_check=False, profile=
                         # log.info("WARNING: The anti CSRF attack trip wire just went off. This means an unprotected request has been made. This could be a hacking attempt, or incomplete protection. The request has NOT been halted")
                         config.c.stats.incr("csrf_fail_DATE")
 
-                # Do we need to do this?
-                user = request.user
-                _add_base_headers(response)
+                start = time.time()
+                queries_start = stats.query_counter.count
                 try:
+                    if read_only and database.use_replica():
+                        try:
+                            try:
+                                user = request.user
+                                _add_base_headers(response, cache_control)
+                                reply.append(func(request, response))
+                                return
+                            except DBAPIError, e:
+                                log.warning("Replica failed for %s, "
+                                    "retrying on the primary: %s",
+                                    route_name, e)
+                        finally:
+                            database.use_primary()
+                        request = BespinRequest(environ)
+                        response = BespinResponse(environ, start_response)
+
+                    # Do we need to do this?
+                    user = request.user
+                    _add_base_headers(response, cache_control)
                     reply.append(func(request, response))
                     return
                 except filesystem.NotAuthorized, e:
@@ -154,6 +338,9 @@ def expose(url_pattern, method=None, auth=True, skip_token_check=False, profile=
                     response.error("400 Bad Request", e)
                 except BadRequest, e:
                     response.error("400 Bad Request", e)
+                finally:
+                    _record_route_stats(route_name, start, queries_start,
+                                        response)
                 reply.append(response())
                 return
 
@@ -163,13 +350,16 @@ def expose(url_pattern, method=None, auth=True, skip_token_check=False, profile=
                 prof = cProfile.Profile()
                 prof = prof.runctx("action()", globals(), locals())
                 stream = StringIO.StringIO()
-                stats = pstats.Stats(prof, stream=stream)
-                stats.sort_stats("time")  # Or cumulative
-                stats.print_stats(80)  # 80 = how many to print
+                profile_stats = pstats.Stats(prof, stream=stream)
+                profile_stats.sort_stats("time")  # Or cumulative
+                profile_stats.print_stats(80)  # 80 = how many to print
                 # The rest is optional.
-                stats.print_callees()
-                stats.print_callers()
+                profile_stats.print_callees()
+                profile_stats.print_callers()
                 log.info("Profile data:\n%s", stream.getvalue())
+            elif config.c.profiler and \
+                config.c.profiler.should_sample(route_name):
+                config.c.profiler.runcall(route_name, action)
             else:
                 action()
 
@@ -582,6 +582,15 @@ class Template(object):
     """
     self._program = CompileTemplate(
         template_str, builder=builder, **compile_options)
+    # A template without any substitutions or sections always expands to the
+    # same thing.
+    statements = self._program.Statements()
+    for statement in statements:
+      if not isinstance(statement, basestring):
+        self._constant = None
+        break
+    else:
+      self._constant = ''.join(statements)
 
   #
   # Public API
@@ -624,6 +633,9 @@ class Template(object):
     else:
       data_dict = kwargs
 
+    if self._constant is not None:
+      return self._constant
+
     tokens = []
     self.render(data_dict, tokens.append)
     return ''.join(tokens)
@@ -735,17 +747,20 @@ def _Execute(statements, context, callback):
   This is called in a mutually recursive fashion.
   """
 
-  for i, statement in enumerate(statements):
+  for statement in statements:
     if isinstance(statement, basestring):
       callback(statement)
     else:
       # In the case of a substitution, args is a pair (name, formatter).
       # In the case of a section, it's a _Section instance.
+      func, args = statement
       try:
-        func, args = statement
         func(args, context, callback)
       except UndefinedVariable, e:
         # Show context for statements
+        for i, s in enumerate(statements):
+          if s is statement:
+            break
         start = max(0, i-3)
         end = i+3
         e.near = statements[start:end]
@@ -35,7 +35,8 @@
 # ***** END LICENSE BLOCK *****
 #
 
-from bespin.database import User, get_project
+from bespin.database import User, get_project, _get_session
+from bespin.filesystem import prune_temp_files
 import logging
 
 log = logging.getLogger("mobwrite.integrate")
@@ -88,6 +89,15 @@ class Persister:
         except:
             log.exception("Error in Persister.save() for name=%s", name)
 
+    def prune(self, max_age):
+        """Delete the temporary files that haven't been saved to for
+        max_age seconds by calling filesystem.prune_temp_files"""
+        try:
+            count = prune_temp_files(_get_session().query(User), max_age)
+            log.info("Pruned %s stale temp files" % count)
+        except:
+            log.exception("Error in Persister.prune()")
+
     def check_access(self, name, handle):
         """Check to see what level of access user has over an owner's project.
         Returns one of: Access.Denied, Access.ReadOnly or Access.ReadWrite
@@ -98,9 +108,10 @@ class Persister:
             if user == owner:
                 return Access.ReadWrite
             if user != owner:
-                if owner.is_project_shared(project_name, user, require_write=True):
+                access = owner.get_project_access(project_name, user)
+                if access == "write":
                     return Access.ReadWrite
-                if owner.is_project_shared(project_name, user, require_write=False):
+                if access == "read":
                     return Access.ReadOnly
                 else:
                     return Access.Denied
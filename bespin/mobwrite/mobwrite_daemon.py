@@ -74,6 +74,10 @@ lock_texts = thread.allocate_lock()
 # server crashes and restarts at the expense of server-load
 PARANOID_SAVE = True
 
+# How often (in seconds) the cleanup task removes stale temp files in
+# PERSISTER mode.
+PRUNE_INTERVAL = 60 * 60
+
 class TextObj(mobwrite_core.TextObj):
   # A persistent object which stores a text.
 
@@ -825,6 +829,7 @@ def debugServer():
 
 # Left at double initial indent to help diff
 def cleanup():
+    global last_prune
     mobwrite_core.LOG.info("Running cleanup task.")
     for view in views.values():
       view.cleanup()
@@ -866,7 +871,16 @@ def cleanup():
           del lasttime_db[k]
         mobwrite_core.LOG.info("Deleted from DB: '%s'" % k)
 
+    if STORAGE_MODE == PERSISTER:
+      # Delete temp files that have outlived their texts.
+      now = time.time()
+      if now > last_prune + PRUNE_INTERVAL:
+        last_prune = now
+        Persister().prune(mobwrite_core.TIMEOUT_TEXT.days * 24 * 60 * 60 +
+                          mobwrite_core.TIMEOUT_TEXT.seconds)
+
 last_cleanup = time.time()
+last_prune = 0
 
 def maybe_cleanup():
   if PARANOID_SAVE:
@@ -0,0 +1,185 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+"""Wake up long polls for messages.
+
+A request waiting on /messages/ listens for its user's id. When a
+session that added Message rows commits, MessageExtension hands the
+users' ids to the notifier, which wakes their listeners.
+
+MemoryNotifier only reaches listeners in the same process. RedisNotifier
+publishes the ids on a redis channel, and every process runs a thread
+subscribed to that channel, so messages posted by queue workers wake
+polls in the web servers too.
+"""
+
+import time
+import logging
+import threading
+
+from sqlalchemy.orm.interfaces import SessionExtension
+
+from bespin.redis import Redis, RedisError
+
+log = logging.getLogger("bespin.notify")
+
+class _Listener(object):
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.event = threading.Event()
+    
+    def wait(self, timeout):
+        """Returns True if a message arrived within timeout seconds."""
+        self.event.wait(timeout)
+        return self.event.isSet()
+
+class MemoryNotifier(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.listeners = {}
+    
+    def listen(self, user_id):
+        """Starts listening for messages for user_id. Listen before
+        looking for messages, so that none can slip in between."""
+        listener = _Listener(user_id)
+        self.lock.acquire()
+        try:
+            self.listeners.setdefault(user_id, []).append(listener)
+        finally:
+            self.lock.release()
+        return listener
+    
+    def unlisten(self, listener):
+        self.lock.acquire()
+        try:
+            listeners = self.listeners.get(listener.user_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self.listeners.pop(listener.user_id, None)
+        finally:
+            self.lock.release()
+    
+    def notify(self, user_ids):
+        for user_id in user_ids:
+            self._wake(user_id)
+    
+    def _wake(self, user_id):
+        self.lock.acquire()
+        try:
+            for listener in self.listeners.get(user_id, []):
+                listener.event.set()
+        finally:
+            self.lock.release()
+
+class RedisNotifier(MemoryNotifier):
+    def __init__(self, host, port, channel="bespin_messages",
+                 retry_delay=5):
+        super(RedisNotifier, self).__init__()
+        self.host = host
+        self.port = port
+        self.channel = channel
+        self.retry_delay = retry_delay
+        self.redis = Redis(host, port)
+        self.redis_lock = threading.Lock()
+        self.subscriber = None
+    
+    def listen(self, user_id):
+        if self.subscriber is None:
+            self._start_subscriber()
+        return super(RedisNotifier, self).listen(user_id)
+    
+    def notify(self, user_ids):
+        self.redis_lock.acquire()
+        try:
+            self.redis.pipeline(*[("PUBLISH", self.channel, user_id)
+                                  for user_id in user_ids])
+        except RedisError, e:
+            # the local listeners can still be told
+            log.error("Unable to publish message notifications: %s", e)
+            super(RedisNotifier, self).notify(user_ids)
+        finally:
+            self.redis_lock.release()
+    
+    def _start_subscriber(self):
+        self.lock.acquire()
+        try:
+            if self.subscriber is not None:
+                return
+            self.subscriber = threading.Thread(target=self._subscribe,
+                                               name="message-notifier")
+            self.subscriber.setDaemon(True)
+            self.subscriber.start()
+        finally:
+            self.lock.release()
+    
+    def _subscribe(self):
+        while True:
+            connection = Redis(self.host, self.port)
+            try:
+                connection.subscribe(self.channel)
+                for channel, user_id in connection.listen():
+                    self._wake(int(user_id))
+            except (RedisError, ValueError), e:
+                # polls just time out until redis is back
+                log.error("Lost message notification subscription: %s", e)
+            connection.disconnect()
+            time.sleep(self.retry_delay)
+
+class MessageExtension(SessionExtension):
+    """Notifies the users that were sent messages once the session
+    commits, so that the messages are there for them to read."""
+    def __init__(self, notifier):
+        self.notifier = notifier
+    
+    def after_flush(self, session, flush_context):
+        from bespin.database import Message
+        user_ids = set(obj.user_id for obj in session.new
+                       if isinstance(obj, Message))
+        if user_ids:
+            pending = getattr(session, "bespin_message_users", None)
+            if pending is None:
+                pending = session.bespin_message_users = set()
+            pending.update(user_ids)
+    
+    def after_commit(self, session):
+        user_ids = getattr(session, "bespin_message_users", None)
+        session.bespin_message_users = None
+        if user_ids:
+            self.notifier.notify(user_ids)
+    
+    def after_rollback(self, session):
+        session.bespin_message_users = None
@@ -0,0 +1,266 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+"""Password hashing.
+
+Passwords are stored as "algorithm$..." strings so that the way they
+are hashed can change over time. Hashes that predate this (a bare
+sha256 of pw_secret + password) are still accepted, and any hash that
+isn't in the current format is replaced the next time its user logs in.
+
+Hashing is deliberately slow, so it runs on a small pool of threads
+with a bounded queue. When the queue is full, PasswordHashBusy is raised
+rather than tying up another web worker.
+"""
+
+import os
+import hmac
+import time
+import Queue
+import atexit
+import hashlib
+import binascii
+import threading
+from hashlib import sha256
+
+from bespin.cache import LRUCache
+
+class PasswordHashBusy(Exception):
+    pass
+
+def _pbkdf2_sha256(password, salt, iterations):
+    if hasattr(hashlib, "pbkdf2_hmac"):
+        return hashlib.pbkdf2_hmac("sha256", password, salt, iterations)
+    # older Pythons: a SHA-256 sized key only needs the first block
+    mac = hmac.new(password, None, sha256)
+    def prf(data):
+        block_mac = mac.copy()
+        block_mac.update(data)
+        return block_mac.digest()
+    block = prf(salt + "\x00\x00\x00\x01")
+    result = int(binascii.hexlify(block), 16)
+    for i in xrange(iterations - 1):
+        block = prf(block)
+        result ^= int(binascii.hexlify(block), 16)
+    return binascii.unhexlify("%064x" % result)
+
+def _constant_time_equals(a, b):
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def _to_bytes(password):
+    if isinstance(password, unicode):
+        return password.encode("utf-8")
+    return password
+
+class SHA256Hasher(object):
+    """The original unsalted scheme: sha256(secret + password)."""
+    algorithm = "sha256"
+    
+    def __init__(self, secret):
+        self.secret = secret
+    
+    def encode(self, password):
+        return sha256(self.secret + _to_bytes(password)).hexdigest()
+    
+    def verify(self, password, encoded):
+        return _constant_time_equals(self.encode(password), encoded)
+    
+    def needs_update(self, encoded):
+        return False
+
+class PBKDF2Hasher(object):
+    """Salted PBKDF2-SHA256, stored as
+    pbkdf2_sha256$iterations$salt$hash."""
+    algorithm = "pbkdf2_sha256"
+    
+    def __init__(self, secret, iterations):
+        self.secret = secret
+        self.iterations = iterations
+    
+    def encode(self, password, salt=None, iterations=None):
+        if salt is None:
+            salt = binascii.hexlify(os.urandom(8))
+        if iterations is None:
+            iterations = self.iterations
+        digest = _pbkdf2_sha256(self.secret + _to_bytes(password), salt,
+                                iterations)
+        return "%s$%d$%s$%s" % (self.algorithm, iterations, salt,
+                                binascii.hexlify(digest))
+    
+    def verify(self, password, encoded):
+        algorithm, iterations, salt, digest = encoded.split("$", 3)
+        return _constant_time_equals(
+            self.encode(password, salt, int(iterations)), encoded)
+    
+    def needs_update(self, encoded):
+        algorithm, iterations, rest = encoded.split("$", 2)
+        return int(iterations) != self.iterations
+
+class _HashPool(object):
+    """A fixed number of threads running hash computations, with at
+    most max_waiting jobs queued up for them."""
+    def __init__(self, threads, max_waiting):
+        self.threads = threads
+        self.jobs = Queue.Queue(max_waiting)
+        self.lock = threading.Lock()
+        self.workers = []
+    
+    def run(self, func, *args):
+        if not self.threads:
+            return func(*args)
+        self._start()
+        job = [func, args, threading.Event(), None, None]
+        try:
+            self.jobs.put_nowait(job)
+        except Queue.Full:
+            raise PasswordHashBusy("Too many logins in progress")
+        job[2].wait()
+        if job[4] is not None:
+            raise job[4]
+        return job[3]
+    
+    def _start(self):
+        if self.workers:
+            return
+        self.lock.acquire()
+        try:
+            if self.workers:
+                return
+            for i in range(self.threads):
+                worker = threading.Thread(target=self._work,
+                                          name="password-hash")
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+            atexit.register(self._stop)
+        finally:
+            self.lock.release()
+    
+    def _stop(self):
+        # let the workers exit before the interpreter shuts down under them
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+    
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            try:
+                job[3] = job[0](*job[1])
+            except Exception, e:
+                job[4] = e
+            job[2].set()
+
+class PasswordManager(object):
+    """Hashes new passwords with the current hasher and verifies
+    stored ones with whichever hasher created them.
+    
+    Successful verifications are remembered (as a keyed digest of the
+    stored hash and password, never the password itself) for cache_ttl
+    seconds, so users who log in repeatedly only pay for the hash once.
+    """
+    def __init__(self, hasher, legacy_hashers=(), threads=2, max_waiting=20,
+                 cache_size=1000, cache_ttl=300):
+        self.hasher = hasher
+        self.hashers = {}
+        for other in legacy_hashers:
+            self.hashers[other.algorithm] = other
+        self.hashers[hasher.algorithm] = hasher
+        self.pool = _HashPool(threads, max_waiting)
+        if cache_ttl:
+            self.cache = LRUCache(cache_size, cache_ttl)
+        else:
+            self.cache = None
+        self.cache_key = os.urandom(16)
+    
+    def encode(self, password):
+        return self.pool.run(self.hasher.encode, password)
+    
+    def verify(self, username, password, encoded):
+        """Checks password against the encoded hash stored for
+        username. Returns a (valid, new_encoded) pair, where new_encoded
+        is a replacement hash in the current format, or None if the
+        stored one is fine."""
+        cache_digest = None
+        if self.cache is not None:
+            cache_digest = hmac.new(self.cache_key,
+                encoded + "\x00" + _to_bytes(password), sha256).digest()
+            if self.cache.get(username) == cache_digest:
+                return True, None
+        
+        hasher = self._get_hasher(encoded)
+        if hasher is None or not self.pool.run(hasher.verify, password,
+                                               encoded):
+            return False, None
+        
+        new_encoded = None
+        if hasher is not self.hasher or hasher.needs_update(encoded):
+            new_encoded = self.encode(password)
+            if self.cache is not None:
+                cache_digest = hmac.new(self.cache_key,
+                    new_encoded + "\x00" + _to_bytes(password),
+                    sha256).digest()
+        if self.cache is not None:
+            self.cache.set(username, cache_digest)
+        return True, new_encoded
+    
+    def _get_hasher(self, encoded):
+        if "$" in encoded:
+            return self.hashers.get(encoded.split("$", 1)[0])
+        # a bare hex digest from before hashes were tagged
+        return self.hashers.get(SHA256Hasher.algorithm)
+
+def get_hasher(name, secret, iterations):
+    if name == "pbkdf2":
+        return PBKDF2Hasher(secret, iterations)
+    elif name == "sha256":
+        return SHA256Hasher(secret)
+    raise ValueError("Unknown password hash: %s" % name)
+
+def time_hasher(hasher, rounds=5):
+    """Returns the average time in seconds to hash a password."""
+    start = time.time()
+    for i in range(rounds):
+        hasher.encode("benchmark password")
+    return (time.time() - start) / rounds
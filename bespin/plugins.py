@@ -40,6 +40,9 @@ from urlparse import urlparse
 import time
 import zipfile
 import logging
+import gzip
+from cStringIO import StringIO
+from hashlib import md5
 
 import simplejson
 
@@ -50,6 +53,7 @@ from dryice.plugins import (Plugin as BasePlugin,
 
 from bespin import config
 from bespin import VERSION
+from bespin.cache import LRUCache
 from bespin.database import GalleryPlugin
 from bespin.filesystem import NotAuthorized, get_project, FileNotFound
 
@@ -59,30 +63,22 @@ log = logging.getLogger("bespin.plugins")
 
 def get_user_plugin_info(user):
     if not user:
-        return None, None
-    
-    project = get_project(user, user, "BespinSettings", create=True)
-    
-    pluginInfo = None
-    try:
-        pluginInfo_content = project.get_file("pluginInfo.json")
-        pluginInfo = simplejson.loads(pluginInfo_content)
-    except FileNotFound:
-        pass
-    except ValueError:
-        pass
-    
-    return pluginInfo, project
+        return None
+    return user.get_plugin_info()
 
 def get_user_plugin_path(user, include_installed=True, plugin_info=None, project=None):
     if not user:
         return []
 
     if plugin_info is None:
-        plugin_info, project = get_user_plugin_info(user)
+        plugin_info = get_user_plugin_info(user)
     
+    # the installed plugins are only listed, so there's no need to look
+    # up (or create) the BespinSettings project on every request
     if project is None:
-        project = get_project(user, user, "BespinSettings", create=True)
+        settings_location = user.get_location() / "BespinSettings"
+    else:
+        settings_location = project.location
     
     path = []
     if plugin_info:
@@ -98,7 +94,7 @@ def get_user_plugin_path(user, include_installed=True, plugin_info=None, project
             path.extend(dict(name="user", path=root / leading_slash.sub("", p), chop=root_len) for p in pi_path)
     
     if include_installed:
-        path.append(dict(name="user", path=project.location / "plugins", 
+        path.append(dict(name="user", path=settings_location / "plugins", 
             chop=len(user.get_location())))
     return path
 
@@ -106,7 +102,69 @@ def get_user_plugin_path(user, include_installed=True, plugin_info=None, project
 class PluginError(Exception):
     pass
 
+def script_wrapper(plugin_name, script_path):
+    """Returns the text that goes before and after a script to make it
+    a module for the loader."""
+    if script_path:
+        module_name = os.path.splitext(script_path)[0]
+    else:
+        module_name = "index"
+    loader_name = config.c.loader_name
+    head = "; %s.module('%s:%s', function(require, exports, module) {" % (
+        loader_name, plugin_name, module_name)
+    tail = "\n;}); %s.script('%s:%s');" % (loader_name, plugin_name,
+                                            script_path)
+    return head, tail
+
+def wrap_script(plugin_name, script_path, script_text):
+    head, tail = script_wrapper(plugin_name, script_path)
+    return head + script_text + tail
+
+def _gzip(data):
+    buffer = StringIO()
+    gzfile = gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0)
+    gzfile.write(data)
+    gzfile.close()
+    return buffer.getvalue()
+
+# bundles of a plugin's wrapped scripts (see Plugin.get_bundle), keyed
+# by the plugin's location
+_bundles = LRUCache(200)
+
 class Plugin(BasePlugin):
+    def _script_location(self, scriptname):
+        if scriptname:
+            return self.location / scriptname
+        # single file plugins are their own script
+        return self.location
+
+    @property
+    def bundle_stamp(self):
+        """A short string that changes whenever one of the plugin's
+        scripts is changed, added or removed."""
+        stamp = md5()
+        for scriptname in sorted(self.scripts):
+            stat = self._script_location(scriptname).stat()
+            stamp.update("%s %s %s\n" % (scriptname, stat.st_mtime,
+                                          stat.st_size))
+        return stamp.hexdigest()[:12]
+
+    def get_bundle(self):
+        """Returns (stamp, script, gzipped script) where script is all of
+        the plugin's scripts wrapped as modules. Bundles are built once
+        and kept until the stamp changes."""
+        stamp = self.bundle_stamp
+        key = str(self.location)
+        bundle = _bundles.get(key)
+        if bundle is not None and bundle[0] == stamp:
+            return bundle
+        script = "\n".join(wrap_script(self.name, scriptname,
+                                        self.get_script_text(scriptname))
+                           for scriptname in sorted(self.scripts))
+        bundle = (stamp, script, _gzip(script))
+        _bundles.set(key, bundle)
+        return bundle
+
     def load_metadata(self):
         md = super(Plugin, self).load_metadata()
         
@@ -178,6 +236,11 @@ class Plugin(BasePlugin):
         
         md['reloadURL'] = "%splugin/reload/%s" % (
             server_base_url, name)
+
+        if self.scripts:
+            md['bundleURL'] = "%splugin/bundle/%s/%s/%s.js" % (
+                server_base_url, self.location_name, name,
+                self.bundle_stamp)
         
         return md
 
@@ -440,7 +503,7 @@ def _perform_installation(user, plugin):
         if destination.exists():
             destination.rmtree()
         project.import_zipfile(location.basename(), location.open(), 
-                "plugins/" + plugin.name + "/")
+                "plugins/" + plugin.name + "/", shared=True)
     else:
         destination = project.location / "plugins" / (plugin.name + ".js")
         if destination.exists():
@@ -0,0 +1,175 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+"""Sampling profiler for exposed functions.
+
+Rather than profiling every request, the SamplingProfiler profiles one
+out of every sample_rate requests for each route and adds the results
+to in-memory pstats that can be dumped while the server is running.
+"""
+
+import copy
+import time
+import marshal
+import threading
+import logging
+import cProfile
+import pstats
+import StringIO
+
+log = logging.getLogger("bespin.profiler")
+
+class SamplingProfiler(object):
+    def __init__(self, sample_rate, slow_threshold=0):
+        """sample_rate: profile one in this many requests for each route.
+        slow_threshold: if set (in milliseconds), sampled requests that
+        finish faster than this are thrown away."""
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.counters = {}
+        self.stats = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+    
+    def should_sample(self, route):
+        """Returns True if the current request for route should be
+        profiled."""
+        self.lock.acquire()
+        try:
+            count = self.counters.get(route, 0) + 1
+            self.counters[route] = count
+        finally:
+            self.lock.release()
+        return count % self.sample_rate == 0
+    
+    def runcall(self, route, func, *args, **kw):
+        """Runs func under the profiler and adds the results to the
+        stats for route."""
+        prof = cProfile.Profile()
+        start = time.time()
+        try:
+            return prof.runcall(func, *args, **kw)
+        finally:
+            elapsed = (time.time() - start) * 1000
+            if elapsed >= self.slow_threshold:
+                self._add(route, prof)
+    
+    def _add(self, route, prof):
+        self.lock.acquire()
+        try:
+            try:
+                existing = self.stats.get(route)
+                if existing is None:
+                    self.stats[route] = pstats.Stats(prof)
+                else:
+                    existing.add(prof)
+                self.samples[route] = self.samples.get(route, 0) + 1
+            except TypeError:
+                # pstats raises TypeError if nothing was recorded
+                log.debug("No profile data recorded for %s", route)
+        finally:
+            self.lock.release()
+    
+    @property
+    def routes(self):
+        """Returns a dictionary of the profiled routes and the number
+        of samples for each."""
+        self.lock.acquire()
+        try:
+            return dict(self.samples)
+        finally:
+            self.lock.release()
+    
+    def _combined(self, route=None):
+        """Returns a new Stats object for route, or for all routes
+        if route is None. Returns None if there is no data."""
+        if route is None:
+            collected = self.stats.values()
+        else:
+            collected = [self.stats[route]] if route in self.stats else []
+        if not collected:
+            return None
+        # copy the first set of stats so that adding the others
+        # doesn't change the stored data
+        first = collected[0]
+        result = copy.copy(first)
+        result.stats = dict(first.stats)
+        result.files = list(first.files)
+        result.top_level = dict(first.top_level)
+        result.all_callees = None
+        result.fcn_list = 0
+        for item in collected[1:]:
+            result.add(item)
+        return result
+    
+    def dump_text(self, route=None, sort="cumulative", limit=80):
+        """Returns the pstats report for route (or all routes)."""
+        self.lock.acquire()
+        try:
+            stats = self._combined(route)
+            if stats is None:
+                return ""
+            stream = StringIO.StringIO()
+            stats.stream = stream
+            stats.sort_stats(sort)
+            stats.print_stats(limit)
+            stats.print_callers(limit)
+            return stream.getvalue()
+        finally:
+            self.lock.release()
+    
+    def dump_pstats(self, route=None):
+        """Returns the profile data for route (or all routes) in the
+        format written by pstats.Stats.dump_stats, so that it can be
+        loaded by pstats or other profile viewers."""
+        self.lock.acquire()
+        try:
+            stats = self._combined(route)
+            if stats is None:
+                return marshal.dumps({})
+            return marshal.dumps(stats.stats)
+        finally:
+            self.lock.release()
+    
+    def reset(self):
+        """Throws away all of the collected data."""
+        self.lock.acquire()
+        try:
+            self.counters.clear()
+            self.stats.clear()
+            self.samples.clear()
+        finally:
+            self.lock.release()
@@ -153,7 +153,67 @@ class Redis(object):
         self.connect()
         self._write('MGET %s\r\n' % ' '.join(args))
         return self.get_response()
-    
+
+    def pipeline(self, *commands):
+        """Sends several inline commands in a single write and reads
+        back their responses in order. Each command is a tuple of the
+        command name followed by its arguments.
+
+        >>> r = Redis(db=9)
+        >>> r.delete('a')
+        1
+        >>> r.pipeline(('INCRBY', 'a', 5), ('EXPIRE', 'a', 10), ('GET', 'a'))
+        [5, 1, '5']
+        >>> r.pipeline()
+        []
+        >>>
+        """
+        if not commands:
+            return []
+        self.connect()
+        self._write(''.join('%s\r\n' % ' '.join(str(part) for part in command)
+                            for command in commands))
+        # read every response before raising so that the connection
+        # is not left with unread replies on it
+        result = []
+        error = None
+        for command in commands:
+            try:
+                result.append(self.get_response())
+            except ResponseError, e:
+                error = error or e
+                result.append(None)
+        if error is not None:
+            raise error
+        return result
+
+    def publish(self, channel, message):
+        """
+        >>> r = Redis(db=9)
+        >>> r.publish('nobody_listening', 1)
+        0
+        >>> 
+        """
+        self.connect()
+        self._write('PUBLISH %s %s\r\n' % (channel, message))
+        return self.get_response()
+
+    def subscribe(self, *channels):
+        """Subscribes this connection to the channels. After this,
+        only listen() (and more subscribe calls) can be used on it."""
+        self.connect()
+        self._write('SUBSCRIBE %s\r\n' % ' '.join(channels))
+        # one confirmation comes back for each channel
+        return [self.get_response() for channel in channels]
+
+    def listen(self):
+        """Yields (channel, message) for each message published to the
+        subscribed channels. This blocks until the next message arrives."""
+        while True:
+            response = self.get_response()
+            if response and response[0] == 'message':
+                yield response[1], response[2]
+
     def incr(self, name, amount=1):
         """
         >>> r = Redis(db=9)
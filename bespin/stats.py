@@ -38,9 +38,74 @@
 
 from datetime import date
 import logging
+import time
+import threading
+import atexit
+
+from sqlalchemy.interfaces import ConnectionProxy
 
 log = logging.getLogger("bespin.stats")
 
+# upper bounds (in milliseconds) of the buckets used for timing
+# histograms. Anything slower than the last bound goes into an extra
+# overflow bucket.
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+def _get_bucket_key(key, value):
+    """Returns the key of the histogram bucket that value falls in."""
+    for i, bound in enumerate(LATENCY_BUCKETS):
+        if value <= bound:
+            return "%s_b%s" % (key, i)
+    return "%s_b%s" % (key, len(LATENCY_BUCKETS))
+
+def get_histogram_keys(key):
+    """Returns the keys for all of the buckets of the histogram
+    stored under key, in bucket order."""
+    return ["%s_b%s" % (key, i) for i in range(len(LATENCY_BUCKETS) + 1)]
+
+def percentile(counts, pct):
+    """Given the bucket counts of a histogram (as returned by
+    get_histogram), returns the upper bound of the bucket that
+    contains the pct (0-100) percentile. None is returned if the
+    histogram is empty or if the percentile falls into the overflow
+    bucket."""
+    total = sum(counts)
+    if not total:
+        return None
+    wanted = total * pct / 100.0
+    running = 0
+    for i, count in enumerate(counts):
+        running += count
+        if running >= wanted:
+            break
+    if i < len(LATENCY_BUCKETS):
+        return LATENCY_BUCKETS[i]
+    return None
+
+def get_histogram(stats, key):
+    """Retrieves the bucket counts for the histogram stored under key."""
+    keys = [_get_key(k) for k in get_histogram_keys(key)]
+    values = stats.multiget(keys)
+    return [int(values.get(k) or 0) for k in keys]
+
+class QueryCounter(ConnectionProxy):
+    """Counts the SQL statements that are run by the current thread.
+    This is installed as the proxy for the database engine."""
+    
+    def __init__(self):
+        self.local = threading.local()
+    
+    @property
+    def count(self):
+        return getattr(self.local, "count", 0)
+    
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        self.local.count = self.count + 1
+        return execute(cursor, statement, parameters, context)
+
+query_counter = QueryCounter()
+
 class DoNothingStats(object):
     def incr(self, key, by=1):
         return 0
@@ -48,6 +113,12 @@ class DoNothingStats(object):
     def decr(self, key, by=1):
         return 0
     
+    def incr_many(self, deltas):
+        return dict()
+    
+    def timing(self, key, value):
+        pass
+    
     def multiget(self, keys):
         return dict()
         
@@ -73,6 +144,15 @@ class MemoryStats(object):
     def decr(self, key, by=1):
         return self.incr(key, -1*by)
     
+    def incr_many(self, deltas):
+        """Applies a dictionary of key -> delta in one go. Returns
+        a dictionary of the new values."""
+        return dict((key, self.incr(key, by)) for key, by in deltas.items())
+    
+    def timing(self, key, value):
+        """Records value (in milliseconds) in the histogram for key."""
+        self.incr(_get_bucket_key(key, value))
+    
     def multiget(self, keys):
         return dict((key, self.storage.get(key)) for key in keys)
         
@@ -96,10 +176,122 @@ class RedisStats(object):
             return self.redis.decr(key, by)
         except:
             log.exception("Problem decrementing stat %s", key)
+    
+    def timing(self, key, value):
+        """Records value (in milliseconds) in the histogram for key."""
+        self.incr(_get_bucket_key(key, value))
+    
+    def incr_many(self, deltas):
+        """Sends all of the deltas to redis with INCRBY in a single
+        round trip. Returns a dictionary of the new values."""
+        keys = [_get_key(key) for key in deltas.keys()]
+        commands = [('INCRBY', key, by) for key, by
+                    in zip(keys, deltas.values())]
+        try:
+            return dict(zip(keys, self.redis.pipeline(*commands)))
+        except:
+            log.exception("Problem incrementing stats %s", keys)
+            return dict()
         
     def multiget(self, keys):
         return dict(zip(keys, self.redis.mget(*keys)))
     
     def disconnect(self):
         self.redis.disconnect()
-        
\ No newline at end of file
+
+class BufferedStats(object):
+    """Wraps another stats object and keeps the counter deltas in
+    memory, sending them on to the wrapped stats in one batch once
+    flush_interval seconds have passed or max_pending updates have
+    been made. multiget includes the deltas that have not been sent
+    yet, so callers still see their own updates.
+    
+    The batch is sent by the request that crosses the threshold, but
+    outside of the lock that guards the deltas, so other requests carry
+    on counting (and skip flushing) while it talks to the wrapped
+    stats. incr doesn't return the new value, since that would mean
+    asking the wrapped stats for it."""
+    
+    def __init__(self, stats, flush_interval=1.0, max_pending=100):
+        self.stats = stats
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.pending = {}
+        self.pending_count = 0
+        # deltas that are being sent right now
+        self.flushing = {}
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        atexit.register(self.flush)
+    
+    def incr(self, key, by=1):
+        key = _get_key(key)
+        self.lock.acquire()
+        try:
+            self.pending[key] = self.pending.get(key, 0) + by
+            self.pending_count += 1
+        finally:
+            self.lock.release()
+        self._maybe_flush()
+    
+    def decr(self, key, by=1):
+        self.incr(key, -1*by)
+    
+    def incr_many(self, deltas):
+        for key, by in deltas.items():
+            self.incr(key, by)
+    
+    def timing(self, key, value):
+        self.incr(_get_bucket_key(key, value))
+    
+    def multiget(self, keys):
+        result = self.stats.multiget(keys)
+        self.lock.acquire()
+        try:
+            for key in keys:
+                delta = self.pending.get(key, 0) + self.flushing.get(key, 0)
+                if delta:
+                    result[key] = int(result.get(key) or 0) + delta
+            return result
+        finally:
+            self.lock.release()
+    
+    def _maybe_flush(self):
+        if self.pending_count >= self.max_pending or \
+            time.time() - self.last_flush >= self.flush_interval:
+            self.flush(wait=False)
+    
+    def flush(self, wait=True):
+        """Sends the pending deltas to the wrapped stats object. If
+        another thread is already flushing, this waits for it to finish
+        first, or returns straight away if wait is False."""
+        if not self.flush_lock.acquire(wait):
+            return
+        try:
+            self.lock.acquire()
+            try:
+                pending = self.pending
+                self.pending = {}
+                self.pending_count = 0
+                self.flushing = pending
+                self.last_flush = time.time()
+            finally:
+                self.lock.release()
+            if not pending:
+                return
+            try:
+                self.stats.incr_many(pending)
+            finally:
+                self.lock.acquire()
+                try:
+                    self.flushing = {}
+                finally:
+                    self.lock.release()
+                self.stats.disconnect()
+        finally:
+            self.flush_lock.release()
+    
+    def disconnect(self):
+        # the wrapped stats are only connected while flushing
+        self._maybe_flush()
@@ -37,6 +37,8 @@
 
 from webtest import TestApp
 
+from bespin import stats
+
 class BespinTestApp(TestApp):
     def _make_environ(self, extra_environ=None):
         environ = super(BespinTestApp, self)._make_environ(extra_environ)
@@ -44,3 +46,13 @@ class BespinTestApp(TestApp):
         environ["HTTP_COOKIE"] = "Domain-Token=anti-csrf"
         environ["BespinTestApp"] = "True"
         return environ
+
+def assert_max_queries(limit, func, *args, **kw):
+    """Calls func and fails if it runs more than limit SQL statements.
+    Returns what func returns."""
+    start = stats.query_counter.count
+    result = func(*args, **kw)
+    count = stats.query_counter.count - start
+    assert count <= limit, "%s ran %s SQL statements, expected at most %s" \
+        % (getattr(func, "__name__", func), count, limit)
+    return result
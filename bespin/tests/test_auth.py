@@ -61,4 +61,87 @@ def test_login_success():
     fli = tracker.can_log_in("foo")
     assert fli.can_log_in
     assert fli.failed_attempts == 0
-    
\ No newline at end of file
+    
+def test_memory_tracker_is_bounded():
+    tracker = auth.MemoryFailedLoginTracker(3, 600, max_entries=100)
+    for i in range(1000):
+        fli = tracker.can_log_in("user%s" % i)
+        tracker.login_failed(fli)
+    assert len(tracker.store) <= 100
+    # the most recent failures are still tracked
+    assert tracker.can_log_in("user999").failed_attempts == 1
+
+def test_credential_stuffing_burst():
+    # a burst of guesses against many accounts, mixed with repeated
+    # guesses against one account
+    tracker = auth.MemoryFailedLoginTracker(5, 600, max_entries=500)
+    locked_out = 0
+    for i in range(5000):
+        fli = tracker.can_log_in("victim")
+        if fli.can_log_in:
+            tracker.login_failed(fli)
+        else:
+            locked_out += 1
+        fli = tracker.can_log_in("random%s" % i)
+        tracker.login_failed(fli)
+    assert len(tracker.store) <= 500
+    assert not tracker.can_log_in("victim").can_log_in
+    assert locked_out == 4995
+
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+        self.expires = {}
+        self.round_trips = 0
+    
+    def get(self, key):
+        self.round_trips += 1
+        if key in self.expires and time.time() > self.expires[key]:
+            del self.values[key]
+            del self.expires[key]
+        return self.values.get(key)
+    
+    def pipeline(self, *commands):
+        self.round_trips += 1
+        result = []
+        for command in commands:
+            if command[0] == "INCR":
+                value = int(self.get(command[1]) or 0) + 1
+                self.round_trips -= 1
+                self.values[command[1]] = str(value)
+                result.append(value)
+            elif command[0] == "EXPIRE":
+                self.expires[command[1]] = time.time() + command[2]
+                result.append(1)
+        return result
+    
+    def delete(self, key):
+        self.round_trips += 1
+        self.values.pop(key, None)
+        self.expires.pop(key, None)
+
+def test_redis_tracker():
+    redis = FakeRedis()
+    tracker = auth.RedisFailedLoginTracker(redis, 2, 1)
+    fli = tracker.can_log_in("foo bar")
+    assert fli.can_log_in
+    tracker.login_failed(fli)
+    # one round trip for INCR and EXPIRE
+    assert redis.round_trips == 2
+    assert redis.values == {"loginfail_foo%20bar": "1"}
+    assert redis.expires["loginfail_foo%20bar"] > time.time()
+    
+    fli = tracker.can_log_in("foo bar")
+    assert fli.can_log_in
+    assert fli.failed_attempts == 1
+    tracker.login_failed(fli)
+    fli = tracker.can_log_in("foo bar")
+    assert not fli.can_log_in
+    time.sleep(1.5)
+    fli = tracker.can_log_in("foo bar")
+    assert fli.can_log_in
+    
+    tracker.login_failed(fli)
+    fli = tracker.can_log_in("foo bar")
+    tracker.login_successful(fli)
+    assert tracker.can_log_in("foo bar").failed_attempts == 0
@@ -44,7 +44,7 @@ from bespin.filesystem import get_project
 from bespin.database import User, Base, ConflictError
 
 from nose.tools import assert_equals
-from __init__ import BespinTestApp
+from __init__ import BespinTestApp, assert_max_queries
 
 session = None
 mattb = None
@@ -290,6 +290,71 @@ def test_sharing():
 
     joes_project.delete()
 
+def test_project_access_levels():
+    _reset()
+
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    assert_equals(joe.get_project_access(joes_project, ev), None)
+
+    homies = joe.get_group("homies", create_on_not_found=True)
+    homies.add_member(mattb)
+    joe.add_sharing(joes_project, homies, False, False)
+    joe.add_sharing(joes_project, ev, True, False)
+    assert_equals(joe.get_project_access(joes_project, mattb), "read")
+    assert_equals(joe.get_project_access("joes_project", ev), "write")
+    assert_equals(joe.get_project_access(joes_project, tom), None)
+    assert joe.is_project_shared(joes_project, ev, require_write=True)
+    assert not joe.is_project_shared(joes_project, mattb, require_write=True)
+
+    # an everyone share never reduces the access from a user share
+    joe.add_sharing(joes_project, 'everyone', False, False)
+    assert_equals(joe.get_project_access(joes_project, tom), "read")
+    assert_equals(joe.get_project_access(joes_project, ev), "write")
+
+    joe.remove_sharing(joes_project)
+    joes_project.delete()
+
+def test_filter_shared_users():
+    _reset()
+
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    everyone = [joe, mattb, zuck, tom, ev]
+    assert_equals(joe.filter_shared_users(joes_project, everyone), [joe])
+    assert_equals(joe.filter_shared_users(joes_project, []), [])
+
+    # the shares are seen before anything is committed
+    homies = joe.get_group("homies", create_on_not_found=True)
+    homies.add_member(mattb)
+    joe.add_sharing(joes_project, homies, False, False)
+    joe.add_sharing(joes_project, ev, True, False)
+    assert_equals(joe.filter_shared_users(joes_project, everyone),
+                  [joe, mattb, ev])
+    shared = assert_max_queries(1, joe.filter_shared_users,
+                                "joes_project", everyone)
+    assert_equals(shared, [joe, mattb, ev])
+
+    joe.add_sharing(joes_project, 'everyone', False, False)
+    assert_equals(joe.filter_shared_users(joes_project, everyone), everyone)
+    # other projects aren't affected
+    assert_equals(joe.filter_shared_users("other", everyone), [joe])
+
+def test_shared_projects_follow_rename_and_delete():
+    _reset()
+
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    joe.add_sharing(joes_project, ev, False, False)
+    ev.follow(joe)
+    assert_equals([p.name for p in ev.get_shared_projects()], ["joes_project"])
+
+    joes_project.rename("renamed")
+    assert_equals([p.name for p in ev.get_shared_projects()], ["renamed"])
+    assert_equals(joe.get_project_access("renamed", ev), "read")
+    assert_equals(len(ev.get_all_projects(True)), 2)
+
+    joes_project.delete()
+    assert_equals(ev.get_shared_projects(), [])
+    assert_equals(joe.get_sharing(), [])
+
 # Sharing tests
 def test_sharing_with_app():
     _reset()
@@ -399,6 +464,32 @@ def test_sharing_with_app():
     joes_project.delete()
 
 # Follower tests
+def test_listings_use_a_fixed_number_of_queries():
+    _reset()
+
+    joes_project = get_project(joe, joe, "joes_project", create=True)
+    group = joe.get_group("group")
+    for i in range(20):
+        other = User.create_user("user%s" % i, "pass", "user%s@foo.com" % i)
+        joe.follow(other)
+        other.follow(joe)
+        group.add_member(other)
+        joe.add_sharing(joes_project, other, False, False)
+    session.commit()
+
+    response = assert_max_queries(6, app.get, "/network/followers/")
+    assert_equals(len(simplejson.loads(response.body)), 20)
+    response = assert_max_queries(6, app.get, "/group/list/group/")
+    assert_equals(len(simplejson.loads(response.body)), 24)
+    response = assert_max_queries(8, app.get, "/share/list/all/")
+    assert_equals(len(simplejson.loads(response.body)), 20)
+
+    session.expunge_all()
+    user = User.find_user("user0")
+    projects = assert_max_queries(2, user.get_all_projects, True)
+    assert_equals([p.name for p in projects],
+                  ["SampleProject", "joes_project"])
+
 def test_follow():
     _reset()
 
@@ -0,0 +1,156 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+# 
+
+import gzip
+import zlib
+import tempfile
+from cStringIO import StringIO
+
+from path import path
+from webob import Request, Response
+from nose.tools import assert_equals
+
+from bespin import compress
+
+def _app(body, content_type="text/plain", etag=None, chunked=False):
+    def app(environ, start_response):
+        response = Response(content_type=content_type)
+        if chunked:
+            response.app_iter = [body[:len(body) / 2], body[len(body) / 2:]]
+        else:
+            response.body = body
+        if etag:
+            response.etag = etag
+            response.conditional_response = True
+        return response(environ, start_response)
+    return app
+
+def _get(app, accept_encoding=None, **headers):
+    if accept_encoding:
+        headers['Accept-Encoding'] = accept_encoding
+    return Request.blank("/", headers=headers).get_response(app)
+
+def _gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+def test_choose_encoding():
+    assert_equals(compress.choose_encoding(""), None)
+    assert_equals(compress.choose_encoding("gzip, deflate"), "gzip")
+    assert_equals(compress.choose_encoding("deflate"), "deflate")
+    assert_equals(compress.choose_encoding("gzip;q=0, deflate"), "deflate")
+    assert_equals(compress.choose_encoding("*;q=0.5, gzip;q=0"), "deflate")
+    assert_equals(compress.choose_encoding("identity"), None)
+
+def test_large_text_responses_are_compressed():
+    body = "Chewing gum wrapper. " * 100
+    app = compress.compress_middleware(_app(body, chunked=True))
+    resp = _get(app, "gzip")
+    assert_equals(resp.headers['Content-Encoding'], "gzip")
+    assert_equals(resp.headers['Vary'], "Accept-Encoding")
+    assert "Content-Length" not in resp.headers
+    assert_equals(_gunzip(resp.body), body)
+
+    resp = _get(app, "deflate")
+    assert_equals(zlib.decompress(resp.body), body)
+
+    resp = _get(app)
+    assert_equals(resp.body, body)
+    assert "Content-Encoding" not in resp.headers
+
+def test_small_and_compressed_responses_are_left_alone():
+    app = compress.compress_middleware(_app("tiny"))
+    resp = _get(app, "gzip")
+    assert_equals(resp.body, "tiny")
+    assert "Content-Encoding" not in resp.headers
+
+    app = compress.compress_middleware(_app("x" * 5000, "image/png"))
+    resp = _get(app, "gzip")
+    assert "Content-Encoding" not in resp.headers
+
+def test_compressed_etags_still_revalidate():
+    app = compress.compress_middleware(
+        _app("Paper clip. " * 200, etag="abc"))
+    resp = _get(app, "gzip")
+    assert_equals(resp.headers['ETag'], '"abc-gzip"')
+    resp = _get(app, "gzip", **{'If-None-Match': '"abc-gzip"'})
+    assert_equals(resp.status_int, 304)
+
+def test_precompressed_siblings_are_served():
+    directory = path(tempfile.mkdtemp())
+    (directory / "big.js").write_bytes("var x = 1;\n" * 500)
+    (directory / "small.js").write_bytes("var y;")
+    assert_equals(compress.compress_directory(directory), 1)
+    assert_equals(compress.compress_directory(directory), 0)
+
+    def fallback(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return ["fallback"]
+    app = compress.precompressed_middleware(fallback, directory)
+
+    resp = Request.blank("/big.js",
+        headers={'Accept-Encoding': 'gzip'}).get_response(app)
+    assert_equals(resp.headers['Content-Encoding'], "gzip")
+    assert resp.content_type.endswith("javascript")
+    assert_equals(_gunzip(resp.body), "var x = 1;\n" * 500)
+
+    etag = resp.headers['ETag']
+    last_modified = resp.headers['Last-Modified']
+    resp = Request.blank("/big.js", headers={'Accept-Encoding': 'gzip',
+        'If-None-Match': etag}).get_response(app)
+    assert_equals(resp.status_int, 304)
+    assert_equals(resp.body, "")
+    assert_equals(resp.headers['ETag'], etag)
+    resp = Request.blank("/big.js", headers={'Accept-Encoding': 'gzip',
+        'If-Modified-Since': last_modified}).get_response(app)
+    assert_equals(resp.status_int, 304)
+    resp = Request.blank("/big.js", headers={'Accept-Encoding': 'gzip',
+        'If-None-Match': '"other"'}).get_response(app)
+    assert_equals(resp.status_int, 200)
+    assert_equals(_gunzip(resp.body), "var x = 1;\n" * 500)
+    resp = Request.blank("/big.js", headers={'Accept-Encoding': 'gzip',
+        'If-Modified-Since': 'Thu, 01 Jan 1970 00:00:00 GMT'}).get_response(app)
+    assert_equals(resp.status_int, 200)
+
+    resp = Request.blank("/big.js").get_response(app)
+    assert_equals(resp.body, "fallback")
+    resp = Request.blank("/small.js",
+        headers={'Accept-Encoding': 'gzip'}).get_response(app)
+    assert_equals(resp.body, "fallback")
+    resp = Request.blank("/../big.js",
+        headers={'Accept-Encoding': 'gzip'}).get_response(app)
+    assert_equals(resp.body, "fallback")
+    directory.rmtree()
@@ -0,0 +1,124 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import tempfile
+
+from nose.tools import assert_equals
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from bespin import config, database
+from bespin.database import Base, EventLog
+
+def setup_module(module):
+    config.set_profile("test")
+    config.activate_profile()
+
+def _reset():
+    Base.metadata.drop_all(bind=config.c.dbengine)
+    Base.metadata.create_all(bind=config.c.dbengine)
+
+def _events(engine=None):
+    engine = engine or config.c.dbengine
+    return engine.execute(EventLog.select()).fetchall()
+
+def _file_engine():
+    # the in-memory test database can't be seen from the writer's thread
+    engine = create_engine("sqlite:///" + tempfile.mktemp())
+    EventLog.create(bind=engine)
+    return engine
+
+class CountingEngine(object):
+    def __init__(self, engine, fail=False):
+        self.engine = engine
+        self.fail = fail
+        self.batches = []
+    
+    def execute(self, statement, rows):
+        if self.fail:
+            raise OperationalError(str(statement), {}, Exception("slow"))
+        self.batches.append(len(rows))
+        return self.engine.execute(statement, rows)
+
+def test_events_are_written_in_batches():
+    file_engine = _file_engine()
+    engine = CountingEngine(file_engine)
+    writer = database.EventLogWriter(engine, batch_size=4, interval=60)
+    config.c.event_log_writer = writer
+    try:
+        for i in range(10):
+            database.log_event("test", None, dict(i=i))
+        writer.stop()
+    finally:
+        config.c.event_log_writer = None
+    assert_equals(sum(engine.batches), 10)
+    assert max(engine.batches) <= 4
+    events = _events(file_engine)
+    assert_equals(len(events), 10)
+    assert_equals(events[0].details, '{"i": 0}')
+
+def test_events_spill_to_file_when_database_fails():
+    _reset()
+    spill_file = tempfile.mktemp()
+    engine = CountingEngine(config.c.dbengine, fail=True)
+    writer = database.EventLogWriter(engine, batch_size=100,
+                                     max_pending=2, spill_file=spill_file)
+    for i in range(3):
+        # the third is over max_pending and goes straight to the file
+        writer.add(dict(ts=database.datetime.now(), kind="test",
+                        username="bob", details=None))
+    writer.stop()
+    assert_equals(len(open(spill_file).readlines()), 3)
+    assert_equals(_events(), [])
+    
+    assert_equals(database.load_spill_file(spill_file, config.c.dbengine), 3)
+    events = _events()
+    assert_equals(len(events), 3)
+    assert_equals(events[0].username, "bob")
+
+def test_events_added_after_stop_are_written():
+    file_engine = _file_engine()
+    engine = CountingEngine(file_engine)
+    writer = database.EventLogWriter(engine, batch_size=4, interval=60)
+    writer.add(dict(ts=database.datetime.now(), kind="test",
+                    username="bob", details=None))
+    writer.stop()
+    assert not writer.thread.isAlive()
+    writer.add(dict(ts=database.datetime.now(), kind="test",
+                    username="late", details=None))
+    assert_equals(engine.batches, [1, 1])
+    assert_equals([event.username for event in _events(file_engine)],
+                  ["bob", "late"])
@@ -38,8 +38,10 @@
 # 
 
 import os
+import time
 from datetime import datetime, timedelta
 from urllib import urlencode
+from cStringIO import StringIO
 
 from __init__ import BespinTestApp
 import simplejson
@@ -52,6 +54,7 @@ from bespin import config, controllers, filesystem
 from bespin.filesystem import File, get_project, ProjectView
 from bespin.filesystem import FSException, FileNotFound, OverQuota, FileConflict, BadValue
 from bespin.database import User, Base, _get_session, EventLog
+from bespin.database import verify_space_used
 
 tarfilename = os.path.join(os.path.dirname(__file__), "ut.tgz")
 zipfilename = os.path.join(os.path.dirname(__file__), "ut.zip")
@@ -138,6 +141,11 @@ def test_changing_file_contents_changes_amount_used():
     assert macgyver.amount_used == starting_point + 6
     bigmac.save_file("foo", "step two")
     assert macgyver.amount_used == starting_point + 8
+    # unicode is counted in the UTF-8 bytes that are written
+    bigmac.save_file("foo", u"\u00e9t\u00e9\r\n")
+    assert bigmac.location.joinpath("foo").size == 6
+    assert macgyver.amount_used == starting_point + 6
+    assert bigmac.metadata.get_space_used("") == 6
     
 def test_cannot_save_beyond_quota():
     _init_data()
@@ -151,7 +159,39 @@ def test_cannot_save_beyond_quota():
         pass
     finally:
         filesystem.QUOTA_UNITS = old_units
-        
+
+def test_save_file_from_streams_into_place():
+    _init_data()
+    starting_point = macgyver.amount_used
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file_from("foo", StringIO("step 1 and then some"), 6)
+    assert macgyver.amount_used == starting_point + 6
+    bigmac.save_file_from("foo", StringIO("step two"))
+    assert macgyver.amount_used == starting_point + 8
+    assert bigmac.get_file("foo") == "step two"
+    assert bigmac.location.files(".bespin-write-*") == []
+
+    try:
+        bigmac.save_file_from("foo", StringIO("short"), 10)
+        assert False, "Expected an FSException"
+    except FSException:
+        pass
+    assert bigmac.get_file("foo") == "step two"
+
+    old_units = filesystem.QUOTA_UNITS
+    filesystem.QUOTA_UNITS = 10
+    try:
+        for length in [11, None]:
+            try:
+                bigmac.save_file_from("foo", StringIO("x" * 11), length)
+                assert False, "Expected an OverQuota exception"
+            except OverQuota:
+                pass
+    finally:
+        filesystem.QUOTA_UNITS = old_units
+    assert bigmac.get_file("foo") == "step two"
+    assert bigmac.location.files(".bespin-write-*") == []
+
 def test_amount_used_can_be_recomputed():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
@@ -162,7 +202,129 @@ def test_amount_used_can_be_recomputed():
     macgyver.amount_used = 0
     macgyver.recompute_files()
     assert macgyver.amount_used == starting_point
-    
+
+def test_space_used_is_recorded_per_directory():
+    _init_data()
+    starting_point = macgyver.amount_used
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar", "data")
+    bigmac.save_file("foo/baz/blorg", "moredata")
+    bigmac.save_file_from("top", StringIO("x"))
+    metadata = bigmac.metadata
+    assert metadata.get_space_used() == 13
+    assert metadata.get_space_used("foo/") == 12
+    assert metadata.get_space_used("foo/baz/") == 8
+
+    bigmac.save_file("foo/bar", "da")
+    assert metadata.get_space_used("foo/") == 10
+    bigmac.delete("/foo/baz/")
+    assert metadata.get_space_used("foo/") == 2
+    assert metadata.get_space_used() == 3
+    assert macgyver.amount_used == starting_point + 3
+
+    # projects without recorded sizes are scanned once
+    metadata.connection.execute("delete from dir_size")
+    bigmac.delete("top")
+    assert metadata.get_space_used() == 2
+    assert macgyver.amount_used == starting_point + 2
+
+    # changes made behind Bespin's back are caught by the verifier
+    (bigmac.location / "foo/other").write_bytes("12345")
+    s = _get_session()
+    assert verify_space_used(s) == [("MacGyver", starting_point + 2,
+                                     starting_point + 7)]
+    assert verify_space_used(s) == []
+    assert metadata.get_space_used("foo/") == 7
+
+def test_file_scans_skip_version_control_directories():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("b/foo.js", "foo")
+    bigmac.save_file("a.txt", "a")
+    bigmac.save_file(".hgignore", "syntax: glob")
+    bigmac.save_file(".hg/store/data", "data")
+    bigmac.save_file("b/.svn/entries", "entries")
+    expected = [(".hgignore", 12), ("a.txt", 1), ("b/foo.js", 3)]
+    for threads in [1, 3]:
+        total, files = filesystem._get_file_list(bigmac.location, threads)
+        assert files == expected
+        assert total == 16
+
+def test_temp_files_shadow_real_files_until_saved():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_file("foo/bar", "real")
+    assert bigmac.get_temp_file("foo/bar") == "real"
+    bigmac.save_temp_file("foo/bar", "edited")
+    assert bigmac.get_temp_file("foo/bar") == "edited"
+    # new files get an empty temp copy
+    assert bigmac.get_temp_file("new") == ""
+    assert (bigmac.temp_directory / "new").exists()
+    # the temp copies aren't part of the project
+    assert [f.name for f in bigmac.list_files()] == ["foo/"]
+
+    bigmac.save_file("foo/bar", "saved")
+    assert not (bigmac.temp_directory / "foo/bar").exists()
+    assert bigmac.get_temp_file("foo/bar") == "saved"
+
+    # copies removed behind our back are noticed
+    bigmac.save_temp_file("foo/bar", "edited")
+    (bigmac.temp_directory / "foo/bar").remove()
+    assert bigmac.get_temp_file("foo/bar") == "saved"
+
+    # temp copies are only ever removed from the temp directory
+    try:
+        bigmac._remove_temp_copy("foo/..")
+        assert False, "Expected BadValue for a relative path"
+    except BadValue:
+        pass
+    bigmac._remove_temp_copy("/foo/bar")
+    assert bigmac.location.exists()
+
+def test_stale_temp_files_are_pruned():
+    _init_data()
+    bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+    bigmac.save_temp_file("foo/bar", "recent")
+    bigmac.save_temp_file("stale", "old")
+    an_hour_ago = time.time() - 3600
+    os.utime(bigmac.temp_directory / "stale", (an_hour_ago, an_hour_ago))
+    assert filesystem.prune_temp_files([macgyver], 60) == 1
+    assert bigmac.get_temp_file("foo/bar") == "recent"
+    assert not (bigmac.temp_directory / "stale").exists()
+    assert filesystem.prune_temp_files([macgyver], 0) == 1
+    assert not bigmac.temp_directory.exists()
+
+def test_shared_files_are_linked_until_edited():
+    config.c.use_blob_store = True
+    try:
+        _init_data()
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        bigmac.install_template()
+        sample = get_project(macgyver, macgyver, "SampleProject")
+        mine = bigmac.location / "readme.txt"
+        theirs = sample.location / "readme.txt"
+        original = theirs.bytes()
+        assert mine.stat().st_ino == theirs.stat().st_ino
+
+        starting_point = macgyver.amount_used
+        bigmac.save_file("readme.txt", "mine")
+        assert mine.stat().st_ino != theirs.stat().st_ino
+        assert mine.bytes() == "mine"
+        assert theirs.bytes() == original
+        assert macgyver.amount_used == starting_point + 4 - len(original)
+
+        bigmac.save_file_from("foo", StringIO("same"), shared=True)
+        sample.save_file_from("foo", StringIO("same"), shared=True)
+        assert (bigmac.location / "foo").stat().st_nlink == 3
+        bigmac.delete("foo")
+        sample.delete("foo")
+        assert config.c.blob_store.collect() == 0
+        assert config.c.blob_store.collect(min_age=0) == 1
+        assert theirs.bytes() == original
+    finally:
+        config.c.use_blob_store = False
+        config.c.blob_store = None
+
 def test_retrieve_file_obj():
     _init_data()
     bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
@@ -611,7 +773,35 @@ def test_preview_mode():
     resp = app.get("/preview/at/bigmac/index.html")
     assert resp.body == "<html><body>Simple HTML file</body></html>"
     assert resp.content_type == "text/html"
-    
+
+def test_file_reads_use_etags_and_ranges():
+    _init_data()
+    app.put("/file/at/bigmac/reqs", "Chewing gum wrapper")
+    resp = app.get("/file/at/bigmac/reqs")
+    etag = resp.headers['ETag']
+    assert resp.headers['Cache-Control'] == "private, no-cache"
+
+    resp = app.get("/file/at/bigmac/reqs",
+                   headers={'If-None-Match': etag}, status=304)
+    assert resp.body == ""
+
+    resp = app.get("/file/at/bigmac/reqs",
+                   headers={'Range': 'bytes=8-10'}, status=206)
+    assert resp.body == "gum"
+    assert resp.headers['Content-Range'] == "bytes 8-10/19"
+
+    resp = app.get("/preview/at/bigmac/reqs",
+                   headers={'If-None-Match': etag}, status=304)
+
+    app.put("/file/at/bigmac/reqs", "Paper clip")
+    resp = app.get("/file/at/bigmac/reqs",
+                   headers={'If-None-Match': etag})
+    assert resp.body == "Paper clip"
+    assert resp.headers['ETag'] != etag
+
+    resp = app.get("/file/list/bigmac/")
+    assert "no-store" in resp.headers['Cache-Control']
+
 def test_quota_limits_on_the_web():
     _init_data()
     old_units = filesystem.QUOTA_UNITS
@@ -0,0 +1,111 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+from urlrelay import URLRelay
+
+from bespin import framework
+
+def _app(name):
+    def app(environ, start_response):
+        return [name]
+    app.__name__ = name
+    return app
+
+default_app = _app("default")
+
+def _make_paths():
+    return [
+        ("^/file/at/(?P<path>.*)$", dict(GET=_app("getfile"),
+                                          PUT=_app("putfile"))),
+        ("^/file/list/(?P<path>.*)$", dict(GET=_app("listfiles"))),
+        ("^/files?/stats/$", dict(GET=_app("filestats"))),
+        ("^/register/new/(?P<username>.*)$", dict(POST=_app("new_user"))),
+        ("^/register/(login|logout)/", dict(POST=_app("loginout"))),
+        ("^/stats/$", dict(GET=_app("stats"))),
+        ("^/stats/profile/$", dict(GET=_app("profile"),
+                                   DELETE=_app("reset_profile"))),
+        ("^/docs/", _app("docs")),
+        ("^/.js/", _app("proxy")),
+        ("/settings/", _app("anywhere")),
+    ]
+
+def _resolve(relay, path, method):
+    try:
+        app, args, kw = relay.resolve(path, method)
+        return app.__name__, args, kw
+    except ImportError:
+        return None
+
+def test_literal_prefix():
+    assert framework._literal_prefix("^/file/at/(?P<path>.*)$") == "/file/at/"
+    assert framework._literal_prefix("^/files?/stats/$") == "/file"
+    assert framework._literal_prefix("^/.js/") == "/"
+    assert framework._literal_prefix("/settings/") == ""
+    # either side of a top level | can match
+    assert framework._literal_prefix("^/a|^/b/") == ""
+    assert framework._literal_prefix("^/a/(b|c)/$") == "/a/"
+    assert framework._literal_prefix(r"^/a\|b/(c)$") == "/a"
+    assert framework._literal_prefix("^/a/[|]$") == "/a/"
+    assert framework._literal_prefix("^/a/[])|]$") == "/a/"
+    # the prefix would be compared case sensitively
+    assert framework._literal_prefix("(?i)^/file/") == ""
+    assert framework._literal_prefix("^/file/(?i)at/") == ""
+
+def test_indexed_relay_dispatches_like_urlrelay():
+    plain = URLRelay(paths=_make_paths(), default=default_app)
+    indexed = framework.IndexedURLRelay(paths=_make_paths(), 
+                                        default=default_app)
+    for path in ["/file/at/foo/bar.js", "/file/list/", "/file/stats/",
+                 "/files/stats/", "/register/new/bob", "/register/login/",
+                 "/stats/", "/stats/profile/", "/docs/index.html", "/xjs/foo",
+                 "/.js/foo", "/foo/settings/", "/", "", "/unknown/path"]:
+        for method in ["GET", "PUT", "POST", "DELETE", "HEAD"]:
+            expected = _resolve(plain, path, method)
+            result = _resolve(indexed, path, method)
+            assert result == expected, "%s %s: %s != %s" % (method, path,
+                                                            result, expected)
+
+def test_indexed_relay_groups_by_method():
+    indexed = framework.IndexedURLRelay(paths=_make_paths(), 
+                                        default=default_app)
+    candidates = indexed._candidates("/stats/profile/", "DELETE")
+    names = [app.__name__ for prefix, pattern, app in candidates]
+    assert names == ["reset_profile", "proxy", "anywhere"]
+    app, args, kw = indexed.resolve("/stats/profile/", "DELETE")
+    assert app.__name__ == "reset_profile"
+    app, args, kw = indexed.resolve("/file/at/foo/bar.js", "PUT")
+    assert app.__name__ == "putfile"
+    assert kw == dict(path="foo/bar.js")
@@ -0,0 +1,121 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading
+
+from nose.tools import assert_equals
+
+from bespin import config, notify, stats
+from bespin.database import User, Message, Base
+
+session = None
+user = None
+
+def setup_module(module):
+    config.set_profile("test")
+    config.activate_profile()
+    
+def _reset():
+    Base.metadata.drop_all(bind=config.c.dbengine)
+    Base.metadata.create_all(bind=config.c.dbengine)
+    global session, user
+    session = config.c.session_factory()
+    user = User("BillBixby", "hulkrulez", "bill@bixby.com")
+    session.add(user)
+    session.commit()
+
+def test_memory_notifier_wakes_only_the_right_user():
+    notifier = notify.MemoryNotifier()
+    bill = notifier.listen(1)
+    other = notifier.listen(2)
+    waiter = threading.Thread(target=lambda: notifier.notify([1]))
+    waiter.start()
+    assert bill.wait(5)
+    waiter.join()
+    assert not other.wait(0.01)
+    notifier.unlisten(bill)
+    notifier.unlisten(other)
+    assert_equals(notifier.listeners, {})
+
+def test_messages_notify_after_commit():
+    _reset()
+    listener = config.c.message_notifier.listen(user.id)
+    try:
+        user.publish(dict(text="hi"))
+        session.flush()
+        assert not listener.event.isSet()
+        session.rollback()
+        assert not listener.event.isSet()
+        
+        user.publish(dict(text="hi"))
+        session.commit()
+        assert listener.event.isSet()
+    finally:
+        config.c.message_notifier.unlisten(listener)
+
+def test_pop_messages_in_one_batch():
+    _reset()
+    for i in range(5):
+        session.add(Message(user_id=user.id, message='"%s"' % i))
+    session.commit()
+    # load the user, which the commit expired
+    user.username
+    
+    start = stats.query_counter.count
+    messages = user.pop_messages()
+    assert_equals(messages, ['"0"', '"1"', '"2"', '"3"', '"4"'])
+    # one query to find them and one delete
+    assert_equals(stats.query_counter.count - start, 2)
+    session.commit()
+    assert_equals(user.pop_messages(), [])
+
+class FakeRedis(object):
+    def __init__(self):
+        self.commands = []
+    
+    def pipeline(self, *commands):
+        self.commands.extend(commands)
+
+def test_redis_notifier_publishes_user_ids():
+    notifier = notify.RedisNotifier("localhost", 6379)
+    notifier.redis = FakeRedis()
+    notifier.notify(set([3]))
+    assert_equals(notifier.redis.commands, [("PUBLISH", "bespin_messages", 3)])
+    
+    # the subscriber thread wakes listeners in this process
+    listener = notify.MemoryNotifier.listen(notifier, 3)
+    notifier._wake(3)
+    assert listener.wait(0)
@@ -0,0 +1,124 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading
+import binascii
+import hashlib
+
+from nose.tools import assert_equals
+
+from bespin import passwords
+
+def test_pbkdf2_round_trip():
+    hasher = passwords.PBKDF2Hasher("secret", 10)
+    encoded = hasher.encode(u"s3cr\xe9t")
+    assert encoded.startswith("pbkdf2_sha256$10$")
+    assert hasher.verify(u"s3cr\xe9t", encoded)
+    assert not hasher.verify("wrong", encoded)
+    # salted, so the same password hashes differently each time
+    assert encoded != hasher.encode(u"s3cr\xe9t")
+    assert not hasher.needs_update(encoded)
+    assert passwords.PBKDF2Hasher("secret", 20).needs_update(encoded)
+
+def test_pure_python_pbkdf2_matches_rfc_vectors():
+    pbkdf2_hmac = getattr(hashlib, "pbkdf2_hmac", None)
+    if pbkdf2_hmac:
+        del hashlib.pbkdf2_hmac
+    try:
+        result = passwords._pbkdf2_sha256("password", "salt", 2)
+    finally:
+        if pbkdf2_hmac:
+            hashlib.pbkdf2_hmac = pbkdf2_hmac
+    assert_equals(binascii.hexlify(result), "ae4d0c95af6b46d32d0adff928f06dd0"
+                  "2a303f8ef3c251dfd6e2d85a95474c43")
+
+def test_legacy_hash_is_upgraded():
+    legacy = passwords.SHA256Hasher("secret")
+    current = passwords.PBKDF2Hasher("secret", 10)
+    manager = passwords.PasswordManager(current, [legacy], threads=0)
+    old = legacy.encode("foo")
+    valid, new = manager.verify("joe", "wrong", old)
+    assert not valid and new is None
+    valid, new = manager.verify("joe", "foo", old)
+    assert valid
+    assert new.startswith("pbkdf2_sha256$")
+    valid, newer = manager.verify("joe", "foo", new)
+    assert valid and newer is None
+
+def test_verification_cache():
+    calls = []
+    class CountingHasher(passwords.PBKDF2Hasher):
+        def verify(self, password, encoded):
+            calls.append(password)
+            return passwords.PBKDF2Hasher.verify(self, password, encoded)
+    hasher = CountingHasher("secret", 10)
+    manager = passwords.PasswordManager(hasher, threads=0, cache_ttl=60)
+    encoded = hasher.encode("foo")
+    assert manager.verify("joe", "foo", encoded)[0]
+    assert manager.verify("joe", "foo", encoded)[0]
+    assert_equals(len(calls), 1)
+    # a wrong password or a changed hash still goes to the hasher
+    assert not manager.verify("joe", "bar", encoded)[0]
+    assert manager.verify("joe", "foo", hasher.encode("foo"))[0]
+    assert_equals(len(calls), 3)
+
+def test_pool_turns_away_logins_when_full():
+    started = threading.Event()
+    release = threading.Event()
+    def slow():
+        started.set()
+        release.wait()
+        return "done"
+    pool = passwords._HashPool(1, 1)
+    results = []
+    first = threading.Thread(target=lambda: results.append(pool.run(slow)))
+    first.start()
+    started.wait()
+    # the worker is busy, so this one waits in the queue
+    second = threading.Thread(target=lambda: results.append(
+        pool.run(lambda: "queued")))
+    second.start()
+    while pool.jobs.qsize() == 0:
+        pass
+    try:
+        pool.run(slow)
+        assert False, "Expected PasswordHashBusy"
+    except passwords.PasswordHashBusy:
+        pass
+    release.set()
+    first.join()
+    second.join()
+    assert_equals(sorted(results), ["done", "queued"])
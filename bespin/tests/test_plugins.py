@@ -38,6 +38,7 @@
 from path import path
 
 from simplejson import loads
+from webob import Request
 
 from bespin import config, plugins, controllers
 from bespin.database import User, Base, EventLog, _get_session, GalleryPlugin
@@ -190,7 +191,30 @@ def test_get_single_file_script():
     assert content_type == "text/javascript"
     assert "exports.someFunction" in response.body
     assert "single_file_plugin1:index" in response.body
-    
+
+def test_get_plugin_bundle():
+    response = app.get("/plugin/register/defaults")
+    md = loads(response.body)["plugin1"]
+    bundle_url = md["bundleURL"]
+    assert bundle_url.startswith("/server/plugin/bundle/testplugins/plugin1/")
+
+    response = app.get(bundle_url[len("/server"):])
+    assert response.content_type == "text/javascript"
+    assert response.headers['Cache-Control'] == "public, max-age=31536000"
+    assert "this is the code" in response.body
+    assert "plugin1:thecode" in response.body
+
+    response = app.get(bundle_url[len("/server"):],
+                       headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == "gzip"
+
+    response = app.get("/plugin/bundle/testplugins/plugin1/old.js")
+    assert "this is the code" in response.body
+    assert "no-store" in response.headers['Cache-Control']
+
+    response = app.get("/plugin/bundle/testplugins/NOPLUGIN/old.js",
+                       status=404)
+
 def test_get_stylesheet():
     response = app.get("/plugin/file/testplugins/plugin1/resources/foo/foo.css")
     content_type = response.content_type
@@ -257,6 +281,44 @@ def test_user_installed_plugins():
     assert "tiki.module('BiggerPlugin:somedir/script', function" in response.body
     assert "tiki.script('BiggerPlugin:somedir/script.js')" in response.body
     
+class ClosingBody(object):
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+    
+    def __iter__(self):
+        return iter(self.chunks)
+    
+    def close(self):
+        self.closed = True
+
+def test_wrapped_scripts_close_the_original_body():
+    body = ClosingBody(["var a;", " var b;"])
+    def script_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain"),
+                                  ("Content-Length", "13")])
+        return body
+    wrapper = controllers.scriptwrapper_middleware(script_app)
+    status = []
+    def start_response(status_line, headers):
+        status[:] = [status_line, dict(headers)]
+    def call():
+        environ = Request.blank("/getscript/MyPlugin.js%3A").environ
+        return wrapper(environ, start_response)
+    result = call()
+    # a server that stops part way through still closes the iterable
+    chunks = iter(result)
+    chunks.next()
+    result.close()
+    assert body.closed
+    
+    result = call()
+    data = "".join(result)
+    head, tail = plugins.script_wrapper("MyPlugin", "")
+    assert data == head + "var a; var b;" + tail
+    assert status[1]['Content-Type'] == "text/javascript"
+    assert status[1]['Content-Length'] == str(len(data))
+    
 def test_plugin_reload():
     _init_data()
 
@@ -0,0 +1,83 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+#
+
+import marshal
+
+from bespin import profiler
+
+def _busy():
+    return sum(range(1000))
+
+def test_samples_one_in_n_requests():
+    prof = profiler.SamplingProfiler(3)
+    sampled = [prof.should_sample("foo") for i in range(9)]
+    assert sampled.count(True) == 3
+    assert prof.should_sample("bar") == False
+
+def test_collects_and_dumps_stats():
+    prof = profiler.SamplingProfiler(1)
+    assert prof.dump_text() == ""
+    result = prof.runcall("foo", _busy)
+    assert result == 499500
+    prof.runcall("foo", _busy)
+    prof.runcall("bar", _busy)
+    assert prof.routes == dict(foo=2, bar=1)
+    
+    text = prof.dump_text("foo")
+    assert "_busy" in text
+    text = prof.dump_text()
+    assert "_busy" in text
+    
+    data = marshal.loads(prof.dump_pstats("foo"))
+    busy = [key for key in data if key[2] == "_busy"]
+    assert len(busy) == 1
+    # two calls were recorded for foo
+    assert data[busy[0]][1] == 2
+    
+    # combining routes doesn't change the stored data
+    data = marshal.loads(prof.dump_pstats("foo"))
+    assert data[busy[0]][1] == 2
+    data = marshal.loads(prof.dump_pstats())
+    assert data[busy[0]][1] == 3
+    
+    prof.reset()
+    assert prof.routes == {}
+
+def test_fast_requests_are_dropped_with_threshold():
+    prof = profiler.SamplingProfiler(1, slow_threshold=10000)
+    prof.runcall("foo", _busy)
+    assert prof.routes == {}
@@ -129,6 +129,22 @@ alert("Welcome to bigmac");
 """
     assert contents == expected
     
+def test_changed_templates_are_recompiled():
+    _init_data()
+    source = config.c.fsroot / "templates" / "changing"
+    source.makedirs()
+    config.c.template_path.append(source.dirname())
+    try:
+        (source / "readme.txt").write_bytes("Hi {username}")
+        bigmac = get_project(macgyver, macgyver, "bigmac", create=True)
+        bigmac.install_template("changing")
+        assert (bigmac.location / "readme.txt").bytes() == "Hi MacGyver"
+        (source / "readme.txt").write_bytes("Goodbye {username}")
+        bigmac.install_template("changing")
+        assert (bigmac.location / "readme.txt").bytes() == "Goodbye MacGyver"
+    finally:
+        config.c.template_path.remove(source.dirname())
+
 def test_common_base_selection():
     tests = [
         (["foo.js", "bar.js"], ""),
@@ -0,0 +1,146 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+
+"""Runs the hot queries in database.py against SQLite and checks with
+EXPLAIN QUERY PLAN that none of them scans a whole table."""
+
+import re
+
+from sqlalchemy import create_engine
+from sqlalchemy.interfaces import ConnectionProxy
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+from bespin import config, database
+from bespin.database import Base, User
+from bespin.filesystem import get_project
+
+class StatementRecorder(ConnectionProxy):
+    def __init__(self):
+        self.recording = False
+        self.statements = []
+    
+    def cursor_execute(self, execute, cursor, statement, parameters,
+                       context, executemany):
+        if self.recording and statement.lstrip().upper().startswith("SELECT"):
+            self.statements.append((statement, parameters))
+        return execute(cursor, statement, parameters, context)
+
+recorder = StatementRecorder()
+engine = None
+saved_config = None
+joe = None
+bob = None
+group = None
+
+_scan = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+
+def setup_module(module):
+    global engine, saved_config, joe, bob, group
+    config.set_profile("test")
+    config.activate_profile()
+    saved_config = (config.c.dbengine, config.c.session_factory)
+    engine = create_engine("sqlite://", proxy=recorder)
+    Base.metadata.create_all(bind=engine)
+    config.c.dbengine = engine
+    config.c.session_factory = scoped_session(sessionmaker(bind=engine))
+    
+    fsroot = config.c.fsroot
+    if fsroot.exists() and fsroot.basename() == "testfiles":
+        fsroot.rmtree()
+    fsroot.makedirs()
+    
+    session = config.c.session_factory()
+    joe = User.create_user("joe", "joe", "joe@example.com")
+    bob = User.create_user("bob", "bob", "bob@example.com")
+    project = get_project(joe, joe, "shared", create=True)
+    group = joe.add_group("friends")
+    group.add_member(bob)
+    joe.add_sharing(project, bob)
+    joe.add_sharing(project, group)
+    joe.add_sharing(project, "everyone")
+    bob.follow(joe)
+    bob.publish(dict(text="hello"))
+    session.commit()
+
+def teardown_module(module):
+    config.c.dbengine, config.c.session_factory = saved_config
+
+def _check_plans(func, *args):
+    database._user_ids.clear()
+    recorder.statements = []
+    recorder.recording = True
+    try:
+        func(*args)
+    finally:
+        recorder.recording = False
+    assert recorder.statements, "%s ran no queries" % func.__name__
+    
+    cursor = engine.raw_connection().cursor()
+    for statement, parameters in recorder.statements:
+        plan = [row[-1] for row in cursor.execute(
+                    "EXPLAIN QUERY PLAN " + statement, parameters)]
+        for step in plan:
+            match = _scan.match(step)
+            assert not (match and match.group(1) in Base.metadata.tables), \
+                "%s scans %s:\n%s\n%s" % (func.__name__, match.group(1),
+                                          statement, "\n".join(plan))
+
+def test_find_user_by_username():
+    _check_plans(User.find_user, "joe")
+
+def test_find_user_by_email():
+    _check_plans(User.find_user, "bob@example.com")
+
+def test_project_access():
+    _check_plans(joe.get_project_access, "shared", bob)
+
+def test_shared_projects():
+    _check_plans(bob.get_shared_projects)
+
+def test_groups_with_member():
+    _check_plans(joe.get_groups, bob)
+
+def test_group_members():
+    _check_plans(group.get_members)
+
+def test_sharing_for_project():
+    _check_plans(joe.get_sharing, get_project(joe, joe, "shared"))
+
+def test_users_i_follow():
+    _check_plans(bob.users_i_follow)
+
+def test_pop_messages():
+    _check_plans(bob.pop_messages)
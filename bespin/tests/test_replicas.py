@@ -0,0 +1,94 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+# 
+
+import tempfile
+
+from nose.tools import assert_equals
+
+from bespin import config, database
+from bespin.database import User, Base
+
+def _sqlite_file():
+    return "sqlite:///" + tempfile.mktemp()
+
+def setup_module(module):
+    config.set_profile("test")
+    # the replica gets its own copy of the user, so that the tests can
+    # tell which database answered
+    config.c.dburl = _sqlite_file()
+    config.c.db_replica_urls = _sqlite_file()
+    config.activate_profile()
+    for engine in [config.c.dbengine] + config.c.replica_engines:
+        Base.metadata.create_all(bind=engine)
+    User.create_user("BillBixby", "hulkrulez", "bill@primary.com")
+    database._get_session().commit()
+    database.use_replica()
+    try:
+        User.create_user("BillBixby", "hulkrulez", "bill@replica.com")
+        database._get_session().commit()
+    finally:
+        database.use_primary()
+
+def teardown_module(module):
+    config.set_profile("test")
+    config.c.db_replica_urls = []
+    config.activate_profile()
+
+def test_replica_engines_are_created_per_url():
+    assert_equals(len(config.c.replica_engines), 1)
+    assert_equals(len(config.c.replica_session_factories), 1)
+    assert config.c.replica_engines[0] is not config.c.dbengine
+
+def test_queries_go_to_the_replica_until_use_primary():
+    assert database.use_replica()
+    try:
+        user = User.find_user("BillBixby")
+        assert_equals(user.email, "bill@replica.com")
+    finally:
+        database.use_primary()
+    user = User.find_user("BillBixby")
+    assert_equals(user.email, "bill@primary.com")
+
+def test_use_replica_without_replicas():
+    replicas = config.c.replica_session_factories
+    config.c.replica_session_factories = []
+    try:
+        assert not database.use_replica()
+        user = User.find_user("BillBixby")
+        assert_equals(user.email, "bill@primary.com")
+    finally:
+        config.c.replica_session_factories = replicas
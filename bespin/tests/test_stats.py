@@ -34,6 +34,7 @@
 #
 # ***** END LICENSE BLOCK *****
 #
+import threading
 from datetime import date
 
 from bespin import stats
@@ -55,4 +56,120 @@ def test_stats_operations():
     
     result = ms.multiget(['foo', datekey])
     assert result == {'foo':100, datekey:100}
-    
\ No newline at end of file
+    
+class FakeRedis(object):
+    def __init__(self):
+        self.values = {}
+        self.pipelines = 0
+        
+    def pipeline(self, *commands):
+        self.pipelines += 1
+        result = []
+        for command, key, by in commands:
+            assert command == "INCRBY"
+            self.values[key] = self.values.get(key, 0) + by
+            result.append(self.values[key])
+        return result
+    
+    def mget(self, *keys):
+        return [self.values.get(key) for key in keys]
+    
+    def disconnect(self):
+        pass
+
+def test_redis_stats_incr_many_uses_one_round_trip():
+    redis = FakeRedis()
+    rs = stats.RedisStats(redis)
+    result = rs.incr_many(dict(foo=2, bar=3))
+    assert result == dict(foo=2, bar=3)
+    assert redis.pipelines == 1
+
+def test_buffered_stats_flushes_in_batches():
+    redis = FakeRedis()
+    bs = stats.BufferedStats(stats.RedisStats(redis), flush_interval=600,
+                             max_pending=5)
+    bs.incr("foo")
+    bs.incr("foo")
+    bs.incr("bar", 10)
+    bs.decr("bar")
+    assert redis.pipelines == 0
+    
+    # reads see the updates that haven't been sent yet
+    result = bs.multiget(["foo", "bar"])
+    assert result == dict(foo=2, bar=9)
+    
+    bs.incr("foo")
+    assert redis.pipelines == 1
+    assert redis.values == dict(foo=3, bar=9)
+    assert bs.multiget(["foo", "bar"]) == dict(foo=3, bar=9)
+    
+    bs.incr("foo_DATE")
+    bs.flush()
+    datekey = "foo_" + date.today().strftime("%Y%m%d")
+    assert redis.values[datekey] == 1
+    assert redis.pipelines == 2
+
+def test_buffered_stats_flushes_after_interval():
+    ms = stats.MemoryStats()
+    bs = stats.BufferedStats(ms, flush_interval=0, max_pending=1000)
+    bs.incr("foo", 4)
+    assert ms.storage['foo'] == 4
+
+class SlowStats(stats.MemoryStats):
+    def __init__(self):
+        stats.MemoryStats.__init__(self)
+        self.started = threading.Event()
+        self.release = threading.Event()
+    
+    def incr_many(self, deltas):
+        self.started.set()
+        self.release.wait()
+        return stats.MemoryStats.incr_many(self, deltas)
+
+def test_buffered_stats_count_while_a_flush_is_running():
+    ss = SlowStats()
+    bs = stats.BufferedStats(ss, flush_interval=600, max_pending=2)
+    bs.incr("foo")
+    flusher = threading.Thread(target=bs.incr, args=("foo",))
+    flusher.start()
+    ss.started.wait()
+    # the flush is stuck talking to the wrapped stats, but other
+    # updates and reads don't wait for it
+    bs.incr("foo")
+    bs.incr("bar")
+    assert bs.multiget(["foo", "bar"]) == dict(foo=3, bar=1)
+    ss.release.set()
+    flusher.join()
+    assert ss.storage == dict(foo=2)
+    bs.flush()
+    assert ss.storage == dict(foo=3, bar=1)
+    assert bs.multiget(["foo", "bar"]) == dict(foo=3, bar=1)
+
+def test_timing_histogram_and_percentiles():
+    ms = stats.MemoryStats()
+    for value in [1, 2, 3, 4, 7, 7, 30, 30, 400, 20000]:
+        ms.timing("timing_foo_DATE", value)
+    counts = stats.get_histogram(ms, "timing_foo_DATE")
+    assert len(counts) == len(stats.LATENCY_BUCKETS) + 1
+    assert sum(counts) == 10
+    assert counts[0] == 4
+    assert counts[-1] == 1
+    assert stats.percentile(counts, 50) == 10
+    assert stats.percentile(counts, 90) == 500
+    assert stats.percentile(counts, 99) is None
+    assert stats.percentile([0] * len(counts), 50) is None
+
+def test_donothing_timing():
+    dn = stats.DoNothingStats()
+    dn.timing("timing_foo_DATE", 10)
+    assert stats.get_histogram(dn, "timing_foo_DATE") == \
+        [0] * (len(stats.LATENCY_BUCKETS) + 1)
+
+def test_query_counter():
+    from sqlalchemy import create_engine
+    counter = stats.QueryCounter()
+    engine = create_engine("sqlite://", proxy=counter)
+    start = counter.count
+    engine.execute("select 1")
+    engine.execute("select 2")
+    assert counter.count - start == 2
@@ -35,9 +35,11 @@
 # ***** END LICENSE BLOCK *****
 # 
 
+import time
+
 import simplejson
 
-from bespin import config, controllers, auth
+from bespin import config, controllers, auth, passwords, database, stats
 from bespin.database import User, Base, ConflictError, EventLog
 from bespin.filesystem import get_project
 
@@ -101,6 +103,43 @@ def test_get_user_returns_none_for_nonexistent():
     user = User.find_user("NOT THERE. NO REALLY!")
     assert user is None
     
+def test_legacy_password_is_upgraded_on_login():
+    s = _get_session(True)
+    u = User.create_user("BillBixby", "somepass", "bill@bixby.com")
+    assert u.password.startswith("pbkdf2_sha256$")
+    legacy = passwords.SHA256Hasher(config.c.pw_secret)
+    u.password = legacy.encode("somepass")
+    s.commit()
+    
+    assert User.find_user("BillBixby", "otherpass") is None
+    user = User.find_user("BillBixby", "somepass")
+    assert user.password.startswith("pbkdf2_sha256$")
+    s.commit()
+    assert User.find_user("BillBixby", "somepass") is not None
+
+def test_repeated_user_lookups_within_a_request():
+    s = _get_session(True)
+    User.create_user("BillBixby", "somepass", "bill@bixby.com")
+    s.commit()
+    
+    database.start_request_cache(s)
+    try:
+        user = User.find_user("BillBixby")
+        start = stats.query_counter.count
+        for i in range(5):
+            assert User.find_user("BillBixby") is user
+            user.file_location
+        assert stats.query_counter.count == start
+    finally:
+        database.end_request_cache(s)
+    s.commit()
+    
+    # between requests the username to id mapping is kept, so only the
+    # user's row is reloaded
+    start = stats.query_counter.count
+    user = User.find_user("BillBixby")
+    user.file_location
+    assert stats.query_counter.count == start + 1
 
 # Controller Tests
 
@@ -237,6 +276,35 @@ def test_messages_sent_from_server_to_user():
     data = simplejson.loads(resp.body)
     assert len(data) == 0
     
+def test_messages_long_poll():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post("/register/new/macgyver",
+        dict(password="foo", email="macgyver@ducttape.macgyver"))
+    config.c.message_wait_max = 0.2
+    # with collab on, every poll also carries a mobwrite answer
+    old_capabilities = config.c.capabilities
+    config.c.capabilities = old_capabilities - set(["collab"])
+    try:
+        # nothing arrives, so the poll gives up after the wait
+        start = time.time()
+        resp = app.post("/messages/?wait=30")
+        assert simplejson.loads(resp.body) == []
+        assert 0.2 <= time.time() - start < 5
+        
+        s = _get_session()
+        macgyver = User.find_user("macgyver")
+        macgyver.publish(dict(my="message"))
+        s.commit()
+        resp = app.post("/messages/?wait=30")
+        assert simplejson.loads(resp.body) == [dict(my="message")]
+        
+        app.post("/messages/?wait=soon", status=400)
+    finally:
+        config.c.message_wait_max = 0
+        config.c.capabilities = old_capabilities
+    
 def test_get_users_settings():
     _clear_db()
     app = controllers.make_app()
@@ -251,7 +319,58 @@ vcsuser Mack Gyver <gyver@mac.com>
     macgyver = User.find_user("macgyver")
     settings = macgyver.get_settings()
     assert settings == dict(vcsuser="Mack Gyver <gyver@mac.com>")
-    
+
+def test_settings_are_cached_until_changed():
+    _clear_db()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post("/register/new/macgyver",
+        dict(password="foo", email="macgyver@ducttape.macgyver"))
+    resp = app.put("/file/at/BespinSettings/settings", "vcsuser Mack\n")
+    s = _get_session()
+    macgyver = User.find_user("macgyver")
+    settings_file = macgyver.get_location() / "BespinSettings" / "settings"
+
+    config.c.settings_check_interval = 60
+    try:
+        assert macgyver.get_settings() == dict(vcsuser="Mack")
+        settings_file.write_bytes("vcsuser Gyver\n")
+        assert macgyver.get_settings() == dict(vcsuser="Mack")
+
+        resp = app.put("/file/at/BespinSettings/settings", "vcsuser Angus\n")
+        assert macgyver.get_settings() == dict(vcsuser="Angus")
+
+        assert macgyver.get_plugin_info() is None
+        resp = app.put("/file/at/BespinSettings/pluginInfo.json",
+                       '{"plugins": ["BespinSettings/plugins/Foo.js"]}')
+        info = macgyver.get_plugin_info()
+        assert info == dict(plugins=["BespinSettings/plugins/Foo.js"])
+
+        config.c.settings_check_interval = 0
+        settings_file.write_bytes("vcsuser Mac Gyver\n")
+        assert macgyver.get_settings() == dict(vcsuser="Mac Gyver")
+    finally:
+        config.c.settings_check_interval = 0
+
+def test_read_only_requests_fall_back_to_the_primary():
+    config.set_profile("test")
+    # the replica has no tables, so every query sent to it fails
+    config.c.db_replica_urls = "sqlite://"
+    config.activate_profile()
+    try:
+        _clear_db()
+        app = controllers.make_app()
+        app = BespinTestApp(app)
+        resp = app.post("/register/new/BillBixby",
+            dict(email="bill@bixby.com", password="notangry"))
+        resp = app.get("/network/followers/")
+        assert simplejson.loads(resp.body) == []
+        assert database._replica.factory is None
+    finally:
+        config.set_profile("test")
+        config.c.db_replica_urls = []
+        config.activate_profile()
+
 def test_users_can_be_locked_out():
     config.set_profile("test")
     config.c.login_failure_tracking = "memory"
@@ -346,4 +465,111 @@ def test_password_change_bad_code():
                                             code="42",
                                             newPassword="hatetraffic"),
                     status=400)
-    
\ No newline at end of file
+    
+class _BusyPasswords(object):
+    def encode(self, password):
+        raise passwords.PasswordHashBusy()
+
+def test_busy_password_hashing_yields_503():
+    config.set_profile("test")
+    config.activate_profile()
+    _clear_db()
+    
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post('/register/new/BillBixby', dict(email="bill@bixby.com",
+                                                    password="notangry"))
+    app.reset()
+    user = User.find_user("BillBixby")
+    verify_code = controllers._get_password_verify_code(user)
+    
+    old_passwords = config.c.passwords
+    config.c.passwords = _BusyPasswords()
+    try:
+        resp = app.post('/register/new/macgyver',
+            dict(email="macgyver@ducttape.macgyver", password="foo"),
+            status=503)
+        assert resp.headers['Retry-After'] == "5"
+        resp = app.post('/register/password/BillBixby', dict(
+                                            code=verify_code,
+                                            newPassword="hatetraffic"),
+                        status=503)
+    finally:
+        config.c.passwords = old_passwords
+    assert User.find_user("macgyver") is None
+    assert User.find_user("BillBixby", "notangry")
+    
+def test_stats_include_route_timings():
+    config.set_profile("test")
+    config.c.stats_type = "memory"
+    config.c.stats_users = "BillBixby"
+    config.activate_profile()
+    _clear_db()
+    
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    resp = app.post('/register/new/BillBixby', dict(email="bill@bixby.com",
+                                                    password="notangry"))
+    app.get('/register/userinfo/')
+    app.get('/register/userinfo/')
+    resp = app.get('/stats/')
+    data = simplejson.loads(resp.body)
+    route = data['routes']['get_registered']
+    assert route['count'] == 2
+    assert route['p50'] is not None
+    assert route['avgBytes'] > 0
+    assert route['avgQueries'] >= 0
+    config.set_profile("test")
+    config.c.stats_type = "none"
+    config.c.stats_users = set()
+    config.activate_profile()
+
+def test_profile_report_rejects_unknown_sort_keys():
+    config.set_profile("test")
+    config.c.profile_sample_rate = 1
+    config.c.stats_users = "BillBixby"
+    config.activate_profile()
+    _clear_db()
+    
+    try:
+        app = controllers.make_app()
+        app = BespinTestApp(app)
+        resp = app.post('/register/new/BillBixby',
+            dict(email="bill@bixby.com", password="notangry"))
+        app.get('/register/userinfo/')
+        resp = app.get('/stats/profile/?sort=tottime')
+        assert "Ordered by: internal time" in resp.body
+        resp = app.get('/stats/profile/?sort=bogus', status=400)
+    finally:
+        config.set_profile("test")
+        config.c.profile_sample_rate = 0
+        config.c.stats_users = set()
+        config.activate_profile()
+
+def test_login_burst_locks_out_without_growing_tracker():
+    config.set_profile("test")
+    config.c.login_failure_tracking = "memory"
+    config.c.login_attempts = "3"
+    config.c.login_tracker_max_entries = "50"
+    config.activate_profile()
+    app = controllers.make_app()
+    app = BespinTestApp(app)
+    _clear_db()
+    
+    resp = app.post('/register/new/BillBixby', dict(email="bill@bixby.com",
+                                                    password="notangry"))
+    app.reset()
+    for i in range(200):
+        app.post("/register/login/BillBixby",
+            dict(password="guess%s" % i), status=401)
+        app.post("/register/login/nobody%s" % i,
+            dict(password="guess%s" % i), status=401)
+    
+    assert len(config.c.login_tracker.store) <= 50
+    resp = app.post("/register/login/BillBixby",
+        dict(password="notangry"), status=401)
+    assert "Locked out" in resp.body
+    
+    config.set_profile("test")
+    config.c.login_failure_tracking = "none"
+    config.activate_profile()
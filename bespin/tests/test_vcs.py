@@ -127,6 +127,7 @@ def test_run_a_diff(run_command_params):
     _init_data()
     bigmac = get_project(macgyver, macgyver, 'bigmac', create=True)
     bigmac.save_file(".hg/hgrc", "# test rc file\n")
+    bigmac.save_temp_file("foo.js", "mobwrite's copy")
     cmd = ["diff"]
     output = vcs._run_command_impl(macgyver, bigmac, cmd, None)
     command, context = run_command_params
@@ -136,6 +137,8 @@ def test_run_a_diff(run_command_params):
     assert isinstance(command, hg.diff)
     assert working_dir == bigmac.location
     assert output['output'] == diff_output
+    # the command could have changed the files under mobwrite
+    assert not bigmac.temp_directory.exists()
     
 update_output = """27 files updates from 97 changesets with 3.2 changes per file,
 all on line 10."""
@@ -0,0 +1,95 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Bespin.
+#
+# The Initial Developer of the Original Code is
+# Mozilla.
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+# 
+
+import os
+import tempfile
+
+from path import path
+from nose.tools import assert_equals
+
+from bespin import config, filesystem
+
+def setup_module(module):
+    config.set_profile("test")
+    config.activate_profile()
+
+def teardown_module(module):
+    config.set_profile("test")
+    config.activate_profile()
+
+def _use_mode(mode):
+    config.c.write_mode = mode
+    config.c.write_sync = filesystem.get_write_sync(mode)
+
+def test_each_mode_saves_files():
+    directory = path(tempfile.mkdtemp())
+    try:
+        for mode in ["fast", "safe"]:
+            _use_mode(mode)
+            target = directory / mode
+            filesystem._save(target, "first")
+            filesystem._save(target, u"second\r\nline")
+            assert_equals(target.bytes(), "second\nline")
+        assert_equals(sorted(directory.files()),
+                      [directory / "fast", directory / "safe"])
+    finally:
+        directory.rmtree()
+
+def test_safe_writes_replace_the_file():
+    directory = path(tempfile.mkdtemp())
+    try:
+        target = directory / "foo"
+        _use_mode("safe")
+        filesystem._save(target, "Chewing gum wrapper")
+        inode = target.stat().st_ino
+
+        def fail(output):
+            output.write("half of it")
+            raise IOError("disk full")
+        try:
+            filesystem._write_file(target, fail)
+            assert False, "Expected the write to fail"
+        except IOError:
+            pass
+        assert_equals(target.bytes(), "Chewing gum wrapper")
+        assert_equals(directory.files(), [target])
+
+        filesystem._save(target, "Paper clip")
+        assert target.stat().st_ino != inode
+        assert_equals(target.stat().st_mode & 0777, 0666 & ~filesystem._UMASK)
+    finally:
+        directory.rmtree()
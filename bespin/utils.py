@@ -35,6 +35,7 @@
 # ***** END LICENSE BLOCK *****
 #
 
+import os
 import re
 import logging
 import smtplib
@@ -43,6 +44,7 @@ from email.mime.text import MIMEText
 import pkg_resources
 
 from bespin import config, jsontemplate
+from bespin.cache import LRUCache
 
 log = logging.getLogger("bespin.model")
 
@@ -85,18 +87,36 @@ def send_text_email(to_addr, subject, text, from_addr=None):
     s.sendmail(from_addr, to_addr, msg.as_string())
     s.quit()
     
+# compiled templates, by filename
+_templates = LRUCache(500)
+
+def load_template(filename, header_options=False):
+    """Returns the compiled jsontemplate.Template in the file. Templates
+    are compiled once and kept until the file's mtime or size changes.
+    If header_options is True, the file can start with template options
+    (see jsontemplate.FromFile)."""
+    stat = os.stat(filename)
+    key = (filename, header_options)
+    entry = _templates.get(key)
+    if entry is not None and entry[0] == (stat.st_mtime, stat.st_size):
+        return entry[1]
+    template_file = open(filename)
+    try:
+        if header_options:
+            template = jsontemplate.FromFile(template_file)
+        else:
+            template = jsontemplate.Template(template_file.read())
+    finally:
+        template_file.close()
+    _templates.set(key, ((stat.st_mtime, stat.st_size), template))
+    return template
+
 def send_email_template(to_addr, subject, template_name, context, from_addr=None):
     """Send an email by applying context to the template in bespin/mailtemplates
     given by template_name and passing the resulting text to send_text_email."""
     template_filename = pkg_resources.resource_filename("bespin", 
                                         "mailtemplates/%s" % template_name)
-    template_file = open(template_filename)
-    
-    try:
-        template = jsontemplate.FromFile(template_file)
-    finally:
-        template_file.close()
-        
+    template = load_template(template_filename, header_options=True)
     text = template.expand(context)
     send_text_email(to_addr, subject, text, from_addr)
     
\ No newline at end of file
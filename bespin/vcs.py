@@ -358,7 +358,12 @@ def _run_command_impl(user, project, args, kcpass):
                     needsInput=True, args=new_args, 
                     prompt = e.prompt)
 
-            main.run_command(command, context)
+            try:
+                main.run_command(command, context)
+            finally:
+                # update, revert and friends change files behind
+                # mobwrite's back, so its temp copies are stale now
+                project._remove_temp_copy("")
         finally:
             if keyfile:
                 keyfile.delete()
@@ -280,3 +280,199 @@ def try_upgrade():
     dburl = config.c.dburl
     dry("Test the database upgrade", main, ["test", repository, dburl])
 
+
+@task
+def bench_dispatch():
+    """Time URL dispatch per route for URLRelay and IndexedURLRelay."""
+    import timeit
+    from urlrelay import URLRelay
+    from bespin import config, controllers, framework
+    config.set_profile('test')
+    config.activate_profile()
+    paths = [
+        ("/file/at/", "/file/at/MyProject/foo.js", "GET"),
+        ("/file/list/", "/file/list/MyProject/", "GET"),
+        ("/plugin/", "/plugin/register/defaults", "GET"),
+        ("/share/", "/share/list/all/", "GET"),
+        ("/register/", "/register/userinfo/", "GET"),
+        ("/settings/", "/settings/", "POST"),
+        ("/messages/", "/messages/", "POST"),
+        ("static", "/css/editor.css", "GET"),
+    ]
+    relays = [("urlrelay", URLRelay(default=None)),
+              ("indexed", framework.IndexedURLRelay(default=None))]
+    # URLRelay caches resolved paths, so a unique path is used for
+    # each call to measure the cost of actually matching the patterns
+    number = 2000
+    for name, path, method in paths:
+        timings = []
+        for relay_name, relay in relays:
+            counter = [0]
+            def resolve():
+                counter[0] += 1
+                try:
+                    relay.resolve(path + str(counter[0]), method)
+                except ImportError:
+                    pass
+            best = min(timeit.repeat(resolve, number=number, repeat=3))
+            timings.append("%s %6.1fus" % (relay_name, 
+                                           best / number * 1000000))
+        info("%-12s %s" % (name, "  ".join(timings)))
+
+@task
+@cmdopts([('target=', 't', 'Milliseconds one password hash should take')])
+def bench_passwords(options):
+    """Time password hashing to choose password_iterations."""
+    from bespin import passwords
+    target = 100
+    if 'bench_passwords' in options and options.bench_passwords.get('target'):
+        target = options.bench_passwords.target
+    target = float(target) / 1000
+    iterations = 1000
+    while True:
+        hasher = passwords.PBKDF2Hasher("benchmark secret", iterations)
+        elapsed = passwords.time_hasher(hasher)
+        info("%8d iterations: %6.1fms" % (iterations, elapsed * 1000))
+        if elapsed >= target:
+            break
+        iterations *= 2
+    suggested = int(iterations * target / elapsed)
+    info("password_iterations = %d takes about %dms per login"
+         % (suggested, target * 1000))
+
+@task
+@cmdopts([('file=', 'f', 'Event log spill file to load')])
+def load_event_spill(options):
+    """Load events that were spilled to a file into the EventLog."""
+    if not 'load_event_spill' in options or not options.load_event_spill.file:
+        raise BuildFailure("You must specify a spill file with -f.")
+    from bespin import config, database
+    config.set_profile('dev')
+    config.activate_profile()
+    count = database.load_spill_file(options.load_event_spill.file,
+                                     config.c.dbengine)
+    info("Loaded %s events" % count)
+
+@task
+def verify_quotas():
+    """Rescan every user's files and correct amount_used where it has
+    drifted. Run this periodically (from cron, for example)."""
+    from bespin import config, database
+    config.set_profile('dev')
+    config.activate_profile()
+    session = config.c.session_factory()
+    drifted = database.verify_space_used(session)
+    session.commit()
+    for username, recorded, actual in drifted:
+        info("%s: recorded %s bytes, actually using %s"
+             % (username, recorded, actual))
+    info("%s users corrected" % len(drifted))
+
+@task
+def collect_blobs():
+    """Remove the files in the blob store that no project links to."""
+    from bespin import config
+    config.set_profile('dev')
+    config.activate_profile()
+    if config.c.blob_store is None:
+        raise BuildFailure("The blob store is not enabled (use_blob_store)")
+    count = config.c.blob_store.collect()
+    info("Removed %s blobs" % count)
+
+@task
+@cmdopts([('signups=', 's', 'Number of signups to simulate')])
+def bench_templates(options):
+    """Time expanding the templates that a signup installs, compiling
+    each file every time (as before) and with the compiled template
+    cache."""
+    import os
+    import time
+    from bespin import config, filesystem, jsontemplate, utils
+    config.set_profile('test')
+    config.activate_profile()
+    signups = 1000
+    if 'bench_templates' in options:
+        signups = int(options.bench_templates.get('signups') or signups)
+    templates = ["template", "usertemplate"]
+
+    def uncached(variables):
+        for template in templates:
+            for p in config.c.template_path:
+                source_dir = os.path.join(p, template)
+                if os.path.isdir(source_dir):
+                    break
+            for dirpath, dirnames, filenames in os.walk(source_dir):
+                for f in filenames:
+                    contents = open(os.path.join(dirpath, f)).read()
+                    variables['filename'] = f
+                    jsontemplate.expand(contents, variables)
+
+    def cached(variables):
+        for template in templates:
+            filesystem.expand_template(template, variables)
+
+    for name, expand in [("uncached", uncached), ("cached", cached)]:
+        utils._templates.clear()
+        start = time.time()
+        for i in range(signups):
+            variables = filesystem.LenientUndefinedDict(
+                project="SampleProject", username="user%s" % i)
+            expand(variables)
+        elapsed = time.time() - start
+        info("%-8s %8.3fms per signup" % (name, elapsed / signups * 1000))
+
+@task
+def compress_static():
+    """Write gzipped copies of the files in the static_map directories."""
+    from bespin import config, compress
+    config.set_profile('dev')
+    config.activate_profile()
+    for location, directory in config.c.static_map.items():
+        count = compress.compress_directory(directory)
+        info("%s: compressed %s files" % (location, count))
+
+@task
+@cmdopts([('threads=', 't', 'Number of concurrent writers'),
+          ('count=', 'c', 'Number of saves per writer')])
+def bench_writes(options):
+    """Time file saves in each write_mode."""
+    import tempfile
+    import threading
+    import time
+    from path import path
+    from bespin import config, filesystem
+    config.set_profile('dev')
+    config.activate_profile()
+    threads = 8
+    count = 50
+    if 'bench_writes' in options:
+        threads = int(options.bench_writes.get('threads') or threads)
+        count = int(options.bench_writes.get('count') or count)
+    contents = "x" * 4096
+    directory = path(tempfile.mkdtemp())
+    try:
+        for mode in ["fast", "safe"]:
+            config.c.write_mode = mode
+            config.c.write_sync = filesystem.get_write_sync(mode)
+            latencies = []
+            def writer(number):
+                for i in range(count):
+                    start = time.time()
+                    filesystem._save(directory / ("%s-%s" % (number, i)),
+                                     contents)
+                    latencies.append(time.time() - start)
+            workers = [threading.Thread(target=writer, args=(i,))
+                       for i in range(threads)]
+            start = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.time() - start
+            latencies.sort()
+            info("%-6s %8.1f saves/s  median %6.2fms  p99 %6.2fms" % (
+                mode, len(latencies) / elapsed,
+                latencies[len(latencies) / 2] * 1000,
+                latencies[int(len(latencies) * 0.99)] * 1000))
+    finally:
+        directory.rmtree()